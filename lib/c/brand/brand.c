@@ -5,6 +5,9 @@
 #include <string.h>
 #include <unistd.h>
 #include <signal.h>
+#include <fcntl.h>
+#include <sys/mman.h>
+#include <sys/stat.h>
 #include "brand.h"
 
 //---------------------------------------------------------------------------
@@ -389,3 +392,128 @@ void stop_new_redis_instance(char *host, int port)
     free(new_redis_command); 
     free(redis_port_string);
 }
+
+//--------------------------------------------------------------
+// Shared-memory payload ring
+//--------------------------------------------------------------
+// Header: uint32 magic, uint32 version, uint32 n_slots, uint32 slot_size,
+// uint64 write_seq. Each slot: uint64 seq (0 while being written), padded
+// to 64 bytes, followed by the payload padded to a multiple of 64 bytes.
+
+struct brand_shm_header {
+    uint32_t magic;
+    uint32_t version;
+    uint32_t n_slots;
+    uint32_t slot_size;
+    uint64_t write_seq;
+};
+
+static uint64_t *slot_seq_ptr(const brand_shm_ring *ring, uint32_t slot) {
+    return (uint64_t *)(ring->mem + BRAND_SHM_HEADER_SIZE + slot * ring->stride);
+}
+
+// Open (and, for the producer, create) the ring /dev/shm/<name>.
+// slot_size and n_slots are only used when create is true.
+// Returns 0 on success and -1 on error.
+int brand_shm_ring_open(brand_shm_ring *ring, const char *name, uint32_t slot_size, uint32_t n_slots, bool create) {
+
+    char shm_name[256];
+    snprintf(shm_name, sizeof(shm_name), "/%s", name);
+
+    int fd = shm_open(shm_name, create ? O_CREAT | O_RDWR : O_RDONLY, 0600);
+    if (fd == -1) {
+        printf("shm_open failed for %s\n", shm_name);
+        return -1;
+    }
+
+    size_t size;
+    if (create) {
+        size_t stride = BRAND_SHM_SLOT_HEADER_SIZE + ((slot_size + 63) / 64) * 64;
+        size = BRAND_SHM_HEADER_SIZE + n_slots * stride;
+        if (ftruncate(fd, size)) {
+            printf("ftruncate failed for %s\n", shm_name);
+            close(fd);
+            return -1;
+        }
+    } else {
+        struct stat st;
+        if (fstat(fd, &st)) {
+            printf("fstat failed for %s\n", shm_name);
+            close(fd);
+            return -1;
+        }
+        // the producer may not have sized the ring yet
+        if ((size_t)st.st_size < BRAND_SHM_HEADER_SIZE) {
+            printf("%s is not initialized yet\n", shm_name);
+            close(fd);
+            return -1;
+        }
+        size = st.st_size;
+    }
+
+    ring->mem = mmap(NULL, size, create ? PROT_READ | PROT_WRITE : PROT_READ, MAP_SHARED, fd, 0);
+    close(fd);
+    if (ring->mem == MAP_FAILED) {
+        printf("mmap failed for %s\n", shm_name);
+        return -1;
+    }
+    ring->size = size;
+
+    struct brand_shm_header *header = (struct brand_shm_header *)ring->mem;
+    if (create) {
+        header->write_seq = 0;
+        header->n_slots = n_slots;
+        header->slot_size = slot_size;
+        header->version = BRAND_SHM_VERSION;
+        header->magic = BRAND_SHM_MAGIC;
+    } else if (header->magic != BRAND_SHM_MAGIC || header->version != BRAND_SHM_VERSION) {
+        printf("%s is not a BRAND shared memory ring\n", shm_name);
+        munmap(ring->mem, size);
+        return -1;
+    }
+
+    ring->n_slots = header->n_slots;
+    ring->slot_size = header->slot_size;
+    ring->stride = BRAND_SHM_SLOT_HEADER_SIZE + ((ring->slot_size + 63) / 64) * 64;
+    return 0;
+}
+
+// Copy a payload into the next slot. The slot index is stored in *slot
+// and the sequence number of the payload is returned (0 on error).
+uint64_t brand_shm_ring_write(brand_shm_ring *ring, const void *payload, size_t nbytes, uint32_t *slot) {
+
+    if (nbytes > ring->slot_size) {
+        printf("Payload of %zu bytes does not fit in slots of %u bytes\n", nbytes, ring->slot_size);
+        return 0;
+    }
+
+    struct brand_shm_header *header = (struct brand_shm_header *)ring->mem;
+    uint64_t seq = header->write_seq + 1;
+    *slot = (uint32_t)((seq - 1) % ring->n_slots);
+
+    uint64_t *slot_seq = slot_seq_ptr(ring, *slot);
+    __atomic_store_n(slot_seq, 0, __ATOMIC_RELEASE);  // mark the slot as being written
+    memcpy((uint8_t *)slot_seq + BRAND_SHM_SLOT_HEADER_SIZE, payload, nbytes);
+    __atomic_store_n(slot_seq, seq, __ATOMIC_RELEASE);
+    __atomic_store_n(&header->write_seq, seq, __ATOMIC_RELEASE);
+
+    return seq;
+}
+
+// Get a pointer to the payload with sequence number seq, or NULL if the
+// slot has since been overwritten. Check brand_shm_ring_is_valid after
+// using the payload if the reader may fall n_slots payloads behind.
+const void *brand_shm_ring_read(const brand_shm_ring *ring, uint32_t slot, uint64_t seq) {
+    if (!brand_shm_ring_is_valid(ring, slot, seq))
+        return NULL;
+    return (const uint8_t *)slot_seq_ptr(ring, slot) + BRAND_SHM_SLOT_HEADER_SIZE;
+}
+
+bool brand_shm_ring_is_valid(const brand_shm_ring *ring, uint32_t slot, uint64_t seq) {
+    return slot < ring->n_slots && __atomic_load_n(slot_seq_ptr(ring, slot), __ATOMIC_ACQUIRE) == seq;
+}
+
+void brand_shm_ring_close(brand_shm_ring *ring) {
+    munmap(ring->mem, ring->size);
+    ring->mem = NULL;
+}
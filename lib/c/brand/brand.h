@@ -1,6 +1,7 @@
 /* Utilities for working with BRAND in Redis */
 
 #include  <stdbool.h>
+#include  <stdint.h>
 #include  <hiredis.h>
 #include  "nxjson.h"
 
@@ -37,3 +38,26 @@ enum node_state {NODE_STARTED, NODE_READY, NODE_SHUTDOWN, NODE_FATAL_ERROR, NODE
 void emit_status(redisContext *c, const char *node_name, enum node_state state, const char *node_message);
 int start_new_redis_instance(char *host, int port);
 void stop_new_redis_instance(char *host, int port);
+
+//--------------------------------------------------------------
+// Shared-memory payload ring (same layout as brand/shm.py)
+//--------------------------------------------------------------
+
+#define BRAND_SHM_MAGIC 0x48535242
+#define BRAND_SHM_VERSION 1
+#define BRAND_SHM_HEADER_SIZE 64
+#define BRAND_SHM_SLOT_HEADER_SIZE 64
+
+typedef struct {
+    uint8_t *mem;
+    size_t size;
+    uint32_t n_slots;
+    uint32_t slot_size;
+    size_t stride;
+} brand_shm_ring;
+
+int brand_shm_ring_open(brand_shm_ring *ring, const char *name, uint32_t slot_size, uint32_t n_slots, bool create);
+uint64_t brand_shm_ring_write(brand_shm_ring *ring, const void *payload, size_t nbytes, uint32_t *slot);
+const void *brand_shm_ring_read(const brand_shm_ring *ring, uint32_t slot, uint64_t seq);
+bool brand_shm_ring_is_valid(const brand_shm_ring *ring, uint32_t slot, uint64_t seq);
+void brand_shm_ring_close(brand_shm_ring *ring);
@@ -1,16 +1,72 @@
-from .tools import (get_node_parameter_value, get_parameter_value,
-                         initializeRedisFromYAML, get_node_parameter_dump,
-                         get_redis_info, main, get_node_io, unpack_string,
-                         node_stage)
+# Public names are imported from their submodules on first access (PEP 562),
+# so that e.g. `from brand import BRANDNode` does not import the supervisor,
+# booter and derivative machinery (psutil, coloredlogs, yaml, ...) that
+# nodes do not need.
+import importlib
 
-from .node import BRANDNode 
+_LAZY_ATTRS = {
+    'get_node_parameter_value': 'tools',
+    'get_parameter_value': 'tools',
+    'initializeRedisFromYAML': 'tools',
+    'get_node_parameter_dump': 'tools',
+    'get_redis_info': 'tools',
+    'main': 'tools',
+    'get_node_io': 'tools',
+    'unpack_string': 'tools',
+    'node_stage': 'tools',
+    'load_graph': 'tools',
+    'GraphFile': 'tools',
+    'StreamCodec': 'codec',
+    'get_dtype': 'codec',
+    'get_stream_codecs': 'codec',
+    'read_stream': 'codec',
+    'read_streams': 'codec',
+    'ShmRing': 'shm',
+    'ShmReader': 'shm',
+    'BRANDNode': 'node',
+    'AsyncBRANDNode': 'async_node',
+    'NodeHost': 'host',
+    'ReorderBuffer': 'sync',
+    'StreamJoin': 'sync',
+    'StreamReplay': 'replay',
+    'ClockSync': 'clock',
+    'get_clock_offsets': 'clock',
+    'LatencyTracer': 'trace',
+    'Supervisor': 'supervisor',
+    'Booter': 'booter',
+    'GraphError': 'exceptions',
+    'NodeError': 'exceptions',
+    'BooterError': 'exceptions',
+    'DerivativeError': 'exceptions',
+    'CommandError': 'exceptions',
+    'RedisError': 'exceptions',
+    'xread_count': 'redis',
+    'xread_sync': 'redis',
+    'stream_iter': 'redis',
+    'multi_stream_iter': 'redis',
+    'get_parameters': 'redis',
+    'RedisLoggingHandler': 'redis',
+}
 
-from .supervisor import Supervisor
+_SUBMODULES = {
+    'async_node', 'booter', 'clock', 'codec', 'derivative', 'exceptions',
+    'host', 'node', 'redis', 'replay', 'shm', 'supervisor', 'sync', 'timing',
+    'tools', 'trace'
+}
 
-from .booter import Booter
+__all__ = list(_LAZY_ATTRS)
 
-from .exceptions import (GraphError, NodeError, 
-                        BooterError, DerivativeError, 
-                        CommandError, RedisError)
 
-from .redis import (xread_count, xread_sync, RedisLoggingHandler)
+def __getattr__(name):
+    if name in _LAZY_ATTRS:
+        module = importlib.import_module(f'.{_LAZY_ATTRS[name]}', __name__)
+        value = getattr(module, name)
+        globals()[name] = value  # later lookups skip __getattr__
+        return value
+    if name in _SUBMODULES:
+        return importlib.import_module(f'.{name}', __name__)
+    raise AttributeError(f'module {__name__!r} has no attribute {name!r}')
+
+
+def __dir__():
+    return sorted(set(globals()) | set(_LAZY_ATTRS) | _SUBMODULES)
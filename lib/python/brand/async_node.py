@@ -0,0 +1,192 @@
+# BRAND asyncio node template
+
+import asyncio
+import inspect
+import logging
+import signal
+
+import redis.asyncio
+
+from .exceptions import NodeError
+from .node import BRANDNode
+
+
+async def _maybe_await(result):
+    if inspect.isawaitable(result):
+        return await result
+    return result
+
+
+class AsyncBRANDNode(BRANDNode):
+    """
+    BRANDNode variant for I/O-bound nodes (network, serial, UI bridges)
+    that runs on an asyncio event loop.
+
+    Argument parsing, state reporting and parameter loading are the same
+    as in BRANDNode. At run time, each registered input stream is read by
+    its own task, queued outputs are flushed by a separate task, and
+    work() is a coroutine, so I/O in all of them overlaps. Handlers
+    registered with registerInput() may be plain functions or coroutines.
+    AsyncBRANDNodes cannot be replicated.
+    """
+
+    def __init__(self):
+        super().__init__()
+
+        if self.consumer_group is not None:
+            # readInput() uses plain XREAD, which cannot read from a
+            # consumer group
+            raise NodeError(f'{self.NAME} is an AsyncBRANDNode, which cannot '
+                            'be run as replicas', node=self.NAME)
+
+        if self.redis_socket:
+            self.ar = redis.asyncio.Redis(unix_socket_path=self.redis_socket)
+        else:
+            self.ar = redis.asyncio.Redis(host=self.redis_host,
+                                          port=self.redis_port,
+                                          retry_on_timeout=True)
+
+        self.tasks = []
+        self.stop_event = None
+        self._outputs_ready = None
+
+    def addTask(self, coroutine_function):
+        """
+        Run a coroutine concurrently with the node's inputs and work()
+        until the node is stopped
+
+        Parameters
+        ----------
+        coroutine_function : callable
+            Coroutine function that takes no arguments
+        """
+        self.tasks.append(coroutine_function)
+
+    async def readInput(self, stream):
+        """
+        Read one registered input stream and dispatch its entries to its
+        handler until the node is stopped
+        """
+        while True:
+            replies = await self.ar.xread({stream: self.input_ids[stream]},
+                                          count=self.input_count,
+                                          block=self.input_block_ms)
+            for _, entries in replies:
+                self.input_ids[stream] = entries[-1][0]
+                await _maybe_await(self.input_handlers[stream](entries))
+
+    def writeOutput(self, stream, entry, sync=None):
+        super().writeOutput(stream, entry, sync=sync)
+        if self._outputs_ready is not None:
+            self._outputs_ready.set()
+
+    async def flushOutputs(self):
+        """
+        Add all queued output entries to Redis in one non-transactional
+        pipeline, applying each stream's retention policy
+
+        Returns
+        -------
+        entry_ids : list
+            IDs of the added entries, in the order they were queued
+        """
+        if not self.output_queue:
+            return []
+
+        p = self.ar.pipeline(transaction=False)
+        self._addOutputsToPipeline(p)
+        return await p.execute()
+
+    async def flushOutputsWhenReady(self):
+        """
+        Flush outputs whenever new entries are queued
+        """
+        while True:
+            await self._outputs_ready.wait()
+            self._outputs_ready.clear()
+            await self.flushOutputs()
+
+    async def updateParameters(self):
+        """
+        Apply the parameter updates published to the nickname_parameters
+        stream. Since this runs in its own task, it blocks on the XREAD call
+        instead of polling.
+
+        Returns
+        -------
+        changed : dict
+            Parameters that were updated, keyed by parameter name
+        """
+        replies = await self.ar.xread(
+            {self.parameters_stream: self.parameters_id},
+            block=self.input_block_ms)
+        return self._applyParameterUpdates(replies)
+
+    async def updateParametersForever(self):
+        while True:
+            await self.updateParameters()
+
+    async def workForever(self):
+        while not self.stop_event.is_set():
+            await self.work()
+            await self.flushOutputs()
+
+    async def work(self):
+        """
+        Coroutine containing the business logic of the node, which is
+        awaited repeatedly until the node is stopped. The default waits
+        for the node to be stopped, so nodes that are driven entirely by
+        their input handlers do not need to override it.
+        """
+        await self.stop_event.wait()
+
+    def run(self):
+        asyncio.run(self.main())
+
+    async def main(self):
+        """
+        Run all of the node's tasks until SIGINT is received, then clean up
+        """
+        self.stop_event = asyncio.Event()
+        self._outputs_ready = asyncio.Event()
+        if self.output_queue:
+            self._outputs_ready.set()
+
+        loop = asyncio.get_running_loop()
+        loop.add_signal_handler(signal.SIGINT, self.stop_event.set)
+
+        coroutines = [self.readInput(stream) for stream in self.input_handlers]
+        coroutines += [
+            self.flushOutputsWhenReady(),
+            self.updateParametersForever(),
+            self.workForever()
+        ]
+        coroutines += [coroutine_function() for coroutine_function in self.tasks]
+        tasks = [asyncio.ensure_future(c) for c in coroutines]
+
+        # stop when SIGINT is received or when any task fails
+        stop_task = asyncio.ensure_future(self.stop_event.wait())
+        pending = set(tasks + [stop_task])
+        failed = None
+        while failed is None and not self.stop_event.is_set():
+            done, pending = await asyncio.wait(
+                pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                if task is not stop_task and task.exception() is not None:
+                    failed = task
+
+        for task in pending:
+            task.cancel()
+        await asyncio.gather(*pending, return_exceptions=True)
+
+        if failed is None:
+            logging.info('SIGINT received, Exiting')
+        try:
+            await _maybe_await(self.cleanup())
+            await self.flushOutputs()
+        finally:
+            await self.ar.close()
+            self.r.close()
+
+        if failed is not None:
+            failed.result()  # re-raise the exception of the failed task
@@ -7,7 +7,6 @@ import coloredlogs
 import json
 import logging
 import os
-import psutil
 import redis
 import signal
 import subprocess
@@ -17,8 +16,14 @@ import traceback
 
 from threading import Event
 
+from .clock import ClockSyncResponder
 from .derivative import RunDerivative
 from .exceptions import CommandError, DerivativeError, GraphError, NodeError
+from .host import (build_host_args, request_hosted_stops,
+                   wait_hosted_stops)
+from .process import (STOP_TIMEOUT, get_state_ids, report_shutdown,
+                      report_startup, start_processes, stop_processes,
+                      wait_until_ready)
 from .redis import RedisLoggingHandler
 
 DEFAULT_REDIS_IP = '127.0.0.1'
@@ -42,7 +47,8 @@ class Booter():
                  machine,
                  host=DEFAULT_REDIS_IP,
                  port=DEFAULT_REDIS_PORT,
-                 log_level=logging.INFO) -> None:
+                 log_level=logging.INFO,
+                 startup_timeout=10) -> None:
         """
         Booter starts and stops nodes according to commands received from
         the Supervisor via Redis
@@ -59,10 +65,14 @@ class Booter():
             Redis port, by default DEFAULT_REDIS_PORT
         log_level : int, optional
             Logging level, by default logging.INFO
+        startup_timeout : float, optional
+            Time to wait for nodes to be initialized when starting a graph,
+            in seconds, by default 10
         """
         self.host = host
         self.port = port
         self.machine = machine
+        self.startup_timeout = startup_timeout
         # make a logger
         self.logger = logging.getLogger(f'booter-{self.machine}')
         coloredlogs.install(level=log_level, logger=self.logger)
@@ -86,6 +96,8 @@ class Booter():
         # get ping-related streams
         self.booter_ping_stream = 'booter_ping'
         self.booter_ping_request_stream = 'booter_ping_request'
+        # answer clock-offset requests from Supervisor in the background
+        self.clock_sync_responder = ClockSyncResponder(self.r, self.machine)
 
 
     @property
@@ -183,11 +195,25 @@ class Booter():
         Start the nodes in the graph that are assigned to this machine
         """
         if self.model:
+            start_ns = time.monotonic_ns()
+            local_nodes = [
+                node for node, cfg in self.model['nodes'].items()
+                if cfg.get('machine') == self.machine
+            ]
+            # only states posted after this point show that a node is ready
+            state_ids = get_state_ids(self.r, local_nodes)
+            host_groups = {}
+            commands = {}
             for node, cfg in self.model['nodes'].items():
                 # specify defaults
                 cfg.setdefault('root', True)
                 # run the node if it is assigned to this machine
                 if 'machine' in cfg and cfg['machine'] == self.machine:
+                    if cfg.get('host_group'):
+                        # started below, in one process per host group
+                        host_groups.setdefault(cfg['host_group'],
+                                               {})[node] = cfg
+                        continue
                     node_stream_name = cfg["nickname"]
                     # build CLI command
                     args = []
@@ -213,9 +239,47 @@ class Booter():
                         if affinity:  # if affinity is not None or empty
                             taskset_args = ['taskset', '-c', str(affinity)]
                             args = taskset_args + args
-                    p = subprocess.Popen(args)
-                    self.logger.debug(' '.join(args))
-                    self.child_nodes[node] = p
+                    commands[node] = args
+
+            for group, node_cfgs in host_groups.items():
+                # host groups are keyed by tuples so they cannot clash with
+                # node nicknames
+                commands[(group, )] = build_host_args(
+                    group, node_cfgs, self.host, self.port,
+                    base_dir=self.brand_base_dir)
+
+            # launch all processes at once
+            procs, errors = start_processes(commands)
+            for name, p in procs.items():
+                self.logger.debug(' '.join(commands[name]))
+                if isinstance(name, tuple):
+                    group, = name
+                    p.host_group = group
+                    for node in host_groups[group]:
+                        self.child_nodes[node] = p
+                else:
+                    self.child_nodes[name] = p
+            if errors:
+                name, exc = next(iter(errors.items()))
+                name = name[0] if isinstance(name, tuple) else name
+                raise NodeError(f"Could not start {name}: {exc!r}",
+                                self.model['graph_name'], name) from exc
+
+            ready, exited, pending = wait_until_ready(
+                self.r,
+                state_ids,
+                procs=self.child_nodes,
+                timeout=self.startup_timeout)
+            report_startup(self.r, self.machine, start_ns, ready, exited,
+                           pending, procs=self.child_nodes, log=self.logger)
+            if exited:
+                node, returncode = next(iter(exited.items()))
+                raise NodeError(
+                    f"{node} exited with code {returncode} before it was"
+                    " initialized", self.model['graph_name'], node)
+            if pending:
+                self.logger.warning(f"Nodes not initialized after "
+                                    f"{self.startup_timeout} s: {pending}")
 
             self.r.xadd("booter_status", {"machine": self.machine, "status": f"{self.model['graph_name']} graph started successfully"})
         else:
@@ -238,60 +302,36 @@ class Booter():
         Kills child processes
         '''
 
-        def kill_proc_tree(pid, sig=signal.SIGTERM, include_parent=True):
-            """
-            Kill a process tree (including grandchildren) with signal "sig"
-            """
-            parent = psutil.Process(pid)
-            children = parent.children(recursive=False)
-            if include_parent:
-                children.append(parent)
-            for p in children:
-                try:
-                    p.send_signal(sig)
-                except psutil.NoSuchProcess:
-                    pass
-
         if node_list is None:
             node_list = list(self.child_nodes.keys())
 
-        for node, proc in self.child_nodes.items():
-            if node in node_list:
-                try:
-                    # check if process exists
-                    os.kill(proc.pid, 0)
-                except OSError:
-                    self.logger.warning(f"'{node}' (pid: {proc.pid})"
-                                        " isn't running and may have crashed")
-                    self.child_nodes[node] = None
-                    node_list.remove(node)
-                else:
-                    # process is running
-                    # send SIGINT
-                    kill_proc_tree(proc.pid, signal.SIGINT)
-                    try:
-                        # check if it terminated
-                        proc.communicate(timeout=15)
-                    except subprocess.TimeoutExpired:
-                        self.logger.warning(f"Could not stop '{node}' "
-                                                f"(pid: {proc.pid}) using SIGINT")
-                        # if not, send SIGKILL
-                        kill_proc_tree(proc.pid, signal.SIGKILL)
-                        try:
-                            # check if it terminated
-                            proc.communicate(timeout=15)
-                        except subprocess.TimeoutExpired:
-                            pass  # delay error message until after the loop
-                        else:
-                            self.logger.info(f"Killed '{node}' "
-                                            f"(pid: {proc.pid}) using SIGKILL")
-                            self.child_nodes[node] = None
-                            node_list.remove(node)
-                    else:
-                        self.logger.info(f"Stopped '{node}' "
-                                             f"(pid: {proc.pid}) using SIGINT")
-                        self.child_nodes[node] = None
-                        node_list.remove(node)
+        # stop co-hosted nodes through their host if it has other nodes,
+        # and signal all other nodes at once, with a single deadline
+        deadline = time.monotonic() + STOP_TIMEOUT
+        state_ids, node_list = request_hosted_stops(self.r, self.child_nodes,
+                                                    node_list)
+        report = stop_processes(
+            {
+                node: self.child_nodes[node]
+                for node in node_list if node in self.child_nodes
+            },
+            timeout=deadline - time.monotonic(),
+            log=self.logger)
+        for node, info in report.items():
+            if info['status'] != 'running':
+                self.child_nodes[node] = None
+                node_list.remove(node)
+        report_shutdown(self.r, self.machine, report)
+
+        stopped, failed = wait_hosted_stops(self.r, state_ids, deadline)
+        for node in stopped:
+            self.logger.info(f"Stopped '{node}' through its host process")
+            self.child_nodes[node] = None
+        for node in failed:
+            self.logger.warning(f"'{node}' was not stopped by its host "
+                                "process, which keeps running other nodes")
+        # hosted nodes that could not be stopped are still running
+        node_list += failed
         # remove killed processes from self.children
         self.child_nodes = {
             n: p
@@ -529,6 +569,7 @@ class Booter():
         and log any exceptions encountered when executing commands.
         """
         entry_id = '$'
+        self.clock_sync_responder.start()
         self.logger.info('Listening for commands')
         self.r.xadd("booter_status", {"machine": self.machine, "status": "Listening for commands"})
         while True:
@@ -598,6 +639,8 @@ class Booter():
         except Exception as exc:
             self.logger.warning(f"Could not kill derivatives. Exiting anyway. {repr(exc)}")
 
+        self.clock_sync_responder.stop_event.set()
+
         # attempt to post an exit message to Redis
         try:
             self.r.xadd("booter_status", {"machine": self.machine, "status": "SIGINT received, Exiting"})
@@ -640,5 +683,10 @@ class Booter():
                         default=logging.INFO,
                         type=lambda x: getattr(logging, x),
                         help="Configure the logging level")
+        ap.add_argument("--startup-timeout",
+                        type=float,
+                        default=10,
+                        help="seconds to wait for nodes to be initialized"
+                        " when starting a graph (default: 10)")
         args = ap.parse_args()
         return args
@@ -0,0 +1,319 @@
+"""
+Cross-machine clock-offset estimation
+
+The monotonic clocks of the machines in a BRAND system are unrelated, so
+the monotonic time keys written by nodes on different machines cannot be
+compared directly. ClockSync runs in the supervisor and repeatedly
+exchanges timestamps with the ClockSyncResponder of every booter. From
+each burst of exchanges it keeps the one with the smallest round-trip
+time (the least delayed by queuing and scheduling), and fits the offset
+and drift of each booter's clock relative to the supervisor's over a
+sliding window of those samples.
+
+The model of every machine is published to the clock_offsets stream as
+JSON, keyed by machine name:
+
+    offset_ns : booter clock minus supervisor clock at ref_ns
+    drift_ppm : rate at which the offset changes, in parts per million
+    ref_ns    : supervisor monotonic time at which offset_ns was estimated
+    rtt_ns    : smallest round-trip time in the window, which bounds the
+                error of offset_ns to about rtt_ns / 2
+    n_samples : number of samples the model was fitted to
+
+so that booter_ns ~= supervisor_ns + offset_ns
+                     + drift_ppm * 1e-6 * (supervisor_ns - ref_ns).
+"""
+import collections
+import json
+import logging
+import time
+
+from threading import Event, Thread
+
+import numpy as np
+import redis
+
+logger = logging.getLogger(__name__)
+
+CLOCK_SYNC_REQUEST_STREAM = 'clock_sync_request'
+CLOCK_SYNC_REPLY_STREAM = 'clock_sync_reply'
+CLOCK_OFFSETS_STREAM = 'clock_offsets'
+STREAM_MAXLEN = 1000
+
+
+def fit_clock_model(samples, rtt_factor=2):
+    """
+    Fit the offset and drift of a clock from (time_ns, offset_ns, rtt_ns)
+    samples, ignoring samples whose round-trip time is more than rtt_factor
+    times the smallest one
+
+    Returns
+    -------
+    dict
+        Clock model, as described in the module docstring
+    """
+    t, offset, rtt = np.array(samples, dtype=np.int64).T
+    min_rtt = rtt.min()
+    keep = rtt <= rtt_factor * min_rtt
+    t, offset = t[keep], offset[keep]
+    ref_ns = int(t[-1])
+    if len(t) > 2 and t[-1] > t[0]:
+        slope, intercept = np.polyfit((t - ref_ns).astype(np.float64),
+                                      offset.astype(np.float64), 1)
+        offset_ns, drift_ppm = int(round(intercept)), slope * 1e6
+    else:
+        offset_ns, drift_ppm = int(offset[-1]), 0.0
+    return {
+        'offset_ns': offset_ns,
+        'drift_ppm': float(drift_ppm),
+        'ref_ns': ref_ns,
+        'rtt_ns': int(min_rtt),
+        'n_samples': int(keep.sum()),
+    }
+
+
+def get_clock_offsets(r, stream=CLOCK_OFFSETS_STREAM):
+    """
+    Get the latest clock model of each machine
+
+    Parameters
+    ----------
+    r : redis.Redis
+        Redis connection
+    stream : str, optional
+        Stream the models are published to, by default 'clock_offsets'
+
+    Returns
+    -------
+    dict
+        Clock model of each machine, keyed by machine name. Empty if no
+        model has been published.
+    """
+    entries = r.xrevrange(stream, count=1)
+    if not entries:
+        return {}
+    return {
+        machine.decode(): json.loads(model)
+        for machine, model in entries[0][1].items()
+    }
+
+
+def to_reference_ns(model, t_ns):
+    """
+    Convert monotonic times of a machine to the supervisor's monotonic clock
+
+    Parameters
+    ----------
+    model : dict
+        Clock model of the machine, from get_clock_offsets()
+    t_ns : int or array_like
+        Monotonic times (in nanoseconds) on that machine, e.g. time keys
+        decoded from its streams
+
+    Returns
+    -------
+    int or numpy.ndarray
+        Corresponding supervisor monotonic times
+    """
+    drift = model['drift_ppm'] * 1e-6
+    t = np.asarray(t_ns, dtype=np.int64)
+    dt = t - model['offset_ns'] - model['ref_ns']
+    correction = np.rint(dt * (drift / (1 + drift))).astype(np.int64)
+    out = model['ref_ns'] + dt - correction
+    return out if out.ndim else int(out)
+
+
+def from_reference_ns(model, t_ns):
+    """
+    Convert supervisor monotonic times to the monotonic clock of a machine
+    (the inverse of to_reference_ns())
+    """
+    drift = model['drift_ppm'] * 1e-6
+    t = np.asarray(t_ns, dtype=np.int64)
+    dt = t - model['ref_ns']
+    out = t + model['offset_ns'] + np.rint(dt * drift).astype(np.int64)
+    return out if out.ndim else int(out)
+
+
+class ClockSync(Thread):
+    """
+    Background thread, run by the supervisor, that estimates the clock
+    offset of every booter and publishes the models to the clock_offsets
+    stream
+
+    Parameters
+    ----------
+    r : redis.Redis
+        Redis connection
+    machines : callable
+        Returns the names of the booter machines to synchronize with
+    reference : str, optional
+        Name of the supervisor's machine, published with a zero offset,
+        by default 'supervisor'
+    interval : float, optional
+        Time between bursts of exchanges, in seconds, by default 1
+    burst : int, optional
+        Number of exchanges per burst, by default 8
+    window : int, optional
+        Number of bursts the model is fitted over, by default 60
+    timeout_ms : int, optional
+        Time to wait for each reply, by default 100
+    stop_event : threading.Event, optional
+        Event that stops the thread when set
+    """
+
+    def __init__(self,
+                 r,
+                 machines,
+                 reference='supervisor',
+                 interval=1,
+                 burst=8,
+                 window=60,
+                 timeout_ms=100,
+                 stop_event=None):
+        super().__init__(daemon=True, name='clock_sync')
+        self.r = r
+        self.machines = machines
+        self.reference = reference
+        self.interval = interval
+        self.burst = burst
+        self.window = window
+        self.timeout_ms = timeout_ms
+        self.stop_event = stop_event if stop_event is not None else Event()
+
+        self.samples = {}
+        self.models = {}
+        self.seq = 0
+        self.reply_id = None
+
+    def exchange(self, machine):
+        """
+        Exchange timestamps with one booter
+
+        Returns
+        -------
+        tuple or None
+            (time_ns, offset_ns, rtt_ns) sample, where time_ns is the
+            supervisor time halfway through the exchange, or None if the
+            booter did not reply in time
+        """
+        self.seq += 1
+        seq = str(self.seq).encode()
+        t1 = time.monotonic_ns()
+        self.r.xadd(CLOCK_SYNC_REQUEST_STREAM,
+                    {'machine': machine, 'seq': seq},
+                    maxlen=STREAM_MAXLEN,
+                    approximate=True)
+        deadline = t1 + self.timeout_ms * 1_000_000
+        while True:
+            block_ms = (deadline - time.monotonic_ns()) // 1_000_000
+            if block_ms <= 0:
+                return None
+            replies = self.r.xread({CLOCK_SYNC_REPLY_STREAM: self.reply_id},
+                                   block=block_ms)
+            t4 = time.monotonic_ns()
+            if not replies:
+                return None
+            for entry_id, entry_data in replies[0][1]:
+                self.reply_id = entry_id
+                if (entry_data[b'machine'].decode() == machine
+                        and entry_data[b'seq'] == seq):
+                    t2 = int(entry_data[b'timestamp_ns'])
+                    midpoint = (t1 + t4) // 2
+                    return midpoint, t2 - midpoint, t4 - t1
+
+    def update(self, machine):
+        """
+        Run one burst of exchanges with a booter and update its model
+        """
+        best = None
+        for _ in range(self.burst):
+            sample = self.exchange(machine)
+            if sample is None:
+                break
+            if best is None or sample[2] < best[2]:
+                best = sample
+        if best is None:
+            return
+        if machine not in self.samples:
+            self.samples[machine] = collections.deque(maxlen=self.window)
+        self.samples[machine].append(best)
+        self.models[machine] = fit_clock_model(self.samples[machine])
+
+    def publish(self):
+        models = {
+            self.reference: {
+                'offset_ns': 0,
+                'drift_ppm': 0.0,
+                'ref_ns': time.monotonic_ns(),
+                'rtt_ns': 0,
+                'n_samples': 0
+            },
+            **self.models
+        }
+        self.r.xadd(CLOCK_OFFSETS_STREAM,
+                    {m: json.dumps(model)
+                     for m, model in models.items()},
+                    maxlen=STREAM_MAXLEN,
+                    approximate=True)
+
+    def run(self):
+        while not self.stop_event.is_set():
+            try:
+                if self.reply_id is None:
+                    last = self.r.xrevrange(CLOCK_SYNC_REPLY_STREAM, count=1)
+                    self.reply_id = last[0][0] if last else '0-0'
+                for machine in list(self.machines()):
+                    if machine != self.reference:
+                        self.update(machine)
+                self.publish()
+            except redis.exceptions.ConnectionError as exc:
+                logger.warning(f'Clock sync could not reach Redis: {exc!r}')
+            except Exception as exc:
+                logger.exception(f'Clock sync failed: {exc!r}')
+            self.stop_event.wait(self.interval)
+
+
+class ClockSyncResponder(Thread):
+    """
+    Background thread, run by each booter, that answers the timestamp
+    requests of ClockSync with this machine's monotonic time
+
+    Parameters
+    ----------
+    r : redis.Redis
+        Redis connection
+    machine : str
+        Name of this booter's machine
+    stop_event : threading.Event, optional
+        Event that stops the thread when set
+    """
+
+    def __init__(self, r, machine, stop_event=None):
+        super().__init__(daemon=True, name='clock_sync_responder')
+        self.r = r
+        self.machine = machine.encode()
+        self.stop_event = stop_event if stop_event is not None else Event()
+
+    def run(self):
+        request_id = '$'
+        while not self.stop_event.is_set():
+            try:
+                requests = self.r.xread({CLOCK_SYNC_REQUEST_STREAM: request_id},
+                                        block=1000)
+            except redis.exceptions.ConnectionError as exc:
+                logger.warning(f'Clock sync could not reach Redis: {exc!r}')
+                self.stop_event.wait(1)
+                continue
+            if not requests:
+                continue
+            for entry_id, entry_data in requests[0][1]:
+                request_id = entry_id
+                if entry_data[b'machine'] == self.machine:
+                    timestamp_ns = time.monotonic_ns()
+                    self.r.xadd(CLOCK_SYNC_REPLY_STREAM,
+                                {'machine': self.machine,
+                                 'seq': entry_data[b'seq'],
+                                 'timestamp_ns': timestamp_ns},
+                                maxlen=STREAM_MAXLEN,
+                                approximate=True)
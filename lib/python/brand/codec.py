@@ -0,0 +1,308 @@
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+from .tools import get_node_io
+
+# sample_type names used in the RedisStreams section of graph YAML files
+SAMPLE_TYPES = {
+    'char': np.int8,
+    'int16': np.int16,
+    'short': np.int16,
+    'uint16': np.uint16,
+    'uInt16': np.uint16,
+    'int32': np.int32,
+    'int': np.int32,
+    'Int': np.int32,
+    'uInt32': np.uint32,
+    'uInt': np.uint32,
+    'uint32': np.uint32,
+    'int64': np.int64,
+    'uint64': np.uint64,
+    'uInt64': np.uint64,
+    'float32': np.float32,
+    'float': np.float32,
+    'float64': np.float64,
+    'double': np.float64,
+}
+
+
+def get_dtype(sample_type):
+    """
+    Get the numpy dtype corresponding to a sample_type
+
+    Parameters
+    ----------
+    sample_type : str
+        sample_type of a stream, as written in the graph YAML
+
+    Returns
+    -------
+    numpy.dtype
+        Data type of each sample
+    """
+    if sample_type in SAMPLE_TYPES:
+        return np.dtype(SAMPLE_TYPES[sample_type])
+    try:
+        return np.dtype(sample_type)
+    except TypeError as exc:
+        raise ValueError(f'Invalid sample_type: {sample_type}') from exc
+
+
+class StreamCodec():
+    """
+    Encode and decode one field of a stream's entries as numpy arrays of
+    shape (chan_per_stream, samp_per_stream)
+
+    Decoded arrays are read-only views of the bytes returned by redis-py,
+    and encoded arrays are passed to redis-py as memoryviews, so no
+    intermediate copies are made in either direction.
+    """
+
+    def __init__(self,
+                 sample_type,
+                 chan_per_stream=1,
+                 samp_per_stream=1,
+                 field=b'samples'):
+        """
+        Parameters
+        ----------
+        sample_type : str
+            sample_type of the stream, e.g. 'int16' or 'float32'
+        chan_per_stream : int, optional
+            Number of channels in each entry, by default 1
+        samp_per_stream : int, optional
+            Number of samples per channel in each entry, by default 1
+        field : bytes, optional
+            Key of the entry that holds the samples, by default b'samples'
+        """
+        self.dtype = get_dtype(sample_type)
+        self.shape = (int(chan_per_stream), int(samp_per_stream))
+        self.size = self.shape[0] * self.shape[1]
+        self.nbytes = self.size * self.dtype.itemsize
+        self.field = field.encode() if isinstance(field, str) else field
+
+    @classmethod
+    def from_stream_info(cls, stream_info, field=b'samples'):
+        """
+        Build a codec from a stream declaration in the RedisStreams section
+        of a graph YAML
+
+        Parameters
+        ----------
+        stream_info : dict
+            Stream declaration containing sample_type, chan_per_stream and
+            samp_per_stream
+        field : bytes, optional
+            Key of the entry that holds the samples, by default b'samples'
+        """
+        return cls(stream_info['sample_type'],
+                   stream_info.get('chan_per_stream', 1),
+                   stream_info.get('samp_per_stream', 1),
+                   field=field)
+
+    def decode(self, entry_data):
+        """
+        Decode the samples of one entry
+
+        Parameters
+        ----------
+        entry_data : dict
+            Entry data as returned by redis-py
+
+        Returns
+        -------
+        numpy.ndarray
+            Read-only view of the samples with shape (chans, samps)
+        """
+        return np.frombuffer(entry_data[self.field],
+                             dtype=self.dtype,
+                             count=self.size).reshape(self.shape)
+
+    def decode_entries(self, entries, out=None):
+        """
+        Decode a batch of entries into a single array
+
+        Parameters
+        ----------
+        entries : list
+            List of (entry_id, entry_data) tuples, as in the replies to
+            XREAD and XRANGE
+        out : numpy.ndarray, optional
+            Preallocated array of shape (N, chans, samps) in which to store
+            the samples, where N >= len(entries)
+
+        Returns
+        -------
+        numpy.ndarray
+            Array of shape (len(entries), chans, samps)
+        """
+        n_entries = len(entries)
+        if out is None:
+            out = np.empty((n_entries, ) + self.shape, dtype=self.dtype)
+        elif out.shape[0] < n_entries or out.shape[1:] != self.shape:
+            raise ValueError(
+                f'out has shape {out.shape}, but at least '
+                f'{(n_entries, ) + self.shape} is needed')
+        else:
+            out = out[:n_entries]
+
+        for i, (_, entry_data) in enumerate(entries):
+            out[i] = self.decode(entry_data)
+        return out
+
+    def encode(self, samples):
+        """
+        Encode samples for an XADD without copying them when they already
+        have the stream's dtype and are contiguous
+
+        Parameters
+        ----------
+        samples : array-like
+            Samples with chans * samps elements
+
+        Returns
+        -------
+        memoryview
+            Buffer that can be passed as a field value to redis-py
+        """
+        samples = np.ascontiguousarray(samples, dtype=self.dtype)
+        if samples.size != self.size:
+            raise ValueError(f'Expected {self.size} samples, got {samples.size}')
+        return memoryview(samples).cast('B')
+
+
+def get_stream_codecs(yaml_path, node, field=b'samples'):
+    """
+    Build codecs for all input and output streams of a node, as defined by
+    the graph settings yaml file
+
+    Parameters
+    ----------
+    yaml_path : str
+        path of the YAML graph settings file
+    node : str
+        name of the node we're inspecting
+    field : bytes, optional
+        Key of the entries that holds the samples, by default b'samples'
+
+    Returns
+    -------
+    dict
+        a dictionary with two nested dictionaries: one named
+        'redis_inputs' and one named 'redis_outputs', mapping stream names
+        to StreamCodec instances
+    """
+    io = get_node_io(yaml_path, node)
+    return {
+        direction: {
+            stream: StreamCodec.from_stream_info(info, field=field)
+            for stream, info in streams.items()
+        }
+        for direction, streams in io.items()
+    }
+
+
+def _id_str(entry_id):
+    return entry_id.decode() if isinstance(entry_id, bytes) else str(entry_id)
+
+
+def read_stream(r, stream, codecs, start='-', end='+', chunk_size=10000):
+    """
+    Read a range of a stream into numpy arrays, paging through it with
+    XRANGE ... COUNT chunk_size so that only one chunk of entries is held
+    as Python objects at a time
+
+    The arrays are allocated for the length of the whole stream and then
+    truncated, but since memory is only committed when it is written, only
+    the entries in the range take up memory.
+
+    Parameters
+    ----------
+    r : redis.Redis
+        instance of the redis.Redis interface
+    stream : str or bytes
+        Name of the stream
+    codecs : StreamCodec or list of StreamCodec
+        Codecs of the fields to decode
+    start : str, bytes or int, optional
+        ID (or time in milliseconds) of the first entry, by default '-'
+    end : str, bytes or int, optional
+        ID (or time in milliseconds) of the last entry, by default '+'
+    chunk_size : int, optional
+        Number of entries read with each XRANGE, by default 10000
+
+    Returns
+    -------
+    entry_ids : numpy.ndarray
+        uint64 array of shape (N, 2) with the millisecond and sequence
+        parts of each entry ID
+    data : dict
+        Array of shape (N, chans, samps) for each codec, keyed by field
+    """
+    if isinstance(codecs, StreamCodec):
+        codecs = [codecs]
+
+    n_max = r.xlen(stream)
+    entry_ids = np.empty((n_max, 2), dtype=np.uint64)
+    data = {
+        codec.field: np.empty((n_max, ) + codec.shape, dtype=codec.dtype)
+        for codec in codecs
+    }
+
+    n_entries = 0
+    start = _id_str(start)
+    while n_entries < n_max:
+        entries = r.xrange(stream, min=start, max=end, count=chunk_size)
+        if not entries:
+            break
+        # entries may have been added since XLEN was called
+        entries = entries[:n_max - n_entries]
+        n_chunk = len(entries)
+        ids = [entry_id for entry_id, _ in entries]
+        entry_ids[n_entries:n_entries + n_chunk] = np.array(
+            b'-'.join(ids).split(b'-')).astype(np.uint64).reshape(-1, 2)
+        for codec in codecs:
+            buffer = b''.join(entry_data[codec.field][:codec.nbytes]
+                              for _, entry_data in entries)
+            data[codec.field][n_entries:n_entries + n_chunk] = np.frombuffer(
+                buffer, dtype=codec.dtype).reshape((n_chunk, ) + codec.shape)
+        n_entries += n_chunk
+        start = '(' + _id_str(ids[-1])
+
+    entry_ids = entry_ids[:n_entries]
+    data = {field: arr[:n_entries] for field, arr in data.items()}
+    return entry_ids, data
+
+
+def read_streams(r, streams, start='-', end='+', chunk_size=10000,
+                 max_workers=None):
+    """
+    Read the same range of several streams into numpy arrays, reading the
+    streams concurrently over the connection pool of r
+
+    Parameters
+    ----------
+    r : redis.Redis
+        instance of the redis.Redis interface
+    streams : dict
+        Codecs of the fields to decode, keyed by stream name
+    start, end, chunk_size
+        As in read_stream()
+    max_workers : int, optional
+        Maximum number of streams read at the same time, by default the
+        number of streams
+
+    Returns
+    -------
+    dict
+        (entry_ids, data) tuple for each stream, as returned by
+        read_stream(), keyed by stream name
+    """
+    with ThreadPoolExecutor(max_workers=max_workers or len(streams)) as pool:
+        futures = {
+            stream: pool.submit(read_stream, r, stream, codecs, start, end,
+                                chunk_size)
+            for stream, codecs in streams.items()
+        }
+        return {stream: future.result() for stream, future in futures.items()}
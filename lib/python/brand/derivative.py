@@ -4,10 +4,7 @@
 
 import coloredlogs
 import logging
-import os
-import psutil
 import redis
-import signal
 import subprocess
 import sys
 import time
@@ -16,6 +13,7 @@ from redis import Redis
 
 from threading import Thread
 
+from .process import stop_processes
 from .redis import RedisLoggingHandler
 
 # EXAMPLE DERIVATIVE YAML CONFIGS, BOTH WORK. 
@@ -447,65 +445,14 @@ class RunDerivative(Thread):
 
         self.child = proc
 
-    def _kill_proc_tree(self, sig=signal.SIGTERM, include_parent=True):
-        """
-        Kill a process tree (including grandchildren) with signal "sig"
-        """
-        parent = psutil.Process(self.child.pid)
-        children = parent.children(recursive=False)
-        if include_parent:
-            children.append(parent)
-        for p in children:
-            try:
-                p.send_signal(sig)
-            except psutil.NoSuchProcess:
-                pass
-
     def kill_child_processes(self):
         '''
         Kills child processes
         '''
-
-        try:
-            # check if process exists
-            os.kill(self.child.pid, 0)
-        except OSError:
-            # process doesn't exist, may have crashed
-            self.logger.warning(f"'{self.nickname}' (pid: {self.child.pid})"
-                            " isn't running and may have crashed")
-            self.send_derivative_exit_status(self.nickname, self.child, "Early termination.")
+        report = stop_processes({self.nickname: self.child}, log=self.logger)
+        if report[self.nickname]['status'] != 'running':
+            self.send_derivative_exit_status("Early termination.")
             self.child = None
-        else:
-            # process is running
-            # send SIGINT
-            self._kill_proc_tree(signal.SIGINT)
-            try:
-                # check if it terminated
-                self.child.communicate(timeout=15)
-            except subprocess.TimeoutExpired:
-                # SIGINT failed, so send SIGKILL
-                self.logger.warning(f"Could not stop '{self.nickname}' "
-                               f"(pid: {self.child.pid}) using SIGINT")
-                self._kill_proc_tree(signal.SIGKILL)
-                try:
-                    # check if it terminated
-                    self.child.communicate(timeout=15)
-                except subprocess.TimeoutExpired:
-                    # keep the process in self.running_children to report 
-                    # the error later
-                    pass  # delay error message until after the loop
-                else:
-                    # process terminated via SIGKILL
-                    self.logger.info(f"Killed '{self.nickname}' "
-                                f"(pid: {self.child.pid}) using SIGKILL")
-                    self.send_derivative_exit_status("Early termination.")
-                    self.child = None
-            else:
-                # process terminated via SIGINT
-                self.logger.info(f"Stopped '{self.nickname}' "
-                            f"(pid: {self.child.pid}) using SIGINT")
-                self.send_derivative_exit_status("Early termination.")
-                self.child = None
 
         # raise an error if nodes are still running
         if self.child is not None:
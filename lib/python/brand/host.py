@@ -0,0 +1,518 @@
+"""
+Host several lightweight Python nodes in one interpreter
+
+Nodes that are given the same 'host_group' in the graph YAML and that run
+on the same machine are started by the supervisor (or booter) as a single
+NodeHost process instead of one process per node, e.g.
+
+    - name:         my_filter
+      nickname:     filter_a
+      module:       ../brand-modules/my-module
+      host_group:   ui_bridges
+
+Each node runs its own run() loop in a thread named after its nickname,
+with its own connection taken from a pool shared by the host. Hosted nodes
+are stopped by clearing their 'running' attribute, so their run() must
+return soon after it is cleared (as the run() and runPeriodic() loops of
+BRANDNode do). Nodes that are still running STOP_TIMEOUT seconds after the
+host is stopped are abandoned when the host process exits. Nodes keep
+their own nickname_state, nickname_parameters and log streams, and can be
+stopped individually by sending a 'stopNode' command to the host's
+<host_group>_host stream, which the supervisor and booter do when only
+some of a host's nodes are stopped.
+
+Streams that a co-hosted node declares in its 'local_outputs' are
+written by that node only, so entries written to them are also handed
+in-process to the co-hosted nodes that read them, which then do not need to
+read them back. The entries are still added to Redis for other consumers
+and for recording. Nodes with any other input read all of their inputs
+from Redis as usual, so that entries written outside the host are not
+missed.
+"""
+import argparse
+import importlib.util
+import inspect
+import logging
+import os
+import queue
+import signal
+import sys
+import threading
+import time
+
+from importlib.machinery import SourceFileLoader
+
+from redis import ConnectionPool, Redis
+from redis.connection import Encoder, UnixDomainSocketConnection
+
+from . import node as brand_node
+from .async_node import AsyncBRANDNode
+from .exceptions import NodeError
+from .node import BRANDNode
+
+DEFAULT_REDIS_IP = '127.0.0.1'
+DEFAULT_REDIS_PORT = 6379
+# seconds for hosted nodes to return from run() once the host is stopped,
+# less than the time the supervisor and booter wait before sending SIGKILL
+STOP_TIMEOUT = 10
+
+
+def get_node_source(binary):
+    """
+    Get the path to the Python source of a node from the path to its
+    binary, looking for <name>.py next to <name>.bin or in its src folder
+
+    Parameters
+    ----------
+    binary : str
+        Path to the node's binary
+
+    Returns
+    -------
+    filepath : str or None
+        Path to the node's Python source, or None if there is none
+    """
+    node_dir, filename = os.path.split(binary)
+    name = os.path.splitext(filename)[0]
+    for filepath in [
+            os.path.join(node_dir, f'{name}.py'),
+            os.path.join(node_dir, 'src', f'{name}.py')
+    ]:
+        if os.path.exists(filepath):
+            return filepath
+    return None
+
+
+def build_host_args(group, node_cfgs, host, port, socket=None, base_dir=None):
+    """
+    Build the command that starts a NodeHost for a group of nodes
+
+    Parameters
+    ----------
+    group : str
+        Name of the host group
+    node_cfgs : dict
+        Configuration of each node in the group, keyed by nickname, which
+        must include the path to the node's 'binary'. The 'root',
+        'run_priority' and 'cpu_affinity' settings of the first node that
+        specifies them apply to the whole host. Streams listed in a node's
+        'local_outputs' are declared to be written by that node only.
+    host : str
+        Redis IP address
+    port : int
+        Redis port
+    socket : str, optional
+        Redis unix socket
+    base_dir : str, optional
+        BRAND base directory, by default the current working directory
+
+    Returns
+    -------
+    args : list
+        CLI command
+    """
+    if base_dir is None:
+        base_dir = os.getcwd()
+
+    def group_setting(key):
+        for cfg in node_cfgs.values():
+            if cfg.get(key):
+                return cfg[key]
+        return None
+
+    args = []
+    if (not all(cfg.get('root', True) for cfg in node_cfgs.values())
+            and 'SUDO_USER' in os.environ):
+        # run nodes as the current user, not root
+        args += [
+            'sudo', '-u', os.environ['SUDO_USER'], '-E', 'env',
+            f"PATH={os.environ['PATH']}"
+        ]
+    args += [
+        sys.executable,
+        os.path.join(base_dir, 'supervisor', 'node_host.py'), '-g', group,
+        '-i', host, '-p', str(port)
+    ]
+    if socket:
+        args += ['-s', socket]
+    writers = {}
+    for nickname, cfg in node_cfgs.items():
+        source = get_node_source(cfg['binary'])
+        if source is None:
+            raise NodeError(
+                f'Python source for co-hosted node {nickname} was not found'
+                f' next to {cfg["binary"]}', node=nickname)
+        args += ['--node', f'{nickname}={source}']
+        for stream in cfg.get('local_outputs') or []:
+            if stream in writers:
+                raise NodeError(
+                    f'{nickname} and {writers[stream]} both declare that '
+                    f'they are the only writer of {stream}', node=nickname)
+            writers[stream] = nickname
+            args += ['--local-stream', stream]
+    # root permissions are needed to set real-time priority
+    priority = group_setting('run_priority')
+    if priority:
+        args = ['chrt', '-f', str(int(priority))] + args
+    affinity = group_setting('cpu_affinity')
+    if affinity:
+        args = ['taskset', '-c', str(affinity)] + args
+    return args
+
+
+def request_hosted_stops(r, child_nodes, node_list):
+    """
+    Ask host processes to stop co-hosted nodes when the host has to keep
+    running other nodes. The processes of the other nodes in node_list
+    (including hosts whose nodes are all being stopped) must be stopped
+    with a signal as usual, while the hosts stop the requested nodes.
+
+    Parameters
+    ----------
+    r : redis.Redis
+        Redis connection
+    child_nodes : dict
+        Running processes, keyed by node nickname. Hosted nodes share the
+        process of their host, which has a 'host_group' attribute.
+    node_list : list
+        Nicknames of the nodes to stop
+
+    Returns
+    -------
+    state_ids : dict
+        Latest ID of the <nickname>_state stream of each node that was
+        requested to stop, to pass to wait_hosted_stops()
+    remaining : list
+        Nicknames of the nodes that have to be stopped with a signal
+    """
+    remaining = []
+    by_host = {}
+    for node in node_list:
+        proc = child_nodes.get(node)
+        if getattr(proc, 'host_group', None) is None:
+            remaining.append(node)
+        else:
+            by_host.setdefault(proc, []).append(node)
+
+    requested = []
+    for proc, nodes in by_host.items():
+        cohosted = [n for n, p in child_nodes.items() if p is proc]
+        if set(cohosted) <= set(nodes) or proc.poll() is not None:
+            remaining += nodes
+        else:
+            requested += [(proc.host_group, node) for node in nodes]
+    if not requested:
+        return {}, remaining
+
+    # get the latest state of each node, then ask their hosts to stop them
+    p = r.pipeline()
+    for _, node in requested:
+        p.xrevrange(f'{node}_state', '+', '-', count=1)
+    state_ids = {}
+    for (_, node), last_entry in zip(requested, p.execute()):
+        state_ids[f'{node}_state'] = last_entry[0][0] if last_entry else '0-0'
+    p = r.pipeline()
+    for group, node in requested:
+        p.xadd(f'{group}_host', {'command': 'stopNode', 'nickname': node})
+    p.execute()
+    return state_ids, remaining
+
+
+def wait_hosted_stops(r, state_ids, deadline):
+    """
+    Wait for host processes to report that the nodes requested by
+    request_hosted_stops() are done. Nodes that their host did not stop in
+    time must not be signalled, since that would stop the rest of the host
+    too.
+
+    Parameters
+    ----------
+    r : redis.Redis
+        Redis connection
+    state_ids : dict
+        Result of request_hosted_stops()
+    deadline : float
+        time.monotonic() time until which to wait
+
+    Returns
+    -------
+    stopped : list
+        Nicknames of the nodes that were stopped by their host
+    failed : list
+        Nicknames of the nodes that their host did not stop in time
+    """
+    state_ids = dict(state_ids)
+    stopped = []
+    while state_ids:
+        # also check once for states posted before the deadline passed
+        block_ms = max(int((deadline - time.monotonic()) * 1000), 0)
+        replies = r.xread(state_ids, block=min(block_ms, 100) or None)
+        for stream, entries in replies:
+            stream = stream.decode()
+            state_ids[stream] = entries[-1][0]
+            if any(entry[b'status'] == b'done' for _, entry in entries):
+                del state_ids[stream]
+                stopped.append(stream[:-len('_state')])
+        if not block_ms:
+            break
+    failed = [stream[:-len('_state')] for stream in state_ids]
+    return stopped, failed
+
+
+def load_node_class(nickname, filepath):
+    """
+    Import a node's Python source and get the BRANDNode subclass it defines
+
+    Parameters
+    ----------
+    nickname : str
+        Nickname of the node, used to name its module
+    filepath : str
+        Path to the node's Python source
+
+    Returns
+    -------
+    node_class : type
+        BRANDNode subclass defined in the file
+    """
+    module_name = f'brand_hosted_{nickname}'
+    loader = SourceFileLoader(module_name, filepath)
+    spec = importlib.util.spec_from_loader(module_name, loader)
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[module_name] = module
+    loader.exec_module(module)
+
+    node_classes = [
+        obj for obj in vars(module).values()
+        if inspect.isclass(obj) and issubclass(obj, BRANDNode)
+        and obj.__module__ == module_name
+    ]
+    if len(node_classes) != 1:
+        raise NodeError(
+            f'{filepath} must define exactly one BRANDNode subclass to be '
+            f'hosted, found {len(node_classes)}', node=nickname)
+    if issubclass(node_classes[0], AsyncBRANDNode):
+        raise NodeError(f'{nickname} is an AsyncBRANDNode, which cannot be '
+                        'hosted', node=nickname)
+    return node_classes[0]
+
+
+class LocalBus():
+    """
+    In-process delivery of output entries to co-hosted nodes that read them
+    """
+
+    def __init__(self):
+        self.subscribers = {}
+        # encode field values the same way redis-py does
+        self.encoder = Encoder(encoding='utf-8',
+                               encoding_errors='strict',
+                               decode_responses=False)
+
+    def subscribe(self, stream, entry_queue):
+        """
+        Deliver the entries of a stream to a queue as (stream, (entry_id,
+        entry_dict)) tuples, as they would be returned by XREAD
+        """
+        self.subscribers.setdefault(stream, []).append(entry_queue)
+
+    def _encode(self, value):
+        value = self.encoder.encode(value)
+        return bytes(value) if isinstance(value, memoryview) else value
+
+    def publish(self, queued, entry_ids):
+        """
+        Deliver flushed output entries to their subscribers
+
+        Parameters
+        ----------
+        queued : list
+            (stream, entry, sync) tuples that were flushed
+        entry_ids : list
+            IDs that Redis assigned to each entry
+        """
+        for (stream, entry, _), entry_id in zip(queued, entry_ids):
+            queues = self.subscribers.get(stream.encode())
+            if not queues:
+                continue
+            entry = {
+                self._encode(key): self._encode(value)
+                for key, value in entry.items()
+            }
+            for entry_queue in queues:
+                entry_queue.put((stream.encode(), (entry_id, entry)))
+
+
+class NodeHost():
+    """
+    Run several Python nodes in one process, each in its own thread
+    """
+
+    def __init__(self,
+                 group,
+                 nodes,
+                 host=DEFAULT_REDIS_IP,
+                 port=DEFAULT_REDIS_PORT,
+                 socket=None,
+                 local_streams=None):
+        """
+        Parameters
+        ----------
+        group : str
+            Name of the host group
+        nodes : dict
+            Path to the Python source of each node, keyed by nickname
+        host : str, optional
+            Redis IP address, by default DEFAULT_REDIS_IP
+        port : int, optional
+            Redis port, by default DEFAULT_REDIS_PORT
+        socket : str, optional
+            Redis unix socket
+        local_streams : list, optional
+            Streams that are written by one of the hosted nodes only, whose
+            entries can be delivered in-process
+        """
+        self.group = group
+        self.command_stream = f'{group}_host'
+        logging.basicConfig(
+            format='[%(threadName)s] %(levelname)s: %(message)s',
+            level=logging.INFO)
+        self.logger = logging.getLogger(f'host_{group}')
+
+        if socket:
+            self.pool = ConnectionPool(
+                connection_class=UnixDomainSocketConnection, path=socket)
+        else:
+            self.pool = ConnectionPool(host=host,
+                                       port=port,
+                                       retry_on_timeout=True)
+        self.r = Redis(connection_pool=self.pool)
+        self.bus = LocalBus()
+
+        # construct the nodes in the main thread, one at a time
+        self.nodes = {}
+        for nickname, filepath in nodes.items():
+            node_class = load_node_class(nickname, filepath)
+            brand_node._hosted.config = {
+                'nickname': nickname,
+                'redis_host': host,
+                'redis_port': port,
+                'redis_socket': socket,
+                'connection_pool': self.pool,
+                'bus': self.bus,
+            }
+            try:
+                self.nodes[nickname] = node_class()
+            finally:
+                brand_node._hosted.config = None
+
+        # deliver entries in-process to the nodes whose inputs are all
+        # written only by co-hosted nodes
+        local_outputs = set()
+        for node in self.nodes.values():
+            local_outputs.update(s.encode() for s in node.output_retention)
+        local_outputs &= {s.encode() for s in local_streams or []}
+        for nickname, node in self.nodes.items():
+            if node.input_handlers and local_outputs.issuperset(
+                    node.input_handlers):
+                node.local_inputs = queue.SimpleQueue()
+                for stream in node.input_handlers:
+                    self.bus.subscribe(stream, node.local_inputs)
+                self.logger.info(f'Inputs of {nickname} are delivered '
+                                 'in-process')
+
+        self.threads = {}
+        self.stop_requested = False
+
+    def run_node(self, nickname):
+        node = self.nodes[nickname]
+        try:
+            node.run()
+        except Exception:
+            self.logger.exception(f'{nickname} failed')
+        finally:
+            try:
+                node.cleanup()
+            finally:
+                node.r.xadd(f'{nickname}_state', {'code': 0, 'status': 'done'})
+
+    def stop_node(self, nickname):
+        """
+        Stop a node after its current cycle
+        """
+        if nickname in self.nodes:
+            self.nodes[nickname].running = False
+        else:
+            self.logger.warning(f'{nickname} is not hosted by {self.group}')
+
+    def terminate(self, sig, frame):
+        self.logger.info('SIGINT received, stopping all nodes')
+        self.stop_requested = True
+        for nickname in self.nodes:
+            self.stop_node(nickname)
+
+    def run(self):
+        """
+        Run all nodes until SIGINT is received or they have all stopped,
+        handling the commands sent to the <host_group>_host stream
+        """
+        signal.signal(signal.SIGINT, self.terminate)
+        for nickname in self.nodes:
+            # daemon threads, so that a node that does not return from run()
+            # cannot keep the host process alive
+            thread = threading.Thread(target=self.run_node,
+                                      args=(nickname, ),
+                                      name=nickname,
+                                      daemon=True)
+            thread.start()
+            self.threads[nickname] = thread
+
+        last_id = '$'
+        while (not self.stop_requested and any(
+                thread.is_alive() for thread in self.threads.values())):
+            replies = self.r.xread({self.command_stream: last_id}, block=100)
+            for _, entries in replies:
+                for entry_id, entry in entries:
+                    last_id = entry_id
+                    if entry.get(b'command') == b'stopNode':
+                        self.stop_node(entry[b'nickname'].decode())
+
+        deadline = time.monotonic() + STOP_TIMEOUT
+        for thread in self.threads.values():
+            thread.join(timeout=max(deadline - time.monotonic(), 0))
+        stuck = [n for n, thread in self.threads.items() if thread.is_alive()]
+        if stuck:
+            self.logger.error(f'{stuck} did not stop within {STOP_TIMEOUT} '
+                              's, exiting without them')
+        self.pool.disconnect()
+
+    @staticmethod
+    def parse_host_args():
+        """
+        Parse command-line arguments for the NodeHost
+
+        Returns
+        -------
+        args : Namespace
+            NodeHost arguments
+        """
+        ap = argparse.ArgumentParser()
+        ap.add_argument('-g', '--group', required=True, type=str,
+                        help='name of the host group')
+        ap.add_argument('--node', dest='nodes', action='append', required=True,
+                        help='node to host, as <nickname>=<path to source>')
+        ap.add_argument('-i', '--host', type=str, default=DEFAULT_REDIS_IP,
+                        help='ip address of the redis server'
+                        f' (default: {DEFAULT_REDIS_IP})')
+        ap.add_argument('-p', '--port', type=int, default=DEFAULT_REDIS_PORT,
+                        help='port of the redis server'
+                        f' (default: {DEFAULT_REDIS_PORT})')
+        ap.add_argument('-s', '--socket', type=str, required=False,
+                        help='unix socket of the redis server')
+        ap.add_argument('--local-stream', dest='local_streams',
+                        action='append',
+                        help='stream written by one of the hosted nodes only,'
+                        ' which can be delivered in-process')
+        args = ap.parse_args()
+        args.nodes = dict(node.split('=', 1) for node in args.nodes)
+        return args
@@ -3,46 +3,116 @@
 # Adapted from code by: David Brandman and Kushant Patel
 
 import argparse
+import ctypes
 import gc
 import json
 import logging
+import os
+import queue
+import resource
 import signal
 import sys
+import threading
+import time
 
 from redis import Redis
+from redis.exceptions import ResponseError
 
-from .redis import RedisLoggingHandler
+from .redis import RedisLoggingHandler, get_parameters
+from .timing import LatencyHistogram, PeriodicTimer
+
+MCL_CURRENT = 1
+MCL_FUTURE = 2
+
+# set by brand.host while it constructs the nodes that it hosts
+_hosted = threading.local()
 
 class BRANDNode():
     def __init__(self):
 
-        # parse input arguments
-        argp = argparse.ArgumentParser()
-        argp.add_argument('-n', '--nickname', type=str, required=True, default='node')
-        argp.add_argument('-i', '--redis_host', type=str, required=True, default='localhost')
-        argp.add_argument('-p', '--redis_port', type=int, required=True, default=6379)
-        argp.add_argument('-s', '--redis_socket', type=str, required=False)
-        args = argp.parse_args()
-
-        len_args = len(vars(args))
-        if(len_args < 3):
-            print("Arguments passed: {}".format(len_args))
-            print("Please check the arguments passed")
-            sys.exit(1)
-
-        self.NAME = args.nickname
-        redis_host = args.redis_host
-        redis_port = args.redis_port
-        redis_socket = args.redis_socket
+        hosted = getattr(_hosted, 'config', None)
+        if hosted is None:
+            # parse input arguments
+            argp = argparse.ArgumentParser()
+            argp.add_argument('-n', '--nickname', type=str, required=True, default='node')
+            argp.add_argument('-i', '--redis_host', type=str, required=True, default='localhost')
+            argp.add_argument('-p', '--redis_port', type=int, required=True, default=6379)
+            argp.add_argument('-s', '--redis_socket', type=str, required=False)
+            args = argp.parse_args()
+
+            len_args = len(vars(args))
+            if(len_args < 3):
+                print("Arguments passed: {}".format(len_args))
+                print("Please check the arguments passed")
+                sys.exit(1)
+
+            self.NAME = args.nickname
+            self.redis_host = args.redis_host
+            self.redis_port = args.redis_port
+            self.redis_socket = args.redis_socket
+            connection_pool = None
+        else:
+            # started by a NodeHost along with other nodes
+            self.NAME = hosted['nickname']
+            self.redis_host = hosted['redis_host']
+            self.redis_port = hosted['redis_port']
+            self.redis_socket = hosted['redis_socket']
+            connection_pool = hosted['connection_pool']
 
         # connect to Redis
-        self.r = self.connectToRedis(redis_host, redis_port, redis_socket)
+        self.r = self.connectToRedis(self.redis_host, self.redis_port,
+                                     self.redis_socket, connection_pool)
+
+        # cleared to stop run() after the current cycle
+        self.running = True
+        # in-process delivery of entries between nodes of a NodeHost
+        self.hosted = hosted is not None
+        self.local_bus = hosted['bus'] if hosted else None
+        self.local_inputs = None
+
+        # input streams, keyed by stream name, that are read in run()
+        self.input_ids = {}
+        self.input_handlers = {}
+        self.input_count = None
+        self.input_block_ms = 1000
+
+        # output streams and the entries queued for them in this cycle
+        self.output_retention = {}
+        self.output_queue = []
+        self.time_key = b'ts'
+        self.sync_key = b'sync'
+        self.sync_dict = {}
 
         # initialize parameters
         self.parameters = {}
+        self.parameter_count = 0
         self.supergraph_id = '0-0'
+        self.parameters_stream = self.NAME + '_parameters'
+        self.parameters_id = self.getLatestParametersId()
         self.initializeParameters()
 
+        # replicas of a node share their inputs through a consumer group
+        # named after the replicated node (see registerInput)
+        self.consumer_group = self.parameters.get('consumer_group')
+        self.claim_idle_ms = int(self.parameters.get('claim_idle_ms', 5000))
+        self.pending_acks = {}
+        self.next_claim_ns = 0
+        if self.consumer_group is not None:
+            self.input_count = 1  # so outputs carry their input's sync label
+
+        # hot-path instrumentation, enabled with the 'perf' parameter
+        self.perf = {
+            'work': LatencyHistogram(),
+            'xread': LatencyHistogram(),
+            'xadd': LatencyHistogram(),
+        }
+        self.perf_stream = self.NAME + '_perf'
+        self.configurePerf()
+
+        # real-time mode, enabled with the 'realtime' parameter in run()
+        self.realtime = False
+        self.realtime_stream = self.NAME + '_realtime'
+
         # set up logging
         loglevel = self.parameters.setdefault('log', 'INFO')
         numeric_level = getattr(logging, loglevel.upper(), None)
@@ -55,20 +125,41 @@ class BRANDNode():
         self.redis_log_handler = RedisLoggingHandler(self.r, self.NAME)
         logging.getLogger().addHandler(self.redis_log_handler)
 
+        if hosted is not None:
+            # the host constructs each node in its main thread, then runs it
+            # in a thread named after the node, and handles signals and
+            # uncaught exceptions for all of them
+            self.redis_log_handler.addFilter(self._isOwnRecord)
+            return
+
         signal.signal(signal.SIGINT, self.terminate)
 
         sys.excepthook = self._handle_exception
 
-    def connectToRedis(self, redis_host, redis_port, redis_socket=None):
+    def _isOwnRecord(self, record):
+        """
+        Whether a log record was emitted by this co-hosted node, while it
+        was being constructed or from its own thread
+        """
+        if record.threadName == self.NAME:
+            return True
+        hosted = getattr(_hosted, 'config', None)
+        return hosted is not None and hosted['nickname'] == self.NAME
+
+    def connectToRedis(self, redis_host, redis_port, redis_socket=None,
+                       connection_pool=None):
         """
         Establish connection to Redis and post initialized status to respective Redis stream
         If we supply a -h flag that starts with a number, then we require a -p for the port
+        If connection_pool is given (by a NodeHost), the connection is taken from it
         If we fail to connect, then exit status 1
         # If this function completes successfully then it executes the following Redis command:
         # XADD nickname_state * code 0 status "initialized"        
         """
         try:
-            if redis_socket:
+            if connection_pool is not None:
+                r = Redis(connection_pool=connection_pool)
+            elif redis_socket:
                 r = Redis(unix_socket_path=redis_socket)
                 print(f"[{self.NAME}] Redis connection established on socket:"
                       f" {redis_socket}")
@@ -130,10 +221,17 @@ class BRANDNode():
 
     def initializeParameters(self):
         """
-        Read node parameters from Redis.
-        ...
+        Read node parameters from Redis. The node's own entry in the
+        supervisor's supergraph index is used when available, so that
+        startup does not parse every supergraph ever published.
         """
-        node_parameters = self.getParametersFromSupergraph()
+        supergraph_id, node_parameters = get_parameters(self.r, self.NAME)
+        if supergraph_id is not None:
+            self.supergraph_id = supergraph_id
+            node_parameters = [node_parameters or {}]
+        else:
+            # no supergraph index, so fall back to parsing supergraph_stream
+            node_parameters = self.getParametersFromSupergraph()
         if node_parameters is None:
             print(f"[{self.NAME}] No model published to supergraph_stream in Redis")
             sys.exit(1)
@@ -141,11 +239,433 @@ class BRANDNode():
         for key,value in node_parameters[-1].items():
             self.parameters[key] = value
 
+    def registerInput(self, stream, handler, start_id='$'):
+        """
+        Register a handler for new entries in an input stream. Registered
+        streams are read together with a single blocking XREAD on each
+        cycle of run(), before work() is called.
+
+        Parameters
+        ----------
+        stream : str or bytes
+            Name of the input stream
+        handler : callable
+            Function called as handler(entries) with the list of
+            (entry_id, entry_dict) tuples read from the stream in this cycle
+        start_id : (optional) str or bytes
+            ID of the last entry already seen. '$' (default) starts from
+            the entry that is currently the latest in the stream.
+
+        If the node is a replica (its 'consumer_group' parameter is set by
+        the supervisor for nodes with 'replicas' in the graph YAML), the
+        stream is read with XREADGROUP in the consumer group shared by all
+        replicas, so that each entry is handled by only one of them.
+        """
+        if isinstance(stream, str):
+            stream = stream.encode()
+
+        if self.consumer_group is not None:
+            # entries are shared with the other replicas of this node
+            try:
+                self.r.xgroup_create(stream, self.consumer_group,
+                                     id=start_id, mkstream=True)
+            except ResponseError as exc:
+                if 'BUSYGROUP' not in str(exc):
+                    raise  # the group was not created by another replica
+            self.input_ids[stream] = '>'
+            self.input_handlers[stream] = handler
+            return
+
+        if start_id == '$':
+            # resolve '$' now so that entries added between cycles are not
+            # skipped while another stream is being handled
+            last_entry = self.r.xrevrange(stream, '+', '-', count=1)
+            start_id = last_entry[0][0] if last_entry else '0-0'
+
+        self.input_ids[stream] = start_id
+        self.input_handlers[stream] = handler
+
+    def readInputs(self, block=True):
+        """
+        Block on all registered input streams with one XREAD call and
+        dispatch the new entries to their handlers
+
+        Parameters
+        ----------
+        block : (optional) bool
+            Whether to block for up to input_block_ms milliseconds when
+            there are no new entries. By default True.
+
+        Returns
+        -------
+        n_entries : int
+            Number of entries that were dispatched
+        """
+        if self.local_inputs is not None:
+            return self.readLocalInputs(block)
+        if self.consumer_group is not None:
+            return self.readGroupInputs(block)
+
+        if self.perf_enabled:
+            t0 = time.perf_counter_ns()
+        replies = self.r.xread(self.input_ids,
+                               count=self.input_count,
+                               block=self.input_block_ms if block else None)
+        if self.perf_enabled:
+            self.perf['xread'].add(time.perf_counter_ns() - t0)
+
+        n_entries = 0
+        for stream, entries in replies:
+            self.input_ids[stream] = entries[-1][0]
+            self.input_handlers[stream](entries)
+            n_entries += len(entries)
+
+        return n_entries
+
+    def readLocalInputs(self, block=True):
+        """
+        Dispatch the entries that co-hosted nodes delivered in-process to
+        the local_inputs queue, in the same format as readInputs(). A
+        NodeHost sets up this queue when all of a node's input streams are
+        written by nodes in the same host.
+        """
+        if self.perf_enabled:
+            t0 = time.perf_counter_ns()
+        try:
+            if block:
+                item = self.local_inputs.get(timeout=self.input_block_ms / 1000)
+            else:
+                item = self.local_inputs.get_nowait()
+        except queue.Empty:
+            item = None
+        replies = {}
+        while item is not None:
+            stream, entry = item
+            replies.setdefault(stream, []).append(entry)
+            try:
+                item = self.local_inputs.get_nowait()
+            except queue.Empty:
+                item = None
+        if self.perf_enabled:
+            self.perf['xread'].add(time.perf_counter_ns() - t0)
+
+        n_entries = 0
+        for stream, entries in replies.items():
+            self.input_ids[stream] = entries[-1][0]
+            self.input_handlers[stream](entries)
+            n_entries += len(entries)
+
+        return n_entries
+
+    def readGroupInputs(self, block=True):
+        """
+        Read the next entries of the registered input streams that are
+        assigned to this replica by the consumer group, and dispatch them
+        to their handlers. Entries that were delivered to a replica that
+        has been idle for more than claim_idle_ms (e.g. because it died)
+        are claimed first. Dispatched entries are acknowledged by
+        ackInputs() once the outputs computed from them have been flushed.
+        """
+        replies = []
+        now_ns = time.monotonic_ns()
+        if now_ns >= self.next_claim_ns:
+            replies = self.claimPending()
+            self.next_claim_ns = now_ns + self.claim_idle_ms * 500_000
+
+        if self.perf_enabled:
+            t0 = time.perf_counter_ns()
+        replies += self.r.xreadgroup(
+            self.consumer_group,
+            self.NAME,
+            self.input_ids,
+            count=self.input_count,
+            block=self.input_block_ms if block and not replies else None)
+        if self.perf_enabled:
+            self.perf['xread'].add(time.perf_counter_ns() - t0)
+
+        n_entries = 0
+        for stream, entries in replies:
+            if not entries:
+                continue
+            # outputs computed from these entries carry their sync labels
+            sync = entries[-1][1].get(self.sync_key)
+            if sync:
+                self.sync_dict.update(json.loads(sync))
+            self.input_handlers[stream](entries)
+            self.pending_acks.setdefault(stream, []).extend(
+                entry_id for entry_id, _ in entries)
+            n_entries += len(entries)
+
+        return n_entries
+
+    def claimPending(self):
+        """
+        Claim the entries of each input stream that were delivered to
+        another replica more than claim_idle_ms milliseconds ago but never
+        acknowledged
+
+        Returns
+        -------
+        replies : list
+            (stream, entries) tuples, as in an XREAD reply
+        """
+        replies = []
+        for stream in self.input_handlers:
+            claimed = self.r.xautoclaim(stream,
+                                        self.consumer_group,
+                                        self.NAME,
+                                        min_idle_time=self.claim_idle_ms,
+                                        start_id='0-0',
+                                        count=self.input_count)
+            # entries deleted from the stream are claimed without data
+            entries = [entry for entry in claimed[1] if entry[1]]
+            if entries:
+                logging.info(f'Claimed {len(entries)} pending entries from '
+                             f'{stream.decode()}')
+                replies.append((stream, entries))
+        return replies
+
+    def ackInputs(self):
+        """
+        Acknowledge the input entries that were dispatched by
+        readGroupInputs(), so that they are not claimed by other replicas
+        """
+        if not self.pending_acks:
+            return
+        p = self.r.pipeline(transaction=False)
+        for stream, entry_ids in self.pending_acks.items():
+            p.xack(stream, self.consumer_group, *entry_ids)
+        p.execute()
+        self.pending_acks = {}
+
     def run(self):
 
-        while True:
-            self.work()
+        self.startRealtime()
+        while self.running:
+            n_entries = 1
+            if self.input_handlers:
+                n_entries = self.readInputs()
+            self.timedWork()
+            self.flushOutputs()
+            self.ackInputs()
             self.updateParameters()
+            if self.perf_enabled:
+                self.publishPerf()
+            if self.realtime:
+                # the last read drained the backlog, so we have slack
+                self.realtimeCollect(
+                    idle=(not self.input_handlers or self.input_count is None
+                          or n_entries < self.input_count))
+                self.publishRealtime()
+
+    def runPeriodic(self, period_ns, policy='skip', report_interval_s=1):
+        """
+        Run the node at a fixed rate instead of blocking on its inputs.
+        On each period, new input entries are dispatched without blocking,
+        and then work(), flushOutputs() and updateParameters() are called.
+        The timer's statistics are published to the nickname_timer stream
+        every report_interval_s seconds.
+
+        Parameters
+        ----------
+        period_ns : int
+            Period in nanoseconds, e.g. 1_000_000 for 1 kHz
+        policy : (optional) str
+            'skip' (default) or 'catchup', see timing.PeriodicTimer
+        report_interval_s : (optional) float
+            Interval (in seconds) between timer reports
+        """
+        self.timer = PeriodicTimer(period_ns,
+                                   clock=time.CLOCK_MONOTONIC,
+                                   policy=policy)
+        report_interval_ns = int(report_interval_s * 1e9)
+        next_report_ns = time.monotonic_ns() + report_interval_ns
+
+        self.startRealtime()
+        self.timer.start()
+        while self.running:
+            self.timer.wait()
+            if self.input_handlers:
+                self.readInputs(block=False)
+            self.timedWork()
+            self.flushOutputs()
+            self.ackInputs()
+            self.updateParameters()
+            if self.perf_enabled:
+                self.publishPerf()
+            if self.realtime:
+                slack_ns = self.timer.next_ns - time.monotonic_ns()
+                self.realtimeCollect(idle=slack_ns > self.timer.period_ns // 2)
+                self.publishRealtime()
+
+            if time.monotonic_ns() >= next_report_ns:
+                self.r.xadd(self.NAME + '_timer', self.timer.stats())
+                self.timer.reset_stats()
+                next_report_ns += report_interval_ns
+
+    def startRealtime(self):
+        """
+        If the 'realtime' parameter is true, prepare the process so that
+        garbage collection and page faults do not stall work():
+
+        * apply the 'rt_priority' (SCHED_FIFO) and 'rt_cpu_affinity'
+          (e.g. [2, 3] or '2-3') parameters, if given
+        * collect and freeze the heap built during startup, then disable
+          automatic garbage collection (see idleCollect())
+        * lock all current and future memory with mlockall
+
+        Garbage is collected when the node has slack, or regardless once
+        'realtime_gc_budget' (default: 10) times the generation-0 threshold
+        of objects were allocated or 'realtime_gc_max_s' seconds (default:
+        1) passed since the last collection (see realtimeCollect()).
+
+        The number of collections and page faults are published to the
+        nickname_realtime stream every 'realtime_report_s' seconds
+        (default: 1).
+
+        Nodes run by a NodeHost cannot use realtime mode, since garbage
+        collection and memory locking apply to the whole host process.
+        """
+        self.realtime = bool(self.parameters.get('realtime', False))
+        if self.realtime and self.hosted:
+            logging.warning('realtime is ignored for co-hosted nodes, since '
+                            'it would apply to the whole host process. Set '
+                            'run_priority and cpu_affinity on the host group '
+                            'instead.')
+            self.realtime = False
+        if not self.realtime:
+            return
+
+        priority = self.parameters.get('rt_priority')
+        if priority:
+            try:
+                os.sched_setscheduler(0, os.SCHED_FIFO,
+                                      os.sched_param(int(priority)))
+            except PermissionError:
+                logging.warning(f'Could not set SCHED_FIFO priority {priority}')
+
+        affinity = self.parameters.get('rt_cpu_affinity')
+        if affinity is not None and affinity != '':
+            os.sched_setaffinity(0, parse_cpu_list(affinity))
+
+        gc.collect()
+        gc.freeze()
+        gc.disable()
+
+        libc = ctypes.CDLL('libc.so.6', use_errno=True)
+        if libc.mlockall(MCL_CURRENT | MCL_FUTURE) != 0:
+            logging.warning('Could not lock memory with mlockall: '
+                            f'{os.strerror(ctypes.get_errno())}')
+
+        self.realtime_report_ns = int(
+            float(self.parameters.get('realtime_report_s', 1)) * 1e9)
+        self.realtime_start_ns = time.monotonic_ns()
+        self.n_collections = 0
+        self.gc_budget = int(
+            float(self.parameters.get('realtime_gc_budget', 10)) *
+            gc.get_threshold()[0])
+        self.gc_max_ns = int(
+            float(self.parameters.get('realtime_gc_max_s', 1)) * 1e9)
+        self.last_collect_ns = self.realtime_start_ns
+        usage = resource.getrusage(resource.RUSAGE_SELF)
+        self.realtime_faults = (usage.ru_minflt, usage.ru_majflt)
+
+    def idleCollect(self):
+        """
+        Run the garbage collection that automatic collection would have run
+        by now, if any. Call this when the node has slack before its next
+        input or deadline.
+        """
+        counts = gc.get_count()
+        thresholds = gc.get_threshold()
+        if counts[0] < thresholds[0]:
+            return
+        generation = 0
+        if counts[1] >= thresholds[1]:
+            generation = 1
+            if counts[2] >= thresholds[2]:
+                generation = 2
+        gc.collect(generation)
+        self.n_collections += 1
+        self.last_collect_ns = time.monotonic_ns()
+
+    def realtimeCollect(self, idle):
+        """
+        Run idleCollect() if the node has slack (idle), or if garbage built
+        up past the allocation or time budget while the node was busy, so
+        that a node with steady input still collects
+
+        Parameters
+        ----------
+        idle : bool
+            Whether the node has slack before its next input or deadline
+        """
+        if (idle or gc.get_count()[0] >= self.gc_budget
+                or time.monotonic_ns() - self.last_collect_ns >= self.gc_max_ns):
+            self.idleCollect()
+
+    def publishRealtime(self):
+        """
+        Publish the number of garbage collections and page faults since the
+        last report to the nickname_realtime stream once per interval
+        """
+        now_ns = time.monotonic_ns()
+        if now_ns - self.realtime_start_ns < self.realtime_report_ns:
+            return
+
+        usage = resource.getrusage(resource.RUSAGE_SELF)
+        self.r.xadd(self.realtime_stream, {
+            'collections': self.n_collections,
+            'minor_faults': usage.ru_minflt - self.realtime_faults[0],
+            'major_faults': usage.ru_majflt - self.realtime_faults[1],
+        })
+        self.realtime_faults = (usage.ru_minflt, usage.ru_majflt)
+        self.n_collections = 0
+        self.realtime_start_ns = now_ns
+
+    def configurePerf(self):
+        """
+        Enable or disable hot-path instrumentation according to the 'perf'
+        parameter, and set the reporting interval from the
+        'perf_interval_s' parameter (default: 1 second)
+        """
+        self.perf_enabled = bool(self.parameters.get('perf', False))
+        self.perf_interval_ns = int(
+            float(self.parameters.get('perf_interval_s', 1)) * 1e9)
+        for hist in self.perf.values():
+            hist.reset()
+        self.perf_start_ns = time.monotonic_ns()
+
+    def timedWork(self):
+        """
+        Call work(), recording its duration if instrumentation is enabled
+        """
+        if not self.perf_enabled:
+            return self.work()
+
+        t0 = time.perf_counter_ns()
+        out = self.work()
+        self.perf['work'].add(time.perf_counter_ns() - t0)
+        return out
+
+    def publishPerf(self):
+        """
+        Publish a summary of the work(), XREAD and XADD durations and the
+        loop rate to the nickname_perf stream once per reporting interval,
+        then start a new interval
+        """
+        now_ns = time.monotonic_ns()
+        elapsed_ns = now_ns - self.perf_start_ns
+        if elapsed_ns < self.perf_interval_ns:
+            return
+
+        entry = {'loop_rate_hz': self.perf['work'].count * 1e9 / elapsed_ns}
+        for stage, hist in self.perf.items():
+            for stat, value in hist.summary().items():
+                entry[f'{stage}_{stat}'] = value
+            hist.reset()
+        self.r.xadd(self.perf_stream, entry)
+        self.perf_start_ns = now_ns
 
     def work(self):
         """
@@ -161,25 +681,172 @@ class BRANDNode():
         """
         pass
 
-    # def write_brand(self):
+    def registerOutput(self, stream, maxlen=None, retention_ms=None):
+        """
+        Register an output stream and its retention policy. If neither
+        maxlen nor retention_ms is given, they are read from the stream's
+        entry in the node's 'output_retention' parameter, e.g.
+
+            output_retention:
+              my_stream: {maxlen: 10000}
+              other_stream: {retention_ms: 60000}
+
+        Parameters
+        ----------
+        stream : str or bytes
+            Name of the output stream
+        maxlen : (optional) int
+            Approximate maximum number of entries kept in the stream
+        retention_ms : (optional) int
+            Entries older than this many milliseconds are trimmed
+            (approximately) using MINID
+        """
+        if isinstance(stream, bytes):
+            stream = stream.decode()
+        if maxlen is None and retention_ms is None:
+            retention = self.parameters.get('output_retention') or {}
+            retention = retention.get(stream) or {}
+            maxlen = retention.get('maxlen')
+            retention_ms = retention.get('retention_ms')
+        self.output_retention[stream] = (maxlen, retention_ms)
+
+    def writeOutput(self, stream, entry, sync=None):
+        """
+        Queue an entry to be added to an output stream on the next call to
+        flushOutputs(). The monotonic time key and the sync labels are
+        added to a copy of the entry when it is flushed, per
+        DataSyncGuidelines.md, so the caller's dict is left unchanged and
+        can be reused.
+
+        Parameters
+        ----------
+        stream : str or bytes
+            Name of the output stream
+        entry : dict
+            Entry data, keyed by field name
+        sync : (optional) dict
+            Sync labels of the data used to compute this entry. By default
+            self.sync_dict is used.
+        """
+        if isinstance(stream, bytes):
+            stream = stream.decode()
+        if stream not in self.output_retention:
+            self.registerOutput(stream)
+        if sync is None:
+            sync = self.sync_dict
+        # copy the entry so that later changes to the caller's dict do not
+        # affect it, and its stamps are not added to the caller's dict
+        self.output_queue.append((stream, dict(entry), json.dumps(sync)))
+
+    def flushOutputs(self):
+        """
+        Add all queued output entries to Redis in one non-transactional
+        pipeline, applying each stream's retention policy
+
+        Returns
+        -------
+        entry_ids : list
+            IDs of the added entries, in the order they were queued
+        """
+        if not self.output_queue:
+            return []
+
+        queued = self.output_queue
+        p = self.r.pipeline(transaction=False)
+        self._addOutputsToPipeline(p)
+        if self.perf_enabled:
+            t0 = time.perf_counter_ns()
+            entry_ids = p.execute()
+            self.perf['xadd'].add(time.perf_counter_ns() - t0)
+        else:
+            entry_ids = p.execute()
 
-    #     self.sync_dict_json = json.dumps(self.sync_dict)
+        if self.local_bus is not None:
+            self.local_bus.publish(queued, entry_ids)
+        return entry_ids
 
-    #     self.output_entry[self.time_key] = time.monotonic()
-    #     self.output_entry[self.sync_key] = self.sync_dict_json.encode()
+    def _addOutputsToPipeline(self, p):
+        """
+        Stamp the queued output entries and add them to pipeline p
+        """
+        now_ms = None
+        for stream, entry, sync in self.output_queue:
+            maxlen, retention_ms = self.output_retention[stream]
+            entry[self.time_key] = time.monotonic_ns().to_bytes(8, sys.byteorder)
+            entry[self.sync_key] = sync
+            if retention_ms is not None:
+                if now_ms is None:
+                    now_ms = int(time.time() * 1000)
+                p.xadd(stream, entry,
+                       minid=max(now_ms - int(retention_ms), 0),
+                       approximate=True)
+            else:
+                p.xadd(stream, entry, maxlen=maxlen, approximate=True)
+        self.output_queue = []
 
-    #     self.r.xadd(self.output_stream, self.output_entry)
+    def getLatestParametersId(self):
+        """
+        Get the ID of the latest entry in the nickname_parameters stream,
+        so that only updates published after startup are applied
 
+        Returns
+        -------
+        entry_id : bytes or str
+            ID of the latest parameter update, or '0-0' if there is none
+        """
+        last_entry = self.r.xrevrange(self.parameters_stream, '+', '-', count=1)
+        return last_entry[0][0] if last_entry else '0-0'
 
     def updateParameters(self):
         """
-        This function reads from the nickname_parameters stream, 
-        and knows how to parse all parameters that (1) do not have static variable
-        specified, or (2) are static: false specified
+        This function reads from the nickname_parameters stream, where the
+        supervisor publishes the parameters changed by each updateParameters
+        command as a JSON dict in the 'data' field.
         It does not block on the XREAD call. Whenever there is a new stream value,
         it assumes that the new value is meaningful (since it should have been checked
         by the supervisor node) and then updates the parameters = {} value
-        If this function updates the parameters{} dictionary, then it increments parameter_count
+        If this function updates the parameters{} dictionary, then it increments
+        parameter_count and calls parametersChanged() with the changed parameters
+
+        Returns
+        -------
+        changed : dict
+            Parameters that were updated, keyed by parameter name
+        """
+        replies = self.r.xread({self.parameters_stream: self.parameters_id})
+        return self._applyParameterUpdates(replies)
+
+    def _applyParameterUpdates(self, replies):
+        """
+        Apply the parameter updates in an XREAD reply from the
+        nickname_parameters stream
+        """
+        if not replies:
+            return {}
+
+        changed = {}
+        for entry_id, entry_data in replies[0][1]:
+            changed.update(json.loads(entry_data[b'data']))
+        self.parameters_id = entry_id
+
+        self.parameters.update(changed)
+        self.parameter_count += 1
+        if 'perf' in changed or 'perf_interval_s' in changed:
+            self.configurePerf()
+        self.parametersChanged(changed)
+
+        return changed
+
+    def parametersChanged(self, changed):
+        """
+        Called by updateParameters() after new parameter values have been
+        applied to self.parameters. Override this to react to changes, e.g.
+        to reallocate buffers when a size parameter changes.
+
+        Parameters
+        ----------
+        changed : dict
+            Parameters that were updated, keyed by parameter name
         """
         pass
 
@@ -204,3 +871,27 @@ class BRANDNode():
             logging.exception('', exc_info=(exc_type, exc_value, exc_traceback))
         else:
             sys.__excepthook__(exc_type, exc_value, exc_traceback)
+
+
+def parse_cpu_list(cpus):
+    """
+    Parse a CPU list, given either as a list of ints or as a string in the
+    format used by taskset -c (e.g. '0,2-4')
+
+    Returns
+    -------
+    set of int
+        CPU indices
+    """
+    if isinstance(cpus, int):
+        return {cpus}
+    if not isinstance(cpus, str):
+        return {int(cpu) for cpu in cpus}
+    out = set()
+    for part in cpus.split(','):
+        if '-' in part:
+            start, end = part.split('-')
+            out.update(range(int(start), int(end) + 1))
+        elif part.strip():
+            out.add(int(part))
+    return out
@@ -0,0 +1,348 @@
+"""
+Starting node processes and waiting for them to be ready, and stopping
+them, shared by Supervisor, Booter and derivatives
+"""
+import json
+import logging
+import signal
+import subprocess
+import time
+
+from concurrent.futures import ThreadPoolExecutor
+from threading import Thread
+
+import psutil
+
+logger = logging.getLogger(__name__)
+
+# states posted to <nickname>_state once a node is up: 'initialized' by
+# BRANDNode, 'Initialized' or 'Ready' by emit_status() in C nodes
+READY_STATES = {b'initialized', b'ready'}
+STARTUP_TIMES_STREAM = 'node_startup_times'
+SHUTDOWN_TIMES_STREAM = 'node_shutdown_times'
+STOP_TIMEOUT = 15  # seconds for processes to stop after SIGINT
+POLL_INTERVAL = 0.01  # seconds between checks for processes that exited
+
+
+def _popen(args):
+    launch_ns = time.monotonic_ns()
+    proc = subprocess.Popen(args)
+    proc.launch_ns = launch_ns
+    return proc
+
+
+def start_processes(commands, max_workers=16):
+    """
+    Start processes concurrently
+
+    Parameters
+    ----------
+    commands : dict
+        Command-line arguments of each process, keyed by name
+    max_workers : int, optional
+        Maximum number of processes being started at the same time, by
+        default 16
+
+    Returns
+    -------
+    procs : dict
+        subprocess.Popen instance of each process that was started, with
+        the monotonic time at which it was launched in its launch_ns
+        attribute
+    errors : dict
+        Exception raised when starting each process that could not be
+        started
+    """
+    procs, errors = {}, {}
+    if not commands:
+        return procs, errors
+    with ThreadPoolExecutor(max_workers=min(max_workers,
+                                            len(commands))) as executor:
+        futures = {
+            name: executor.submit(_popen, args)
+            for name, args in commands.items()
+        }
+    for name, future in futures.items():
+        try:
+            procs[name] = future.result()
+        except Exception as exc:
+            errors[name] = exc
+    return procs, errors
+
+
+def get_state_ids(r, nodes):
+    """
+    Get the ID of the latest entry of each node's <nickname>_state stream,
+    so that only states posted afterwards are waited for
+
+    Returns
+    -------
+    dict
+        Latest ID (or '0-0') of each <nickname>_state stream
+    """
+    p = r.pipeline()
+    for node in nodes:
+        p.xrevrange(f'{node}_state', '+', '-', count=1)
+    return {
+        f'{node}_state': last_entry[0][0] if last_entry else '0-0'
+        for node, last_entry in zip(nodes, p.execute())
+    }
+
+
+def wait_until_ready(r, state_ids, procs=None, timeout=10):
+    """
+    Block until each node posts a ready state to its <nickname>_state
+    stream, its process exits, or the timeout expires
+
+    Parameters
+    ----------
+    r : redis.Redis
+        Redis connection
+    state_ids : dict
+        ID after which to look for a ready state in each <nickname>_state
+        stream, from get_state_ids()
+    procs : dict, optional
+        Process of each node started on this machine, keyed by nickname,
+        so that nodes whose process exits are not waited for
+    timeout : float, optional
+        Maximum time to wait, in seconds, by default 10
+
+    Returns
+    -------
+    ready : dict
+        Monotonic time at which each ready node was seen to be ready
+    exited : dict
+        Exit code of each node whose process exited before it was ready
+    pending : list
+        Nodes that were not ready when the timeout expired
+    """
+    state_ids = dict(state_ids)
+    procs = procs or {}
+    ready, exited = {}, {}
+    deadline = time.monotonic_ns() + int(timeout * 1e9)
+    while state_ids:
+        block_ms = (deadline - time.monotonic_ns()) // 1_000_000
+        if block_ms <= 0:
+            break
+        replies = r.xread(state_ids, block=min(block_ms, 100))
+        now = time.monotonic_ns()
+        for stream, entries in replies:
+            stream = stream.decode()
+            state_ids[stream] = entries[-1][0]
+            for _, entry in entries:
+                state = entry.get(b'status', entry.get(b'state', b''))
+                if state.lower() in READY_STATES:
+                    ready[stream[:-len('_state')]] = now
+                    del state_ids[stream]
+                    break
+        for node, proc in procs.items():
+            stream = f'{node}_state'
+            if stream in state_ids and proc.poll() is not None:
+                exited[node] = proc.returncode
+                del state_ids[stream]
+    pending = [stream[:-len('_state')] for stream in state_ids]
+    return ready, exited, pending
+
+
+def report_startup(r,
+                   machine,
+                   start_ns,
+                   ready,
+                   exited,
+                   pending,
+                   procs=None,
+                   log=logger):
+    """
+    Log how long each node took to be ready and publish it to the
+    node_startup_times stream
+
+    Parameters
+    ----------
+    r : redis.Redis
+        Redis connection
+    machine : str
+        Name of the machine reporting the times
+    start_ns : int
+        Monotonic time at which the graph started to be launched. Nodes
+        that have a process in procs are timed from their own launch.
+    ready, exited, pending
+        Results of wait_until_ready()
+    procs : dict, optional
+        Process of each node started on this machine, keyed by nickname
+    log : logging.Logger, optional
+        Logger to report the slowest nodes to
+
+    Returns
+    -------
+    dict
+        Startup report of each node: its 'status' ('ready', 'exited' or
+        'timeout') and, if ready, its 'startup_s'
+    """
+    procs = procs or {}
+    report = {}
+    for node, ready_ns in sorted(ready.items(), key=lambda item: item[1]):
+        launch_ns = getattr(procs.get(node), 'launch_ns', start_ns)
+        report[node] = {
+            'status': 'ready',
+            'startup_s': (ready_ns - launch_ns) / 1e9
+        }
+    for node, returncode in exited.items():
+        report[node] = {'status': 'exited', 'returncode': returncode}
+    for node in pending:
+        report[node] = {'status': 'timeout'}
+
+    if ready:
+        slowest = sorted(report.items(),
+                         key=lambda item: item[1].get('startup_s', 0),
+                         reverse=True)[:5]
+        log.info('Slowest nodes to start: ' + ', '.join(
+            f"{node} ({info['startup_s']:.3f} s)" for node, info in slowest
+            if 'startup_s' in info))
+    if report:
+        r.xadd(STARTUP_TIMES_STREAM, {
+            'machine': machine,
+            **{node: json.dumps(info)
+               for node, info in report.items()}
+        })
+    return report
+
+
+def _signal_tree(proc, sig):
+    """
+    Send a signal to a process and its children, returning the children
+    """
+    try:
+        parent = psutil.Process(proc.pid)
+        children = parent.children(recursive=False)
+    except psutil.NoSuchProcess:
+        return []
+    for p in children + [parent]:
+        try:
+            p.send_signal(sig)
+        except psutil.NoSuchProcess:
+            pass
+    return children
+
+
+def _wait_trees(trees, deadline):
+    """
+    Wait until the deadline for each process in trees (a dict mapping
+    processes to their children) to exit along with its children
+
+    Returns
+    -------
+    dict
+        Monotonic time at which each process's tree was seen to have exited
+    """
+    done = {}
+    while True:
+        for proc, children in trees.items():
+            if proc in done or proc.poll() is None:
+                continue
+            # Popen.poll() reaps the process itself (keeping its return
+            # code), so psutil only has to check on its children
+            _, alive = psutil.wait_procs(children, timeout=0)
+            trees[proc] = alive
+            if not alive:
+                done[proc] = time.monotonic()
+        if len(done) == len(trees) or time.monotonic() >= deadline:
+            return done
+        time.sleep(POLL_INTERVAL)
+
+
+def stop_processes(procs, timeout=STOP_TIMEOUT, kill_timeout=15, log=logger):
+    """
+    Stop processes and their children: SIGINT is sent to all of them at
+    once, they are waited for against a single deadline, and only those
+    still running then are sent SIGKILL
+
+    Parameters
+    ----------
+    procs : dict
+        subprocess.Popen instance of each process, keyed by name. A process
+        shared by several names (e.g. a NodeHost) is only signalled once.
+        The stdout and stderr pipes of a process, if any, are drained
+        while it stops, so that it does not block writing to them.
+    timeout : float, optional
+        Time to wait for the processes to stop after SIGINT, in seconds, by
+        default 15
+    kill_timeout : float, optional
+        Time to wait for the remaining processes to stop after SIGKILL, in
+        seconds, by default 15
+    log : logging.Logger, optional
+        Logger to report the outcome for each name to
+
+    Returns
+    -------
+    dict
+        Outcome for each name: its 'status' ('not running' if it had
+        already exited, 'stopped' by SIGINT, 'killed' by SIGKILL, or
+        'running' if it could not be stopped), the process's 'pid' and,
+        if it was stopped or killed, its 'shutdown_s' since SIGINT was sent
+    """
+    names = {}
+    for name, proc in procs.items():
+        names.setdefault(proc, []).append(name)
+
+    status = {}
+    trees = {}
+    for proc in names:
+        if proc.poll() is not None:
+            status[proc] = 'not running'
+    for proc in names:
+        if proc not in status and (proc.stdout or proc.stderr):
+            Thread(target=proc.communicate, daemon=True).start()
+    start = time.monotonic()
+    for proc in names:
+        if proc not in status:
+            trees[proc] = _signal_tree(proc, signal.SIGINT)
+    done = _wait_trees(trees, start + timeout)
+    for proc in done:
+        status[proc] = 'stopped'
+
+    stragglers = {}
+    for proc, children in trees.items():
+        if proc not in done:
+            log.warning(f"Could not stop {', '.join(names[proc])} "
+                        f"(pid: {proc.pid}) using SIGINT")
+            for child in children:
+                try:
+                    child.kill()
+                except psutil.NoSuchProcess:
+                    pass
+            stragglers[proc] = children + _signal_tree(proc, signal.SIGKILL)
+    killed = _wait_trees(stragglers, time.monotonic() + kill_timeout)
+    done.update(killed)
+    for proc in stragglers:
+        status[proc] = 'killed' if proc in killed else 'running'
+
+    report = {}
+    for proc, proc_names in names.items():
+        info = {'status': status[proc], 'pid': proc.pid}
+        if proc in done:
+            info['shutdown_s'] = done[proc] - start
+        for name in proc_names:
+            report[name] = info
+            if info['status'] == 'not running':
+                log.warning(f"'{name}' (pid: {proc.pid}) isn't running and "
+                            "may have crashed")
+            elif info['status'] == 'stopped':
+                log.info(f"Stopped '{name}' (pid: {proc.pid}) using SIGINT "
+                         f"in {info['shutdown_s']:.3f} s")
+            elif info['status'] == 'killed':
+                log.info(f"Killed '{name}' (pid: {proc.pid}) using SIGKILL "
+                         f"after {info['shutdown_s']:.3f} s")
+    return report
+
+
+def report_shutdown(r, machine, report):
+    """
+    Publish the outcome of stop_processes() to the node_shutdown_times
+    stream, as JSON keyed by name
+    """
+    if report:
+        r.xadd(SHUTDOWN_TIMES_STREAM, {
+            'machine': machine,
+            **{name: json.dumps(info)
+               for name, info in report.items()}
+        })
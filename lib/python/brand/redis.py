@@ -1,6 +1,10 @@
+import collections
+import json
 import logging
 import numpy as np
 import redis
+import threading
+import time
 
 
 def xread_count(r, stream, count, startid=0, block=None) -> list:
@@ -43,97 +47,394 @@ def xread_count(r, stream, count, startid=0, block=None) -> list:
     return out
 
 
-def xread_sync(self,
+def _to_str(value):
+    return value.decode() if isinstance(value, bytes) else str(value)
+
+
+def xread_sync(r,
                streams,
                sync_field,
                sync_dtype='uint32',
                count=1,
-               block=None) -> list:
+               block=None,
+               window=100,
+               return_discarded=False):
     """
     Read and sync entries from multiple streams
 
+    Entries are fetched in windows of up to `window` entries per stream with
+    one pipelined XRANGE for all streams that need more entries, and the
+    sync values of each window are decoded at once, so a stream that lags
+    far behind the others is caught up in a few round trips. The sync
+    values of each stream must be non-decreasing.
+
     Parameters
     ----------
-    streams : bytes
+    r : redis.Redis
+        instance of the redis.Redis interface
+    streams : dict
         dict of stream names to stream IDs, where IDs indicate the last ID
-        already seen.
+        already seen. '$' starts after the latest entry of the stream.
     sync_field : bytes
         Field in each stream containing a value that should match in the
         synchronized data
+    sync_dtype : str, optional
+        Data type of the sync field, by default 'uint32'
     count : int
         Number of items to return
     block : int, optional
-        Number of milliseconds to wait in each XREAD call, by default None
+        Number of milliseconds to wait for new entries when all of a
+        stream's entries have been read, by default None (do not wait). If
+        no entries arrive in time, fewer than `count` items are returned.
+    window : int, optional
+        Maximum number of entries fetched from a stream at once, by
+        default 100
+    return_discarded : bool, optional
+        Also return the number of entries of each stream that were skipped
+        because they had no match in the other streams, by default False
+
     Returns
     -------
     out : list
         List of entries for each stream
+    discarded : dict
+        Number of discarded entries, keyed by stream name. Only returned
+        if return_discarded is True.
     """
     # Data type of the sync field
     dtype = np.dtype(sync_dtype)
 
-    # stream names and entry IDs
-    stream_names, entry_ids = zip(*streams.items())
-    entry_ids = list(entry_ids)
-
-    # Number of streams
+    stream_names = list(streams)
     n_streams = len(stream_names)
-    # Data from each stream
-    entry_data = [None] * n_streams
-    # Starting timestamps of each stream's entry. Used for synchronization.
-    t0 = np.zeros(n_streams, dtype=dtype)
+    stream_index = {
+        name.encode() if isinstance(name, str) else name: i
+        for i, name in enumerate(stream_names)
+    }
+
+    # ID of the last entry fetched from each stream
+    last_ids = []
+    for name in stream_names:
+        entry_id = streams[name]
+        if _to_str(entry_id) == '$':
+            last_entry = r.xrevrange(name, '+', '-', count=1)
+            entry_id = last_entry[0][0] if last_entry else '0-0'
+        last_ids.append(entry_id)
+
+    # entries fetched from each stream and their sync values, starting
+    # from the first entry that has not been used or discarded (the head)
+    buffers = [[] for _ in range(n_streams)]
+    sync_vals = [np.empty(0, dtype=dtype) for _ in range(n_streams)]
+    heads = [0] * n_streams
+    discarded = [0] * n_streams
+
+    def add_entries(i_s, entries):
+        if not entries:
+            return
+        last_ids[i_s] = entries[-1][0]
+        vals = np.frombuffer(b''.join(
+            entry_data[sync_field][:dtype.itemsize]
+            for _, entry_data in entries),
+                             dtype=dtype)
+        buffers[i_s] = buffers[i_s][heads[i_s]:] + entries
+        sync_vals[i_s] = np.concatenate((sync_vals[i_s][heads[i_s]:], vals))
+        heads[i_s] = 0
 
     # Initialize the synchronized output
-    out = [[name, [None] * count] for name in stream_names]
+    out = [[name, []] for name in stream_names]
 
-    for i_c in range(count):
-        # Block for entries from multiple streams at once. Return when all
-        # streams have new values.
-        p = self.pipeline(transaction=False)
-        for i_s in range(n_streams):
-            p.xread({stream_names[i_s]: entry_ids[i_s]}, block=block, count=1)
-        replies = p.execute()
+    while len(out[0][1]) < count:
+        empty = [i_s for i_s in range(n_streams)
+                 if heads[i_s] == len(buffers[i_s])]
+        if empty:
+            # fetch the next window of every stream that has run out
+            p = r.pipeline(transaction=False)
+            for i_s in empty:
+                p.xrange(stream_names[i_s],
+                         min='(' + _to_str(last_ids[i_s]),
+                         max='+',
+                         count=window)
+            for i_s, entries in zip(empty, p.execute()):
+                add_entries(i_s, entries)
 
-        # Get timestamps from both streams
-        for i_s in range(n_streams):
-            reply = replies[i_s][0]
-            entry_ids[i_s], entry_data[i_s] = reply[1][0]
-            sync_val = entry_data[i_s][sync_field][:dtype.itemsize]
-            t0[i_s] = np.frombuffer(sync_val, dtype=dtype)[0]
-
-        # Synchronize the streams by reading the next entry in the lagging
-        # stream until it matches the leading stream.
-        while np.min(t0) < np.max(t0):
-            # repeat until all timestamps match (if there are more than 2)
-            i_min = np.argmin(t0)  # index of the lagging stream
-            i_max = np.argmax(t0)  # index of the leading stream
-            while t0[i_min] < t0[i_max]:
-                # repeat until the minimum and maximum timestamps match
-                replies = self.xread({stream_names[i_min]: entry_ids[i_min]},
-                                     block=block,
-                                     count=1)
-                entry_ids[i_min], entry_data[i_min] = replies[0][1][0]
-                sync_val = entry_data[i_min][sync_field][:dtype.itemsize]
-                t0[i_min] = np.frombuffer(sync_val, dtype=dtype)[0]
-
-        # save the output
+            empty = [i_s for i_s in empty if heads[i_s] == len(buffers[i_s])]
+            if empty:
+                # wait for new entries in the streams that are still empty
+                replies = r.xread(
+                    {stream_names[i_s]: last_ids[i_s] for i_s in empty},
+                    count=window,
+                    block=block)
+                if not replies:
+                    break
+                for name, entries in replies:
+                    add_entries(stream_index[name], entries)
+            continue
+
+        # Synchronize the streams by skipping the entries of the lagging
+        # streams that precede the leading stream's sync value
+        target = max(sync_vals[i_s][heads[i_s]] for i_s in range(n_streams))
+        aligned = True
         for i_s in range(n_streams):
-            out[i_s][1][i_c] = (entry_ids[i_s], entry_data[i_s])
+            head = heads[i_s]
+            i_match = head + int(np.searchsorted(sync_vals[i_s][head:], target))
+            discarded[i_s] += i_match - head
+            heads[i_s] = i_match
+            if (i_match == len(buffers[i_s])
+                    or sync_vals[i_s][i_match] != target):
+                aligned = False
+
+        if aligned:
+            # save the output
+            for i_s in range(n_streams):
+                out[i_s][1].append(buffers[i_s][heads[i_s]])
+                heads[i_s] += 1
 
+    if return_discarded:
+        return out, dict(zip(stream_names, discarded))
     return out  # Return the synchronized output
 
+def multi_stream_iter(r,
+                      streams,
+                      count=100,
+                      block=1000,
+                      latest_only=False,
+                      codecs=None,
+                      cursor_key=None,
+                      stop_event=None,
+                      idle_timeout_ms=None,
+                      reconnect_delay=1):
+    """
+    Lazily read new entries from multiple streams
+
+    Each batch of entries read from a stream is yielded as soon as it is
+    read, so unbounded streams can be consumed in constant memory.
+
+    Parameters
+    ----------
+    r : redis.Redis
+        instance of the redis.Redis interface
+    streams : dict
+        dict of stream names to stream IDs, where IDs indicate the last ID
+        already seen. '$' (the latest entry) and '0-0' (the first entry)
+        are also accepted.
+    count : int, optional
+        Maximum number of entries read from each stream at once, by
+        default 100
+    block : int, optional
+        Number of milliseconds to wait in each XREAD call, by default 1000
+    latest_only : bool, optional
+        Only deliver the latest entry of each stream, skipping the entries
+        that were added since the previous one was delivered, by default
+        False (deliver every entry)
+    codecs : dict, optional
+        StreamCodec for each stream, keyed by stream name. The entries of
+        these streams are decoded into one array per batch.
+    cursor_key : str, optional
+        Key of a Redis hash in which the ID of the last entry delivered
+        from each stream is stored, so that a restarted reader resumes
+        where it stopped. Stored IDs take precedence over the IDs in
+        `streams`.
+    stop_event : threading.Event, optional
+        Stop iterating once this event is set
+    idle_timeout_ms : int, optional
+        Stop iterating when no entries arrive for this many milliseconds,
+        by default None (never)
+    reconnect_delay : float, optional
+        Time (in seconds) to wait before retrying after a connection error,
+        by default 1
+
+    Yields
+    ------
+    stream : str or bytes
+        Name of the stream, as given in `streams`
+    entries : list or tuple
+        List of (entry_id, entry_dict) tuples or, for streams with a codec,
+        a tuple of (entry_ids, samples), where samples has shape
+        (len(entry_ids), chans, samps)
+    """
+    stream_names = list(streams)
+    names = {
+        name.encode() if isinstance(name, str) else name: name
+        for name in stream_names
+    }
+    codecs = codecs or {}
+
+    last_ids = dict(streams)
+    if cursor_key is not None:
+        cursors = r.hgetall(cursor_key)
+        for key, name in names.items():
+            if key in cursors:
+                last_ids[name] = cursors[key]
+    for name in stream_names:
+        if _to_str(last_ids[name]) == '$':
+            last_entry = r.xrevrange(name, '+', '-', count=1)
+            last_ids[name] = last_entry[0][0] if last_entry else '0-0'
+
+    idle_since = time.monotonic()
+    while stop_event is None or not stop_event.is_set():
+        try:
+            if latest_only:
+                p = r.pipeline(transaction=False)
+                for name in stream_names:
+                    p.xrevrange(name,
+                                '+',
+                                '(' + _to_str(last_ids[name]),
+                                count=1)
+                replies = [(name, entries)
+                           for name, entries in zip(stream_names, p.execute())
+                           if entries]
+                if not replies:
+                    # wait for a new entry, then get the latest one
+                    if r.xread(last_ids, count=1, block=block):
+                        continue
+            else:
+                replies = [(names[name], entries) for name, entries in
+                           r.xread(last_ids, count=count, block=block)]
+        except (redis.exceptions.ConnectionError,
+                redis.exceptions.TimeoutError) as exc:
+            logging.warning(f'Lost connection to Redis ({exc}), retrying in '
+                            f'{reconnect_delay} s')
+            time.sleep(reconnect_delay)
+            continue
+
+        if not replies:
+            if (idle_timeout_ms is not None and
+                (time.monotonic() - idle_since) * 1000 >= idle_timeout_ms):
+                return
+            continue
+        idle_since = time.monotonic()
+
+        for name, entries in replies:
+            last_ids[name] = entries[-1][0]
+            if name in codecs:
+                entry_ids = [entry_id for entry_id, _ in entries]
+                yield name, (entry_ids, codecs[name].decode_entries(entries))
+            else:
+                yield name, entries
+            if cursor_key is not None:
+                r.hset(cursor_key, name, last_ids[name])
+
+
+def stream_iter(r, stream, start_id='$', codec=None, batches=False, **kwargs):
+    """
+    Lazily read new entries from a stream
+
+    Parameters
+    ----------
+    r : redis.Redis
+        instance of the redis.Redis interface
+    stream : str or bytes
+        Name of the stream
+    start_id : str or bytes, optional
+        ID of the last entry already seen, by default '$' (only entries
+        added from now on)
+    codec : StreamCodec, optional
+        Codec used to decode the entries into one array per batch
+    batches : bool, optional
+        Yield the list of entries read in each XREAD call instead of one
+        entry at a time, by default False. Always True with a codec.
+    **kwargs
+        count, block, latest_only, cursor_key, stop_event,
+        idle_timeout_ms and reconnect_delay, as in multi_stream_iter()
+
+    Yields
+    ------
+    entry : tuple
+        (entry_id, entry_dict) tuple or, if batches is True, a list of them,
+        or, with a codec, a tuple of (entry_ids, samples)
+    """
+    codecs = {stream: codec} if codec is not None else None
+    for _, entries in multi_stream_iter(r, {stream: start_id},
+                                        codecs=codecs,
+                                        **kwargs):
+        if batches or codec is not None:
+            yield entries
+        else:
+            yield from entries
+
+
+def get_parameters(r, nickname):
+    """
+    Read the parameters of a single node or derivative from the supergraph
+    index maintained by the supervisor
+
+    Parameters
+    ----------
+    r : redis.Redis
+        instance of the redis.Redis interface
+    nickname : str
+        Nickname of the node or derivative
+
+    Returns
+    -------
+    supergraph_id : str
+        ID of the supergraph_stream entry the parameters were taken from,
+        or None if no supergraph has been indexed
+    parameters : dict
+        The node's parameters, or None if the nickname is not in the
+        supergraph
+    """
+    p = r.pipeline()  # read the ID and parameters atomically
+    p.get('supergraph_id')
+    p.hget('supergraph_parameters', nickname)
+    supergraph_id, parameters = p.execute()
+
+    if supergraph_id is None:
+        return None, None
+
+    supergraph_id = supergraph_id.decode('utf-8')
+    if parameters is not None:
+        parameters = json.loads(parameters)
+    return supergraph_id, parameters
+
+
 class RedisLoggingHandler(logging.Handler):
     """
     Send `logging` messages to a particular stream in Redis. (This stream can then be
     read from and displayed in a custom GUI, for example.)
+
+    Records are formatted by emit(), so that their arguments are rendered
+    before they can change, and added to the stream by a background thread
+    in pipelined batches, so logging does not add a Redis round trip to the
+    caller's thread. When the queue is full, the oldest records are dropped.
+    If max_rate is given, records beyond max_rate per second from the same
+    logger are also dropped. The number of dropped records is reported in
+    the stream.
     """
 
     LOG_STREAM_NAME = "console_logging"
 
-    def __init__(self, redis_conn, name):
+    def __init__(self,
+                 redis_conn,
+                 name,
+                 max_queue=10000,
+                 batch_size=100,
+                 max_rate=None,
+                 maxlen=10000):
+        """
+        Parameters
+        ----------
+        redis_conn : redis.Redis
+            Redis connection
+        name : str
+            Name of the process, included in each message
+        max_queue : int, optional
+            Maximum number of records waiting to be sent, by default 10000
+        batch_size : int, optional
+            Maximum number of records sent in one pipeline, by default 100
+        max_rate : float, optional
+            Maximum rate (in records per second) of records from each
+            logger, by default None (no rate limiting)
+        maxlen : int, optional
+            Approximate maximum length of the console_logging stream, by
+            default 10000. None disables trimming.
+        """
         logging.Handler.__init__(self)
 
         self.redis_conn = redis_conn
+        self.nickname = name
+        self.batch_size = batch_size
+        self.max_rate = max_rate
+        self.maxlen = maxlen
 
         self.setFormatter(
             logging.Formatter(
@@ -142,12 +443,112 @@ class RedisLoggingHandler(logging.Handler):
             )
         )
 
+        self.queue = collections.deque(maxlen=max_queue)
+        self.queue_cond = threading.Condition()
+        self.buckets = {}  # per-logger (tokens, time) for rate limiting
+        self.dropped = 0  # records dropped because the queue was full
+        self.rate_limited = 0  # records dropped by rate limiting
+        self.n_reported = (0, 0)
+        self.sending = False
+        self.closing = False
+        self.thread = None
+
+    def _allow(self, source, now):
+        """
+        Token bucket allowing max_rate records per second from each source
+        """
+        tokens, last = self.buckets.get(source, (self.max_rate, now))
+        tokens = min(self.max_rate, tokens + (now - last) * self.max_rate)
+        allowed = tokens >= 1
+        self.buckets[source] = (tokens - 1 if allowed else tokens, now)
+        return allowed
+
     def emit(self, record):
         try:
             msg = self.format(record)
-            self.redis_conn.xadd(self.LOG_STREAM_NAME, {"message": msg})
+        except Exception:
+            self.handleError(record)
+            return
+        with self.queue_cond:
+            if self.closing:
+                return
+            if self.max_rate is not None and not self._allow(
+                    record.name, record.created):
+                self.rate_limited += 1
+                return
+            if len(self.queue) == self.queue.maxlen:
+                self.dropped += 1  # the oldest record is dropped
+            self.queue.append(msg)
+            if self.thread is None:
+                self.thread = threading.Thread(target=self._send_forever,
+                                               name=f'{self.nickname}_logging',
+                                               daemon=True)
+                self.thread.start()
+            self.queue_cond.notify()
+
+    def _send_forever(self):
+        while True:
+            with self.queue_cond:
+                while not self.queue and not self.closing:
+                    self.queue_cond.wait()
+                if not self.queue and self.closing:
+                    return
+                batch = [
+                    self.queue.popleft()
+                    for _ in range(min(self.batch_size, len(self.queue)))
+                ]
+                self.sending = True
+                n_dropped = (self.dropped, self.rate_limited)
+            try:
+                self._send(batch, n_dropped)
+            finally:
+                with self.queue_cond:
+                    self.sending = False
+                    self.queue_cond.notify_all()
+
+    def _send(self, batch, n_dropped):
+        messages = list(batch)
+        if n_dropped != self.n_reported:
+            record = logging.makeLogRecord({
+                'levelname': 'WARNING',
+                'levelno': logging.WARNING,
+                'msg': f'Dropped {n_dropped[0] - self.n_reported[0]} log '
+                       'records because the queue was full and '
+                       f'{n_dropped[1] - self.n_reported[1]} because of '
+                       'rate limiting',
+            })
+            messages.append(self.format(record))
+            self.n_reported = n_dropped
+
+        p = self.redis_conn.pipeline(transaction=False)
+        for msg in messages:
+            p.xadd(self.LOG_STREAM_NAME, {"message": msg},
+                   maxlen=self.maxlen,
+                   approximate=True)
+        try:
+            p.execute()
         except redis.exceptions.ConnectionError:
             # If not connected to redis, that's ok, just do nothing.
             pass
-        except:
-            self.handleError(record)
+        except Exception:
+            self.handleError(logging.makeLogRecord({'msg': messages[-1]}))
+
+    def flush(self, timeout=1):
+        """
+        Wait for up to timeout seconds for the queued records to be sent
+        """
+        with self.queue_cond:
+            self.queue_cond.wait_for(
+                lambda: not (self.queue or self.sending) or self.thread is None,
+                timeout=timeout)
+
+    def close(self):
+        """
+        Send the queued records and stop the background thread
+        """
+        with self.queue_cond:
+            self.closing = True
+            self.queue_cond.notify_all()
+        if self.thread is not None:
+            self.thread.join(timeout=1)
+        logging.Handler.close(self)
@@ -0,0 +1,314 @@
+"""
+Replay recorded streams into a live graph with their original timing
+
+The recorded streams are read from a source Redis instance, which can be
+started from a saved RDB file, and are added to the live Redis instance in
+the order and at the pace at which they were originally written, so that a
+graph can be tested in closed loop on the data of a previous session.
+
+Usage:
+    python -m brand.replay --rdb path/to/session.rdb -s stream1 stream2
+    python -m brand.replay --src-port 6380 -s stream1 --speed 2
+"""
+import argparse
+import heapq
+import logging
+import os
+import subprocess
+import sys
+import time
+
+from redis import Redis
+
+from .timing import LatencyHistogram, clock_nanosleep
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_REDIS_IP = '127.0.0.1'
+DEFAULT_REDIS_PORT = 6379
+DEFAULT_SOURCE_PORT = 6380
+
+
+def _entry_time_ns(entry_id, entry_data, time_field):
+    """
+    Time at which an entry was written: its monotonic time key if
+    time_field is given and the entry has it, or the millisecond part of
+    its ID (wall-clock time) otherwise
+    """
+    if time_field is not None and time_field in entry_data:
+        return int.from_bytes(entry_data[time_field][:8], sys.byteorder)
+    return int(entry_id.split(b'-')[0]) * 1_000_000
+
+
+class StreamReplay():
+    """
+    Re-add the entries of recorded streams to a live Redis instance with
+    their original inter-entry timing
+
+    Parameters
+    ----------
+    src : redis.Redis
+        Connection to the Redis instance holding the recorded streams
+    dst : redis.Redis
+        Connection to the live Redis instance
+    streams : list
+        Names of the streams to replay
+    speed : float, optional
+        Replay speed relative to the original timing, e.g. 1 (default) for
+        real time or 2 for twice as fast. 0 replays as fast as possible.
+    start : str or int, optional
+        ID (or time in milliseconds) of the first entry to replay
+    end : str or int, optional
+        ID (or time in milliseconds) of the last entry to replay
+    prefix : str, optional
+        Prefix added to the name of each replayed stream, by default ''
+    time_field : bytes, optional
+        Field holding the monotonic timestamp (uint64 nanoseconds) of each
+        entry, by default b'ts'. The entries are paced by it if every
+        stream has it, or by their IDs otherwise. If restamp is True, it is
+        replaced with the time at which the entry is replayed.
+    restamp : bool, optional
+        Replace the time key of each entry, by default True
+    chunk_size : int, optional
+        Number of entries read from each stream, and sent to the live
+        instance, at a time, by default 1000
+    """
+
+    def __init__(self,
+                 src,
+                 dst,
+                 streams,
+                 speed=1,
+                 start='-',
+                 end='+',
+                 prefix='',
+                 time_field=b'ts',
+                 restamp=True,
+                 chunk_size=1000):
+        self.src = src
+        self.dst = dst
+        self.streams = streams
+        self.speed = speed
+        self.start = start
+        self.end = end
+        self.prefix = prefix
+        self.time_field = time_field
+        self.restamp = restamp
+        self.chunk_size = chunk_size
+        # field the entries are ordered and paced by, or None for entry IDs
+        self.time_base = time_field
+        # lateness of each entry relative to its deadline
+        self.error = LatencyHistogram()
+
+    def read_stream(self, stream):
+        """
+        Iterate over the entries of a recorded stream, one chunk at a time
+
+        Yields
+        ------
+        tuple
+            (time_ns, stream, entry_id, entry_data)
+        """
+        start = str(self.start)
+        time_ns = None
+        while True:
+            entries = self.src.xrange(stream,
+                                      min=start,
+                                      max=self.end,
+                                      count=self.chunk_size)
+            for entry_id, entry_data in entries:
+                # entries missing the time key keep the previous entry's
+                # time rather than mixing wall-clock and monotonic times
+                if self.time_base is None or self.time_field in entry_data:
+                    time_ns = _entry_time_ns(entry_id, entry_data,
+                                             self.time_base)
+                yield time_ns, stream, entry_id, entry_data
+            if len(entries) < self.chunk_size:
+                return
+            start = '(' + entries[-1][0].decode()
+
+    def _send(self, p, deadlines):
+        """
+        Execute the queued XADDs and record how late they were sent
+        relative to their deadlines
+        """
+        if len(p):
+            p.execute()
+        now_ns = time.monotonic_ns()
+        for deadline_ns in deadlines:
+            self.error.add(now_ns - deadline_ns)
+        deadlines.clear()
+
+    def select_time_base(self):
+        """
+        Pick one time base for all streams: the time key if the first entry
+        of every stream has one, or entry IDs otherwise, since monotonic
+        and wall-clock times cannot be merged
+
+        Returns
+        -------
+        bytes or None
+            The time field, or None to use entry IDs
+        """
+        has_time_key = {}
+        for stream in self.streams:
+            first = self.src.xrange(stream,
+                                    min=str(self.start),
+                                    max=self.end,
+                                    count=1)
+            has_time_key[stream] = bool(first) and self.time_field in first[0][1]
+        if all(has_time_key.values()):
+            return self.time_field
+        if any(has_time_key.values()):
+            missing = [s for s, has in has_time_key.items() if not has]
+            logger.warning(f'{missing} have no {self.time_field.decode()} '
+                           'time key, so all streams are replayed using '
+                           'their entry IDs (millisecond resolution)')
+        return None
+
+    def run(self):
+        """
+        Replay the streams
+
+        Returns
+        -------
+        dict
+            Number of entries replayed, duration of the replay and summary
+            of the timing error (in nanoseconds) relative to the original
+            schedule
+        """
+        self.time_base = self.select_time_base()
+        # merge the streams in the order their entries were written
+        entries = heapq.merge(*[self.read_stream(s) for s in self.streams],
+                              key=lambda entry: entry[0])
+
+        n_entries = 0
+        t0_orig = None
+        t0_ns = time.monotonic_ns()
+        p = self.dst.pipeline(transaction=False)
+        deadlines = []  # of the entries queued in the pipeline
+        for time_ns, stream, _, entry_data in entries:
+            if t0_orig is None:
+                t0_orig = time_ns
+            if self.speed:
+                deadline_ns = t0_ns + int((time_ns - t0_orig) / self.speed)
+                if time.monotonic_ns() < deadline_ns:
+                    # send the entries that are due before sleeping
+                    self._send(p, deadlines)
+                    clock_nanosleep(deadline_ns, clock=time.CLOCK_MONOTONIC)
+                deadlines.append(deadline_ns)
+            if self.restamp:
+                entry_data[self.time_field] = time.monotonic_ns().to_bytes(
+                    8, sys.byteorder)
+            p.xadd(self.prefix + stream, entry_data)
+            n_entries += 1
+            if len(p) >= self.chunk_size:
+                # bound the pipeline when replaying behind schedule or
+                # as fast as possible
+                self._send(p, deadlines)
+        self._send(p, deadlines)
+
+        return {
+            'entries': n_entries,
+            'duration_s': (time.monotonic_ns() - t0_ns) / 1e9,
+            **{f'error_{k}': v for k, v in self.error.summary().items()},
+        }
+
+
+def start_source_server(rdb_path, port=DEFAULT_SOURCE_PORT):
+    """
+    Start a redis-server that loads a saved RDB file, without saving back
+    to it
+
+    Returns
+    -------
+    proc : subprocess.Popen
+        The redis-server process
+    r : redis.Redis
+        Connection to it, once the RDB file has been loaded
+    """
+    rdb_dir, rdb_file = os.path.split(os.path.abspath(rdb_path))
+    proc = subprocess.Popen([
+        'redis-server', '--port', str(port), '--dir', rdb_dir,
+        '--dbfilename', rdb_file, '--save', '', '--appendonly', 'no'
+    ], stdout=subprocess.DEVNULL)
+    r = Redis(DEFAULT_REDIS_IP, port)
+    while True:
+        if proc.poll() is not None:
+            raise RuntimeError(f'redis-server could not load {rdb_path} on '
+                               f'port {port}, which may already be in use')
+        try:
+            info = r.info()
+        except Exception:
+            info = None
+        if info is not None and info['process_id'] != proc.pid:
+            # another server is answering on the port
+            proc.terminate()
+            proc.wait()
+            raise RuntimeError(f'Port {port} is already used by another '
+                               'redis-server, choose another --src-port')
+        if info is not None and not info['loading']:
+            return proc, r
+        time.sleep(.1)
+
+
+def main():
+    ap = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    ap.add_argument('-s', '--streams', nargs='+', required=True,
+                    help='streams to replay')
+    ap.add_argument('-i', '--host', default=DEFAULT_REDIS_IP,
+                    help='ip address of the live redis server'
+                    f' (default: {DEFAULT_REDIS_IP})')
+    ap.add_argument('-p', '--port', type=int, default=DEFAULT_REDIS_PORT,
+                    help='port of the live redis server'
+                    f' (default: {DEFAULT_REDIS_PORT})')
+    ap.add_argument('--rdb', help='RDB file holding the recorded streams')
+    ap.add_argument('--src-host', default=DEFAULT_REDIS_IP,
+                    help='ip address of the redis server holding the'
+                    ' recorded streams, if no RDB file is given')
+    ap.add_argument('--src-port', type=int, default=DEFAULT_SOURCE_PORT,
+                    help='port of the redis server holding the recorded'
+                    f' streams (default: {DEFAULT_SOURCE_PORT})')
+    ap.add_argument('--speed', type=float, default=1,
+                    help='replay speed, e.g. 1 for real time (default) or'
+                    ' 0 for as fast as possible')
+    ap.add_argument('--start', default='-',
+                    help='ID or millisecond time of the first entry')
+    ap.add_argument('--end', default='+',
+                    help='ID or millisecond time of the last entry')
+    ap.add_argument('--prefix', default='',
+                    help='prefix added to the replayed stream names')
+    ap.add_argument('--no-restamp', action='store_true',
+                    help='keep the original time keys')
+    args = ap.parse_args()
+
+    logging.basicConfig(format='[replay] %(levelname)s: %(message)s',
+                        level=logging.INFO)
+    src_proc = None
+    if args.rdb:
+        src_proc, src = start_source_server(args.rdb, args.src_port)
+    else:
+        src = Redis(args.src_host, args.src_port)
+    dst = Redis(args.host, args.port)
+
+    try:
+        replay = StreamReplay(src,
+                              dst,
+                              args.streams,
+                              speed=args.speed,
+                              start=args.start,
+                              end=args.end,
+                              prefix=args.prefix,
+                              restamp=not args.no_restamp)
+        logger.info(f'Replaying {args.streams} at {args.speed or "max"}x')
+        report = replay.run()
+        dst.xadd('replay_status', report)
+        logger.info(f'Replay done: {report}')
+    finally:
+        if src_proc is not None:
+            src_proc.terminate()
+            src_proc.wait()
+
+
+if __name__ == '__main__':
+    main()
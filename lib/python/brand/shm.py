@@ -0,0 +1,276 @@
+"""
+Shared-memory payload transport for co-located producers and consumers
+
+Payloads are written to a ring buffer of fixed-size slots in POSIX shared
+memory (/dev/shm/<name>), and the Redis stream entry only carries a
+descriptor of where the payload is. Consumers on the same machine read the
+payload as a numpy view without copying it, and consumers on other machines
+can fall back to a copy of the payload written inline in the entry.
+
+Memory layout (all integers are native-endian, as in brand.h):
+
+    header (64 bytes): uint32 magic, uint32 version, uint32 n_slots,
+                       uint32 slot_size, uint64 write_seq
+    n_slots x slot:    uint64 seq, padding up to 64 bytes, payload
+                       (slot_size bytes, padded to a multiple of 64)
+
+A slot's seq is set to 0 while it is being written and to the sequence
+number of its payload (starting at 1) once the write is complete.
+"""
+import mmap
+import os
+import time
+
+import numpy as np
+
+SHM_DIR = '/dev/shm'
+SHM_MAGIC = 0x48535242  # 'BRSH'
+SHM_VERSION = 1
+HEADER_SIZE = 64
+SLOT_HEADER_SIZE = 64
+# seconds between attempts to map a ring that was not available yet
+RETRY_INTERVAL_S = 0.1
+
+_header_dtype = np.dtype([('magic', np.uint32), ('version', np.uint32),
+                          ('n_slots', np.uint32), ('slot_size', np.uint32),
+                          ('write_seq', np.uint64)])
+
+
+def _slot_stride(slot_size):
+    return SLOT_HEADER_SIZE + -(-slot_size // 64) * 64
+
+
+class ShmRing():
+    """
+    Ring buffer of payload slots in POSIX shared memory
+
+    Parameters
+    ----------
+    name : str
+        Name of the shared memory object, e.g. the name of the stream
+    slot_size : int, optional
+        Maximum size (in bytes) of each payload. Required when creating.
+    n_slots : int, optional
+        Number of slots in the ring. Required when creating. Consumers
+        must read each payload before n_slots newer payloads are written.
+    create : bool, optional
+        True for the producer, which creates (or resizes) the shared
+        memory, and False (default) for consumers, which map it read-only
+    """
+
+    def __init__(self, name, slot_size=None, n_slots=None, create=False):
+        self.name = name.lstrip('/')
+        self.path = os.path.join(SHM_DIR, self.name)
+        self.writable = create
+
+        if create:
+            if slot_size is None or n_slots is None:
+                raise ValueError('slot_size and n_slots are required to '
+                                 'create a shared memory ring')
+            size = HEADER_SIZE + n_slots * _slot_stride(slot_size)
+            fd = os.open(self.path, os.O_CREAT | os.O_RDWR, 0o600)
+            try:
+                os.ftruncate(fd, size)
+                self.mm = mmap.mmap(fd, size)
+            finally:
+                os.close(fd)
+            self.header = np.frombuffer(self.mm, _header_dtype, count=1)
+            self.header['write_seq'] = 0
+            self.header['n_slots'] = n_slots
+            self.header['slot_size'] = slot_size
+            self.header['version'] = SHM_VERSION
+            self.header['magic'] = SHM_MAGIC
+        else:
+            fd = os.open(self.path, os.O_RDONLY)
+            try:
+                size = os.fstat(fd).st_size
+                self.mm = mmap.mmap(fd, size, prot=mmap.PROT_READ)
+            finally:
+                os.close(fd)
+            self.header = np.frombuffer(self.mm, _header_dtype, count=1)
+            if (self.header['magic'][0] != SHM_MAGIC
+                    or self.header['version'][0] != SHM_VERSION):
+                raise ValueError(f'{self.path} is not a BRAND shared memory ring')
+
+        self.n_slots = int(self.header['n_slots'][0])
+        self.slot_size = int(self.header['slot_size'][0])
+        self.stride = _slot_stride(self.slot_size)
+        # sequence number of each slot, as a view of the shared memory
+        self.slot_seqs = np.ndarray((self.n_slots, ),
+                                    dtype=np.uint64,
+                                    buffer=self.mm,
+                                    offset=HEADER_SIZE,
+                                    strides=(self.stride, ))
+
+    def _payload_offset(self, slot):
+        return HEADER_SIZE + slot * self.stride + SLOT_HEADER_SIZE
+
+    def write(self, payload):
+        """
+        Copy a payload into the next slot
+
+        Parameters
+        ----------
+        payload : bytes-like or numpy.ndarray
+            Payload of at most slot_size bytes
+
+        Returns
+        -------
+        slot : int
+            Index of the slot the payload was written to
+        seq : int
+            Sequence number of the payload
+        nbytes : int
+            Size of the payload in bytes
+        """
+        data = memoryview(np.ascontiguousarray(payload)).cast('B')
+        nbytes = data.nbytes
+        if nbytes > self.slot_size:
+            raise ValueError(f'Payload of {nbytes} bytes does not fit in '
+                             f'slots of {self.slot_size} bytes')
+
+        seq = int(self.header['write_seq'][0]) + 1
+        slot = (seq - 1) % self.n_slots
+        offset = self._payload_offset(slot)
+
+        self.slot_seqs[slot] = 0  # mark the slot as being written
+        self.mm[offset:offset + nbytes] = data
+        self.slot_seqs[slot] = seq
+        self.header['write_seq'] = seq
+        return slot, seq, nbytes
+
+    def view(self, slot, seq, nbytes, dtype=np.uint8):
+        """
+        Get a read-only view of a payload, without copying it
+
+        Since the slot can be overwritten once n_slots newer payloads have
+        been written, call is_valid() after using the view if the consumer
+        may fall that far behind.
+
+        Returns
+        -------
+        numpy.ndarray or None
+            1D view of the payload, or None if the slot no longer holds
+            the payload with this sequence number
+        """
+        if self.slot_seqs[slot] != seq:
+            return None
+        dtype = np.dtype(dtype)
+        arr = np.frombuffer(self.mm,
+                            dtype=dtype,
+                            count=nbytes // dtype.itemsize,
+                            offset=self._payload_offset(slot))
+        arr.flags.writeable = False
+        return arr
+
+    def is_valid(self, slot, seq):
+        """
+        Check whether a slot still holds the payload with sequence number seq
+        """
+        return self.slot_seqs[slot] == seq
+
+    def entry(self, payload, field=b'samples', inline=False):
+        """
+        Write a payload and build the stream entry that describes it
+
+        Parameters
+        ----------
+        payload : bytes-like or numpy.ndarray
+            Payload of at most slot_size bytes
+        field : bytes, optional
+            Field of the entry that the payload belongs to
+        inline : bool, optional
+            Also store a copy of the payload in the entry, for consumers
+            on other machines. By default False.
+
+        Returns
+        -------
+        dict
+            Entry data to pass to BRANDNode.writeOutput() or XADD
+        """
+        slot, seq, nbytes = self.write(payload)
+        entry = {
+            b'shm': self.name,
+            b'shm_slot': slot,
+            b'shm_seq': seq,
+            b'shm_nbytes': nbytes,
+        }
+        if inline:
+            entry[field] = memoryview(np.ascontiguousarray(payload)).cast('B')
+        return entry
+
+    def close(self):
+        """
+        Unmap the shared memory. Any views of it must be released first.
+        """
+        self.mm.close()
+
+    def unlink(self):
+        """
+        Remove the shared memory object (producer only)
+        """
+        os.unlink(self.path)
+
+
+class ShmReader():
+    """
+    Decode stream entries written with ShmRing.entry(), mapping each
+    producer's shared memory on first use and falling back to the inline
+    payload when the shared memory is not available on this machine. A
+    ring that is not available (yet) is looked for again at most every
+    RETRY_INTERVAL_S seconds, so that a reader started before its producer
+    attaches to the ring once it has been created.
+    """
+
+    def __init__(self):
+        self.rings = {}
+        self.next_retry = {}  # monotonic time of the next attempt per ring
+
+    def _get_ring(self, name):
+        ring = self.rings.get(name)
+        if ring is not None:
+            return ring
+        now = time.monotonic()
+        if now < self.next_retry.get(name, 0):
+            return None
+        try:
+            # a ring being created may still be empty or lack its header
+            ring = ShmRing(name)
+        except (FileNotFoundError, ValueError):
+            self.next_retry[name] = now + RETRY_INTERVAL_S
+            return None
+        self.rings[name] = ring
+        self.next_retry.pop(name, None)
+        return ring
+
+    def read(self, entry_data, field=b'samples', dtype=np.uint8):
+        """
+        Get the payload of an entry
+
+        Parameters
+        ----------
+        entry_data : dict
+            Entry data as returned by redis-py
+        field : bytes, optional
+            Field holding the inline payload, if any
+        dtype : numpy.dtype, optional
+            Data type of the payload, by default uint8
+
+        Returns
+        -------
+        numpy.ndarray or None
+            1D view of the payload, or None if it has been overwritten in
+            shared memory and there is no inline copy
+        """
+        if b'shm' in entry_data:
+            ring = self._get_ring(entry_data[b'shm'].decode())
+            if ring is not None:
+                payload = ring.view(int(entry_data[b'shm_slot']),
+                                    int(entry_data[b'shm_seq']),
+                                    int(entry_data[b'shm_nbytes']),
+                                    dtype=dtype)
+                if payload is not None:
+                    return payload
+        if field in entry_data:
+            return np.frombuffer(entry_data[field], dtype=dtype)
+        return None
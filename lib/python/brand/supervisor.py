@@ -3,7 +3,6 @@ import coloredlogs
 import json
 import logging
 import os
-import psutil
 import redis
 import signal
 import subprocess
@@ -18,9 +17,15 @@ from redis import Redis
 
 from threading import Event
 
+from .clock import ClockSync
 from .derivative import AutorunDerivatives, RunDerivative
 from .exceptions import (BooterError, CommandError, DerivativeError,
                          GraphError, NodeError, RedisError)
+from .host import (build_host_args, request_hosted_stops,
+                   wait_hosted_stops)
+from .process import (STOP_TIMEOUT, get_state_ids, report_shutdown,
+                      report_startup, start_processes, stop_processes,
+                      wait_until_ready)
 from .redis import RedisLoggingHandler
 
 logger = logging.getLogger(__name__)
@@ -71,6 +76,15 @@ class Supervisor:
 
         self.r.xadd("graph_status", {'status': self.state[5]})
 
+        self.clock_sync = ClockSync(
+            self.r,
+            machines=lambda: [machine for machine, status in list(self.booter_status_dict.items())
+                              if not status.endswith('Exiting')],
+            reference=self.machine,
+            interval=self.clock_sync_interval)
+        if self.clock_sync_interval > 0:
+            self.clock_sync.start()
+
         if self.graph_file is not None:
             self.load_graph(graph_dict)
 
@@ -132,6 +146,8 @@ class Supervisor:
         ap.add_argument("-a", "--redis-affinity", type=str, required=False, help="cpu affinity to use for the redis server")
         ap.add_argument("-l", "--log-level", default=logging.DEBUG, type=lambda x: getattr(logging, x.upper()), required=False, help="supervisor logging level")
         ap.add_argument("-d", "--data-dir", type=str, default=self.DEFAULT_DATA_DIR, required=False, help="root data directory for supervisor's save path")
+        ap.add_argument("--startup-timeout", type=float, default=10, required=False, help="seconds to wait for nodes to be initialized when starting a graph (default: 10)")
+        ap.add_argument("--clock-sync-interval", type=float, default=1, required=False, help="seconds between clock-offset estimates for each booter (default: 1, 0 to disable)")
         ap.add_argument(
             "--bind",
             type=str,
@@ -181,6 +197,8 @@ class Supervisor:
         self.machine = args.machine
         self.redis_priority = args.redis_priority
         self.redis_affinity = args.redis_affinity
+        self.clock_sync_interval = args.clock_sync_interval
+        self.startup_timeout = args.startup_timeout
 
         logger.setLevel(args.log_level)
 
@@ -384,9 +402,30 @@ class Supervisor:
                     bin_f = None
 
                 # Loading the nodes and graph into self.model dict
-                model["nodes"][n["nickname"]] = {}
-                model["nodes"][n["nickname"]].update(n)
-                model["nodes"][n["nickname"]]["binary"] = bin_f
+                replicas = int(n.get("replicas", 1))
+                if replicas > 1:
+                    # replicas share their inputs through a consumer group
+                    # named after the node
+                    for i_r in range(replicas):
+                        nickname = f'{n["nickname"]}_{i_r}'
+                        if nickname in model["nodes"]:
+                            raise NodeError(
+                                f"Duplicate node nicknames found: {nickname}",
+                                self.graph_name,
+                                nickname)
+                        model["nodes"][nickname] = {}
+                        model["nodes"][nickname].update(n)
+                        model["nodes"][nickname]["nickname"] = nickname
+                        model["nodes"][nickname]["replica_of"] = n["nickname"]
+                        model["nodes"][nickname]["binary"] = bin_f
+                        model["nodes"][nickname]["parameters"] = {
+                            **n.get("parameters", {}),
+                            "consumer_group": n["nickname"]
+                        }
+                else:
+                    model["nodes"][n["nickname"]] = {}
+                    model["nodes"][n["nickname"]].update(n)
+                    model["nodes"][n["nickname"]]["binary"] = bin_f
 
                 logger.info("%s is a valid node" % n["nickname"])                
 
@@ -489,7 +528,8 @@ class Supervisor:
         payload = {
             "data": model_pub
         }
-        self.r.xadd("supergraph_stream",payload)
+        supergraph_id = self.r.xadd("supergraph_stream",payload)
+        self.index_supergraph(supergraph_id)
         self.r.xadd("booter", {
                         'command': 'loadGraph',
                         'graph': model_pub,
@@ -498,8 +538,37 @@ class Supervisor:
         self.r.xadd("graph_status", {'status': self.state[4]}) # status 4 means graph is published
 
 
+    def index_supergraph(self, supergraph_id, p=None):
+        '''
+        Store the latest supergraph's ID and each node's and derivative's
+        parameters under their nickname, so that processes can fetch only
+        their own parameters without parsing the supergraph_stream
+        Args:
+            supergraph_id: ID of the supergraph_stream entry being indexed
+            p: transactional pipeline to queue the update in, to be
+                executed by the caller. By default, the update is executed
+                in its own transaction.
+        '''
+        parameters = {}
+        for group in ['nodes', 'derivatives']:
+            for nickname, info in self.model.get(group, {}).items():
+                parameters[nickname] = json.dumps(info.get('parameters', {}))
+
+        execute = p is None
+        if execute:
+            p = self.r.pipeline()  # update the ID and parameters atomically
+        p.delete("supergraph_parameters")
+        if parameters:
+            p.hset("supergraph_parameters", mapping=parameters)
+        p.set("supergraph_id", supergraph_id)
+        if execute:
+            p.execute()
+
     def start_graph(self):
         ''' Start the graph '''
+        start_ns = time.monotonic_ns()
+        # only states posted after this point show that a node is ready
+        state_ids = get_state_ids(self.r, list(self.model["nodes"]))
         self.r.xadd("booter", {
                         'command': 'startGraph',
                         'graph': json.dumps(self.model),
@@ -510,6 +579,8 @@ class Supervisor:
         logger.info("Validation of the graph is successful")
         host = self.model["redis_host"]
         port = self.model["redis_port"]
+        host_groups = {}
+        commands = {}
         for node, node_info in self.model["nodes"].items():
             # specify defaults
             node_info.setdefault('root', True)
@@ -518,6 +589,12 @@ class Supervisor:
             if ('machine' not in node_info
                     or node_info["machine"] == self.machine):
 
+                if node_info.get('host_group'):
+                    # started below, in one process per host group
+                    host_groups.setdefault(node_info['host_group'],
+                                           {})[node] = node_info
+                    continue
+
                 binary = node_info["binary"]
 
                 logger.info("Binary for %s is %s" % (node,binary))
@@ -545,16 +622,56 @@ class Supervisor:
                     if affinity:  # if affinity is not None or empty
                         taskset_args = ['taskset', '-c', str(affinity)]
                         args = taskset_args + args
-                proc = subprocess.Popen(args)
-                proc.name = node
-                logger.info("Child process created with pid: %s" % proc.pid)
-                logger.info("Parent process is running and waiting for commands from redis")
-                self.parent = os.getpid()
-                logger.info("Parent Running on: %d" % os.getppid())
-                self.child_nodes[node] = proc
+                commands[node] = args
+
+        for group, node_cfgs in host_groups.items():
+            # host groups are keyed by tuples so they cannot clash with
+            # node nicknames
+            commands[(group, )] = build_host_args(group, node_cfgs, host,
+                                                  port, self.unixsocket,
+                                                  self.BRAND_BASE_DIR)
+
+        # launch all processes at once
+        procs, errors = start_processes(commands)
+        self.parent = os.getpid()
+        for name, proc in procs.items():
+            if isinstance(name, tuple):
+                group, = name
+                proc.name = group
+                proc.host_group = group
+                logger.info(f"Host process for {list(host_groups[group])} "
+                            f"created with pid: {proc.pid}")
+                for node in host_groups[group]:
+                    self.child_nodes[node] = proc
+            else:
+                proc.name = name
+                logger.info(f"Child process for {name} created with pid: "
+                            f"{proc.pid}")
+                self.child_nodes[name] = proc
+        if errors:
+            name, exc = next(iter(errors.items()))
+            name = name[0] if isinstance(name, tuple) else name
+            raise NodeError(f"Could not start {name}: {exc!r}",
+                            self.model['graph_name'], name) from exc
 
         self.checkBooter()
 
+        # wait for every node in the graph, including those started by
+        # booters, to report that it is initialized
+        ready, exited, pending = wait_until_ready(self.r,
+                                                  state_ids,
+                                                  procs=self.child_nodes,
+                                                  timeout=self.startup_timeout)
+        report_startup(self.r, self.machine, start_ns, ready, exited, pending,
+                       procs=self.child_nodes, log=logger)
+        if exited:
+            node, returncode = next(iter(exited.items()))
+            raise NodeError(f"{node} exited with code {returncode} before it"
+                            " was initialized", self.model['graph_name'], node)
+        if pending:
+            logger.warning(f"Nodes not initialized after "
+                           f"{self.startup_timeout} s: {pending}")
+
         # status 3 means graph is running and publishing data
         self.r.xadd("graph_status", {'status': self.state[3]})
 
@@ -666,60 +783,36 @@ class Supervisor:
         Kills child processes
         '''
 
-        def kill_proc_tree(pid, sig=signal.SIGTERM, include_parent=True):
-            """
-            Kill a process tree (including grandchildren) with signal "sig"
-            """
-            parent = psutil.Process(pid)
-            children = parent.children(recursive=False)
-            if include_parent:
-                children.append(parent)
-            for p in children:
-                try:
-                    p.send_signal(sig)
-                except psutil.NoSuchProcess:
-                    pass
-        
         if node_list is None:
             node_list = list(self.child_nodes.keys())
 
-        for node, proc in self.child_nodes.items():
-            if node in node_list:
-                try:
-                    # check if process exists
-                    os.kill(proc.pid, 0)
-                except OSError:
-                    self.logger.warning(f"'{node}' (pid: {proc.pid})"
-                                            " isn't running and may have crashed")
-                    self.child_nodes[node] = None
-                    node_list.remove(node)
-                else:
-                    # process is running
-                    # send SIGINT
-                    kill_proc_tree(proc.pid, signal.SIGINT)
-                    try:
-                        # check if it terminated
-                        proc.communicate(timeout=15)
-                    except subprocess.TimeoutExpired:
-                        self.logger.warning(f"Could not stop '{node}' "
-                                                f"(pid: {proc.pid}) using SIGINT")
-                        # if not, send SIGKILL
-                        kill_proc_tree(proc.pid, signal.SIGKILL)
-                        try:
-                            # check if it terminated
-                            proc.communicate(timeout=15)
-                        except subprocess.TimeoutExpired:
-                            pass  # delay error message until after the loop
-                        else:
-                            self.logger.info(f"Killed '{node}' "
-                                                f"(pid: {proc.pid}) using SIGKILL")
-                            self.child_nodes[node] = None
-                            node_list.remove(node)
-                    else:
-                        self.logger.info(f"Stopped '{node}' "
-                                            f"(pid: {proc.pid}) using SIGINT")
-                        self.child_nodes[node] = None
-                        node_list.remove(node)
+        # stop co-hosted nodes through their host if it has other nodes,
+        # and signal all other nodes at once, with a single deadline
+        deadline = time.monotonic() + STOP_TIMEOUT
+        state_ids, node_list = request_hosted_stops(self.r, self.child_nodes,
+                                                    node_list)
+        report = stop_processes(
+            {
+                node: self.child_nodes[node]
+                for node in node_list if node in self.child_nodes
+            },
+            timeout=deadline - time.monotonic(),
+            log=self.logger)
+        for node, info in report.items():
+            if info['status'] != 'running':
+                self.child_nodes[node] = None
+                node_list.remove(node)
+        report_shutdown(self.r, self.machine, report)
+
+        stopped, failed = wait_hosted_stops(self.r, state_ids, deadline)
+        for node in stopped:
+            self.logger.info(f"Stopped '{node}' through its host process")
+            self.child_nodes[node] = None
+        for node in failed:
+            self.logger.warning(f"'{node}' was not stopped by its host "
+                                "process, which keeps running other nodes")
+        # hosted nodes that could not be stopped are still running
+        node_list += failed
         # remove killed processes from self.children
         self.child_nodes = {
             n: p
@@ -831,8 +924,10 @@ class Supervisor:
 
     def update_params(self, new_params):
         '''
-        Updates parameters from an input dictionary
-        and writes a new supergraph
+        Updates parameters from an input dictionary,
+        publishes the changed parameters to each
+        <nickname>_parameters stream and writes a new
+        supergraph
 
         Parameters
         ----------
@@ -850,6 +945,16 @@ class Supervisor:
 
         # validate the new parameters
         if self.model:
+            # parameters of a replicated node apply to all of its replicas
+            for nickname in list(new_params):
+                replicas = [
+                    n for n, cfg in self.model["nodes"].items()
+                    if cfg.get("replica_of") == nickname.decode("utf-8")
+                ]
+                for replica in replicas:
+                    new_params[replica.encode()] = new_params[nickname]
+                if replicas:
+                    del new_params[nickname]
             for nickname in new_params:
                 nickname_decoded = nickname.decode("utf-8")
                 if nickname_decoded in self.model["nodes"] or nickname_decoded in self.model["derivatives"]:
@@ -871,6 +976,7 @@ class Supervisor:
                 self.graph_file)
 
         # if we make it out of the above loop without error, then the parameter update is valid, so overwrite the existing model
+        deltas = {}
         for nickname in new_params:
             nickname_decoded = nickname.decode("utf-8")
             nickname_params = json.loads(new_params[nickname].decode())
@@ -879,13 +985,23 @@ class Supervisor:
                     self.model["nodes"][nickname_decoded]["parameters"][param] = value
                 elif nickname_decoded in self.model["derivatives"]:
                     self.model["derivatives"][nickname_decoded]["parameters"][param] = value
+            deltas[nickname_decoded] = nickname_params
 
         # write the new supergraph
         model_pub = json.dumps(self.model)
         payload = {
             "data": model_pub
         }
-        self.r.xadd("supergraph_stream", payload)
+        supergraph_id = self.r.xadd("supergraph_stream", payload)
+        # index it and publish only the changed parameters to each node's
+        # own stream in one transaction, so that a node starting up either
+        # reads the new parameters from the index or gets the update
+        p = self.r.pipeline()
+        self.index_supergraph(supergraph_id, p)
+        for nickname, nickname_params in deltas.items():
+            p.xadd(f"{nickname}_parameters",
+                   {"data": json.dumps(nickname_params)})
+        p.execute()
         self.r.xadd("booter", {
                         'command': 'loadGraph',
                         'graph': model_pub,
@@ -1043,6 +1159,8 @@ class Supervisor:
         except Exception as exc:
             logger.warning(f"Could not kill autorun derivatives before exiting. Exiting anyway. {repr(exc)}")
 
+        self.clock_sync.stop_event.set()
+
         # attempt to post an exit message to Redis
         try:
             self.r.xadd("supervisor_status", {"status": "SIGINT received, Exiting"})
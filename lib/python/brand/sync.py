@@ -0,0 +1,396 @@
+"""
+Utilities for combining streams according to their sync labels (see
+doc/DataSyncGuidelines.md)
+"""
+import collections
+import heapq
+import json
+import sys
+import time
+
+import numpy as np
+
+
+class ReorderBuffer():
+    """
+    Restore the order of entries that were written out of order, e.g. by
+    the replicas of a node, according to one of their sync labels
+
+    Entries are held until the entry that follows the last released one
+    (according to `step`) arrives, until more than `window` entries are
+    held, or until they have been held for `max_delay_ms`, whichever comes
+    first. Entries that arrive after a later entry has been released are
+    released immediately and counted in n_late.
+    """
+
+    def __init__(self,
+                 label,
+                 step=None,
+                 window=64,
+                 max_delay_ms=100,
+                 sync_field=b'sync'):
+        """
+        Parameters
+        ----------
+        label : str
+            Name of the sync label to order the entries by, e.g. 'nsp_idx'
+        step : int, optional
+            Increment of the label between consecutive entries. If given,
+            an entry is released as soon as its predecessor has been.
+        window : int, optional
+            Maximum number of entries held, by default 64
+        max_delay_ms : float, optional
+            Maximum time (in milliseconds) an entry is held, by default 100
+        sync_field : bytes, optional
+            Field of the entries holding the sync labels, by default b'sync'
+        """
+        self.label = label
+        self.step = step
+        self.window = window
+        self.max_delay_ns = int(max_delay_ms * 1e6)
+        self.sync_field = sync_field
+
+        self.heap = []
+        self.n_added = 0  # tie-breaker for entries with the same label
+        # (added_ns, n_added) of held entries in arrival order, to find the
+        # oldest one without scanning the heap. Released entries are
+        # removed from the front lazily.
+        self.arrivals = collections.deque()
+        self.released = set()
+        self.last_label = None
+        self.n_late = 0
+
+    def add(self, entries):
+        """
+        Add entries and get the ones that can be released
+
+        Parameters
+        ----------
+        entries : list
+            (entry_id, entry_dict) tuples, as returned by XREAD
+
+        Returns
+        -------
+        list
+            (entry_id, entry_dict) tuples in sync order
+        """
+        now_ns = time.monotonic_ns()
+        out = []
+        for entry in entries:
+            label = json.loads(entry[1][self.sync_field])[self.label]
+            if self.last_label is not None and label < self.last_label:
+                self.n_late += 1
+                out.append(entry)
+                continue
+            heapq.heappush(self.heap, (label, self.n_added, now_ns, entry))
+            self.arrivals.append((now_ns, self.n_added))
+            self.n_added += 1
+        return out + self.release(now_ns)
+
+    def release(self, now_ns=None):
+        """
+        Get the held entries that can be released
+
+        Returns
+        -------
+        list
+            (entry_id, entry_dict) tuples in sync order
+        """
+        if now_ns is None:
+            now_ns = time.monotonic_ns()
+        out = []
+        while self.heap:
+            label, n_added, _, entry = self.heap[0]
+            while self.arrivals[0][1] in self.released:
+                self.released.remove(self.arrivals.popleft()[1])
+            oldest_ns = self.arrivals[0][0]
+            if not (len(self.heap) > self.window
+                    or now_ns - oldest_ns >= self.max_delay_ns
+                    or (self.step is not None and self.last_label is not None
+                        and label <= self.last_label + self.step)):
+                break
+            heapq.heappop(self.heap)
+            self.released.add(n_added)
+            self.last_label = label
+            out.append(entry)
+        return out
+
+    def flush(self):
+        """
+        Release all held entries
+
+        Returns
+        -------
+        list
+            (entry_id, entry_dict) tuples in sync order
+        """
+        out = [heapq.heappop(self.heap)[3] for _ in range(len(self.heap))]
+        self.arrivals.clear()
+        self.released.clear()
+        if out:
+            self.last_label = json.loads(out[-1][1][self.sync_field])[self.label]
+        return out
+
+
+class _JoinBuffer():
+    """
+    Ring buffer of the latest entries of a stream and their join keys.
+    Each key (and decoded value) is written twice, at i and i + size, so
+    that the latest n keys are always a contiguous view.
+    """
+
+    def __init__(self, size, codec=None):
+        self.size = size
+        self.codec = codec
+        self.keys = np.zeros(2 * size, dtype=np.float64)
+        self.entries = [None] * size
+        self.values = None
+        if codec is not None:
+            self.values = np.zeros((2 * size, ) + codec.shape,
+                                   dtype=np.float64)
+        self.n = 0
+        self.head = -1  # position of the latest entry
+
+    def add(self, key, entry):
+        self.head = (self.head + 1) % self.size
+        self.keys[self.head] = self.keys[self.head + self.size] = key
+        self.entries[self.head] = entry
+        if self.codec is not None:
+            value = self.codec.decode(entry[1])
+            self.values[self.head] = self.values[self.head + self.size] = value
+        self.n = min(self.n + 1, self.size)
+
+    def window(self):
+        """
+        Slice of the doubled arrays holding the entries, oldest first
+        """
+        end = self.head + self.size + 1
+        return slice(end - self.n, end)
+
+    def entry(self, i_window):
+        return self.entries[(self.head - self.n + 1 + i_window) % self.size]
+
+
+class StreamJoin():
+    """
+    Align each entry of a driving stream with the entries of slower streams
+    by a sync label or by the monotonic time key
+
+    The latest `buffer_size` entries of each slower stream are kept in a
+    ring buffer, so joining a driving entry does not need any Redis reads.
+    Each slower stream is joined in one of these modes:
+
+    * 'asof': latest entry at or before the driving entry
+    * 'nearest': entry closest to the driving entry
+    * 'interp': samples linearly interpolated between the entries before
+      and after the driving entry (requires a codec). If the driving entry
+      is newer than all buffered entries, the latest samples are used.
+    """
+
+    def __init__(self,
+                 driving_stream,
+                 streams,
+                 by='time',
+                 buffer_size=32,
+                 sync_field=b'sync',
+                 time_field=b'ts'):
+        """
+        Parameters
+        ----------
+        driving_stream : str or bytes
+            Name of the stream whose entries are joined
+        streams : dict
+            Slower streams, keyed by name. Each value is a join mode
+            ('asof', 'nearest' or 'interp') or a (mode, StreamCodec) tuple.
+        by : str, optional
+            Name of the sync label to join on, or 'time' (default) to join
+            on the monotonic timestamp in time_field
+        buffer_size : int, optional
+            Number of entries kept for each slower stream, by default 32
+        sync_field : bytes, optional
+            Field of the entries holding the sync labels, by default b'sync'
+        time_field : bytes, optional
+            Field of the entries holding the monotonic timestamp (uint64
+            nanoseconds), by default b'ts'
+        """
+        self.driving_stream = _to_bytes(driving_stream)
+        self.by = by
+        self.sync_field = sync_field
+        self.time_field = time_field
+
+        self.modes = {}
+        self.buffers = {}
+        for stream, mode in streams.items():
+            codec = None
+            if isinstance(mode, tuple):
+                mode, codec = mode
+            if mode not in ('asof', 'nearest', 'interp'):
+                raise ValueError(f'Invalid join mode for {stream}: {mode}')
+            if mode == 'interp' and codec is None:
+                raise ValueError(f'A codec is required to interpolate {stream}')
+            self.modes[_to_bytes(stream)] = mode
+            self.buffers[_to_bytes(stream)] = _JoinBuffer(buffer_size, codec)
+
+        self.last_ids = None
+
+    def key(self, entry_data):
+        """
+        Get the value that entries are joined on
+        """
+        if self.by == 'time':
+            return int.from_bytes(entry_data[self.time_field][:8],
+                                  sys.byteorder)
+        return json.loads(entry_data[self.sync_field])[self.by]
+
+    def add(self, stream, entries):
+        """
+        Buffer the entries of a slower stream. This can be registered as
+        the stream's handler with BRANDNode.registerInput().
+
+        Parameters
+        ----------
+        stream : str or bytes
+            Name of the stream
+        entries : list
+            (entry_id, entry_dict) tuples, as returned by XREAD
+        """
+        buffer = self.buffers[_to_bytes(stream)]
+        for entry in entries:
+            buffer.add(self.key(entry[1]), entry)
+
+    def handler(self, stream):
+        """
+        Get a handler that buffers the entries of a slower stream, for
+        BRANDNode.registerInput()
+        """
+        return lambda entries: self.add(stream, entries)
+
+    def join(self, entry):
+        """
+        Join an entry of the driving stream with the buffered entries
+
+        Parameters
+        ----------
+        entry : tuple
+            (entry_id, entry_dict) tuple of the driving stream
+
+        Returns
+        -------
+        dict
+            For each slower stream, the matched (entry_id, entry_dict)
+            tuple ('asof' and 'nearest') or the interpolated samples
+            ('interp'), or None if no entry matches
+        """
+        key = self.key(entry[1])
+        out = {}
+        for stream, buffer in self.buffers.items():
+            out[stream] = None
+            if buffer.n == 0:
+                continue
+            window = buffer.window()
+            keys = buffer.keys[window]
+            # index of the latest entry at or before the driving entry
+            i_before = int(np.searchsorted(keys, key, side='right')) - 1
+            mode = self.modes[stream]
+            if mode == 'asof':
+                if i_before >= 0:
+                    out[stream] = buffer.entry(i_before)
+            elif mode == 'nearest':
+                if i_before < 0:
+                    i_match = 0
+                elif (i_before + 1 < buffer.n and keys[i_before + 1] - key
+                      < key - keys[i_before]):
+                    i_match = i_before + 1
+                else:
+                    i_match = i_before
+                out[stream] = buffer.entry(i_match)
+            else:
+                values = buffer.values[window]
+                if i_before < 0:
+                    continue
+                if i_before + 1 >= buffer.n or keys[i_before] == key:
+                    out[stream] = values[i_before].copy()
+                else:
+                    weight = ((key - keys[i_before]) /
+                              (keys[i_before + 1] - keys[i_before]))
+                    out[stream] = ((1 - weight) * values[i_before] +
+                                   weight * values[i_before + 1])
+        return out
+
+    def seed(self, r):
+        """
+        Fill the buffer of each slower stream with its latest entries, so
+        that driving entries can be joined before the slower streams write
+        new entries
+
+        Parameters
+        ----------
+        r : redis.Redis
+            instance of the redis.Redis interface
+
+        Returns
+        -------
+        dict
+            ID of the latest entry of each slower stream ('0-0' if empty)
+        """
+        p = r.pipeline(transaction=False)
+        for stream, buffer in self.buffers.items():
+            p.xrevrange(stream, '+', '-', count=buffer.size)
+        last_ids = {}
+        for stream, entries in zip(self.buffers, p.execute()):
+            self.add(stream, entries[::-1])
+            last_ids[stream] = entries[0][0] if entries else '0-0'
+        return last_ids
+
+    def read(self, r, block=None, count=None, start_id='$'):
+        """
+        Read new entries of all streams with one XREAD call, buffer the
+        entries of the slower streams and join each new driving entry
+
+        Parameters
+        ----------
+        r : redis.Redis
+            instance of the redis.Redis interface
+        block : int, optional
+            Number of milliseconds to wait for new entries, by default None
+        count : int, optional
+            Maximum number of entries read from each stream
+        start_id : str, optional
+            ID after which to start reading on the first call, by default
+            '$' (the latest entry of each stream, in which case the
+            buffers of the slower streams are seeded with their latest
+            entries, see seed())
+
+        Returns
+        -------
+        list
+            (driving_entry, matches) tuples, where matches is the output of
+            join(), for each new driving entry
+        """
+        if self.last_ids is None:
+            if start_id == '$':
+                last_entry = r.xrevrange(self.driving_stream, '+', '-',
+                                         count=1)
+                self.last_ids = {
+                    self.driving_stream:
+                    last_entry[0][0] if last_entry else '0-0',
+                    **self.seed(r)
+                }
+            else:
+                self.last_ids = {
+                    stream: start_id
+                    for stream in [self.driving_stream, *self.buffers]
+                }
+
+        driving_entries = []
+        for stream, entries in r.xread(self.last_ids, count=count, block=block):
+            self.last_ids[stream] = entries[-1][0]
+            if stream == self.driving_stream:
+                driving_entries = entries
+            else:
+                self.add(stream, entries)
+        return [(entry, self.join(entry)) for entry in driving_entries]
+
+
+def _to_bytes(stream):
+    return stream.encode() if isinstance(stream, str) else stream
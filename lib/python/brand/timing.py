@@ -1,14 +1,22 @@
 import ctypes
+import errno
 import time
 from ctypes import Structure, c_long, pointer
 from datetime import datetime
 
+import numpy as np
+
 TIMEVAL_LEN = 16  # bytes
 TIMESPEC_LEN = 16  # bytes
 TIMER_ABSTIME = 1
 
 libc = ctypes.CDLL('libc.so.6')
 
+# numpy equivalents of the timeval and timespec structs
+_c_long = f'=i{ctypes.sizeof(c_long)}'
+timeval_dtype = np.dtype([('tv_sec', _c_long), ('tv_usec', _c_long)])
+timespec_dtype = np.dtype([('tv_sec', _c_long), ('tv_nsec', _c_long)])
+
 
 class timespec(Structure):
     """
@@ -52,6 +60,231 @@ def clock_nanosleep(time_ns, clock=time.CLOCK_REALTIME):
     return out
 
 
+class PeriodicTimer():
+    """
+    Fixed-rate timer that sleeps until absolute deadlines, so that the
+    period does not drift with the time spent between calls to wait().
+
+    The timespec passed to clock_nanosleep is allocated once, and timing
+    statistics are kept for deadline misses (overruns) and for the lateness
+    of each wake-up relative to its deadline (jitter).
+
+    Parameters
+    ----------
+    period_ns : int
+        Timer period in nanoseconds
+    clock : int, optional
+        Clock used for the deadlines, by default time.CLOCK_MONOTONIC
+    policy : str, optional
+        What to do when a deadline has already passed when wait() is
+        called: 'skip' (default) drops the missed periods and waits for the
+        next deadline in the future, while 'catchup' returns immediately
+        for each missed period so that the number of ticks is preserved.
+    """
+
+    def __init__(self, period_ns, clock=time.CLOCK_MONOTONIC, policy='skip'):
+        if policy not in ('skip', 'catchup'):
+            raise ValueError(f"Invalid policy: {policy}, use 'skip' or 'catchup'")
+        self.period_ns = int(period_ns)
+        self.clock = clock
+        self.policy = policy
+
+        self._deadline = timespec(0, 0)
+        self._deadline_ptr = pointer(self._deadline)
+
+        self.next_ns = None
+        self.reset_stats()
+
+    def reset_stats(self):
+        """
+        Reset the timing statistics
+        """
+        self.n_ticks = 0
+        self.n_overruns = 0
+        self.n_skipped = 0
+        self.lateness_sum_ns = 0
+        self.lateness_max_ns = 0
+
+    def start(self, start_ns=None):
+        """
+        Start the timer
+
+        Parameters
+        ----------
+        start_ns : int, optional
+            Time of the first deadline, as measured by the timer's clock. By
+            default, the first deadline is one period from now.
+        """
+        if start_ns is None:
+            start_ns = time.clock_gettime_ns(self.clock) + self.period_ns
+        self.next_ns = int(start_ns)
+
+    def wait(self):
+        """
+        Sleep until the next deadline
+
+        Returns
+        -------
+        lateness_ns : int
+            Time (in nanoseconds) between the deadline and the wake-up
+        """
+        if self.next_ns is None:
+            self.start()
+
+        now_ns = time.clock_gettime_ns(self.clock)
+        if now_ns >= self.next_ns:
+            # the deadline was missed before we got to sleep
+            self.n_overruns += 1
+            if self.policy == 'skip':
+                n_missed = (now_ns - self.next_ns) // self.period_ns + 1
+                self.n_skipped += n_missed
+                self.next_ns += n_missed * self.period_ns
+
+        if now_ns < self.next_ns:
+            self._deadline.tv_sec = self.next_ns // 1_000_000_000
+            self._deadline.tv_nsec = self.next_ns % 1_000_000_000
+            while libc.clock_nanosleep(self.clock, TIMER_ABSTIME,
+                                       self._deadline_ptr,
+                                       None) == errno.EINTR:
+                pass
+            now_ns = time.clock_gettime_ns(self.clock)
+
+        lateness_ns = now_ns - self.next_ns
+        self.n_ticks += 1
+        self.lateness_sum_ns += lateness_ns
+        if lateness_ns > self.lateness_max_ns:
+            self.lateness_max_ns = lateness_ns
+
+        self.next_ns += self.period_ns
+        return lateness_ns
+
+    def stats(self):
+        """
+        Get the timing statistics since the last call to reset_stats()
+
+        Returns
+        -------
+        dict
+            Number of ticks, overruns and skipped periods, and the mean and
+            maximum lateness (in nanoseconds)
+        """
+        return {
+            'ticks': self.n_ticks,
+            'overruns': self.n_overruns,
+            'skipped': self.n_skipped,
+            'lateness_mean_ns':
+            self.lateness_sum_ns // self.n_ticks if self.n_ticks else 0,
+            'lateness_max_ns': self.lateness_max_ns,
+        }
+
+
+class LatencyHistogram():
+    """
+    Histogram of durations (in nanoseconds) with fixed log-linear buckets:
+    each power of two is split into 2**SUB_BITS buckets, so adding a value
+    is O(1) and quantiles are accurate to within 1 / 2**SUB_BITS.
+    """
+
+    SUB_BITS = 3
+
+    def __init__(self):
+        self.n_sub = 1 << self.SUB_BITS
+        self.counts = [0] * ((64 - self.SUB_BITS + 1) * self.n_sub)
+        self.reset()
+
+    def reset(self):
+        """
+        Clear all recorded durations
+        """
+        for i in range(len(self.counts)):
+            self.counts[i] = 0
+        self.count = 0
+        self.sum_ns = 0
+        self.max_ns = 0
+
+    def add(self, duration_ns):
+        """
+        Record a duration
+
+        Parameters
+        ----------
+        duration_ns : int
+            Duration in nanoseconds
+        """
+        if duration_ns < self.n_sub:
+            index = max(duration_ns, 0)
+        else:
+            exp = duration_ns.bit_length() - 1
+            sub = (duration_ns >> (exp - self.SUB_BITS)) - self.n_sub
+            index = (exp - self.SUB_BITS + 1) * self.n_sub + sub
+        self.counts[index] += 1
+        self.count += 1
+        self.sum_ns += duration_ns
+        if duration_ns > self.max_ns:
+            self.max_ns = duration_ns
+
+    def _upper_edge(self, index):
+        if index < self.n_sub:
+            return index
+        exp = index // self.n_sub + self.SUB_BITS - 1
+        sub = index % self.n_sub
+        width = 1 << (exp - self.SUB_BITS)
+        return (self.n_sub + sub) * width + width - 1
+
+    def quantile(self, q):
+        """
+        Get an upper bound on a quantile of the recorded durations
+
+        Parameters
+        ----------
+        q : float
+            Quantile between 0 and 1, e.g. 0.99
+
+        Returns
+        -------
+        int
+            Upper edge (in nanoseconds) of the bucket containing the quantile
+        """
+        if self.count == 0:
+            return 0
+        target = max(1, int(q * self.count + 0.5))
+        cumulative = 0
+        for index, n in enumerate(self.counts):
+            cumulative += n
+            if cumulative >= target:
+                return min(self._upper_edge(index), self.max_ns)
+        return self.max_ns
+
+    def summary(self):
+        """
+        Get the count, mean, p50, p99 and maximum of the recorded durations
+
+        Returns
+        -------
+        dict
+            Summary statistics, with durations in nanoseconds
+        """
+        return {
+            'count': self.count,
+            'mean_ns': self.sum_ns // self.count if self.count else 0,
+            'p50_ns': self.quantile(0.5),
+            'p99_ns': self.quantile(0.99),
+            'max_ns': self.max_ns,
+        }
+
+    def buckets(self):
+        """
+        Get the non-empty buckets of the histogram
+
+        Returns
+        -------
+        list
+            [upper_edge_ns, count] pairs, in increasing order of duration
+        """
+        return [[self._upper_edge(index), n]
+                for index, n in enumerate(self.counts) if n]
+
+
 def timeval_to_datetime(val):
     """
     Convert a C timeval object to a Python datetime
@@ -103,6 +336,84 @@ def timespec_to_timestamp(val):
     return timestamp
 
 
+def _as_struct_array(vals, dtype):
+    """
+    View a buffer (or a list of buffers) of packed structs as an array
+    """
+    if isinstance(vals, (list, tuple)):
+        vals = b''.join(vals)
+    return np.frombuffer(vals, dtype=dtype,
+                         count=len(vals) // dtype.itemsize)
+
+
+def timevals_to_array(vals, unit='s'):
+    """
+    Convert packed C timeval objects to an array of timestamps
+
+    Parameters
+    ----------
+    vals : bytes or list of bytes
+        timeval objects encoded as bytes, or a list of such buffers
+    unit : str, optional
+        's' (default) for float64 seconds or 'ns' for int64 nanoseconds
+
+    Returns
+    -------
+    numpy.ndarray
+        Timestamps
+    """
+    tv = _as_struct_array(vals, timeval_dtype)
+    if unit == 'ns':
+        return (tv['tv_sec'].astype(np.int64) * 1_000_000_000 +
+                tv['tv_usec'].astype(np.int64) * 1_000)
+    if unit == 's':
+        return tv['tv_sec'] + tv['tv_usec'] * 1e-6
+    raise ValueError(f"Invalid unit: {unit}, use 's' or 'ns'")
+
+
+def timespecs_to_array(vals, unit='s'):
+    """
+    Convert packed C timespec objects to an array of timestamps
+
+    Parameters
+    ----------
+    vals : bytes or list of bytes
+        timespec objects encoded as bytes, or a list of such buffers
+    unit : str, optional
+        's' (default) for float64 seconds or 'ns' for int64 nanoseconds
+
+    Returns
+    -------
+    numpy.ndarray
+        Timestamps
+    """
+    ts = _as_struct_array(vals, timespec_dtype)
+    if unit == 'ns':
+        return (ts['tv_sec'].astype(np.int64) * 1_000_000_000 +
+                ts['tv_nsec'].astype(np.int64))
+    if unit == 's':
+        return ts['tv_sec'] + ts['tv_nsec'] * 1e-9
+    raise ValueError(f"Invalid unit: {unit}, use 's' or 'ns'")
+
+
+def timevals_to_datetimes(vals):
+    """
+    Convert packed C timeval objects to an array of datetimes
+
+    Parameters
+    ----------
+    vals : bytes or list of bytes
+        timeval objects encoded as bytes, or a list of such buffers
+
+    Returns
+    -------
+    numpy.ndarray
+        datetime64[us] array. Unlike timeval_to_datetime(), which returns
+        local time, these are in UTC.
+    """
+    return (timevals_to_array(vals, unit='ns') // 1_000).astype('datetime64[us]')
+
+
 def timevals_to_timestamps(vals):
     """
     Convert a list of C timeval objects to a list of timestamps (in seconds)
@@ -115,13 +426,7 @@ def timevals_to_timestamps(vals):
     list
         List of timestamps in units of seconds
     """
-    tlen = TIMEVAL_LEN
-    n_timevals = int(len(vals) / tlen)
-    ts = [
-        timeval_to_timestamp(vals[i * tlen:(i + 1) * tlen])
-        for i in range(n_timevals)
-    ]
-    return ts
+    return timevals_to_array(vals).tolist()
 
 
 def timespecs_to_timestamps(vals):
@@ -136,10 +441,4 @@ def timespecs_to_timestamps(vals):
     list
         List of timestamps in units of seconds
     """
-    tlen = TIMESPEC_LEN
-    n_timespecs = int(len(vals) / tlen)
-    ts = [
-        timespec_to_timestamp(vals[i * tlen:(i + 1) * tlen])
-        for i in range(n_timespecs)
-    ]
-    return ts
+    return timespecs_to_array(vals).tolist()
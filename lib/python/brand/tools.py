@@ -1,6 +1,106 @@
+import argparse
+import copy
+import os
+import re
+import shlex
+
 import redis
 import yaml
-import argparse
+
+# parsed graph files, keyed by absolute path
+_graph_cache = {}
+
+
+# -----------------------------------------------------------
+class GraphFile():
+    """
+    Graph settings YAML file, parsed once and indexed by node name
+
+    Use load_graph() to get an instance, so that the file is only parsed
+    again when it changes. Values returned by the methods are shared with
+    the cache and must not be modified.
+
+    Parameters
+    ----------
+    yaml_path : str
+        Path of the YAML file
+    """
+
+    def __init__(self, yaml_path):
+        self.path = yaml_path
+        with open(yaml_path, 'r') as f:
+            self.data = yaml.safe_load(f)
+
+        # the first entry with a given name wins, as in a linear scan
+        self.parameters = {}
+        for record in self.data.get('parameters') or []:
+            self.parameters.setdefault(record['name'], record['value'])
+        self.nodes = {}
+        for node in self.data.get('Nodes') or []:
+            self.nodes.setdefault(node['Name'].split('.')[0], node)
+
+    def parameter(self, field):
+        return self.parameters.get(field)
+
+    def node_parameter(self, node, field):
+        if node in self.nodes:
+            return self.nodes[node]['Parameters'][field]
+
+    def node_parameters(self, node=None):
+        if node is None:
+            return self.data['Nodes']
+        if node in self.nodes:
+            return self.nodes[node]['Parameters']
+
+    def redis_info(self, field):
+        return self.data['RedisConnection'][field]
+
+    def node_io(self, node):
+        io = {'redis_inputs': {}, 'redis_outputs': {}}
+        if node not in self.nodes:
+            return io
+        for key in io:
+            streams = self.nodes[node][key]
+            if type(streams) is str:
+                streams = [streams]
+            for stream in streams or []:
+                io[key][stream] = self.data['RedisStreams'][stream]
+        return io
+
+    def node_stage(self, stage):
+        return [
+            node['Name'] for node in self.data['Nodes']
+            if node['Stage'].lower() == stage.lower()
+        ]
+
+    def node_module(self, node):
+        if node in self.nodes:
+            return self.nodes[node]['Module']
+
+
+def load_graph(yaml_path):
+    """
+    Get the parsed graph settings in a YAML file, parsing it only if it
+    was not parsed before or has changed since
+
+    Parameters
+    ----------
+    yaml_path : str
+        Path of the YAML file
+
+    Returns
+    -------
+    GraphFile
+        Parsed and indexed graph settings
+    """
+    path = os.path.abspath(yaml_path)
+    stat = os.stat(path)
+    key = (stat.st_mtime_ns, stat.st_size)
+    cached = _graph_cache.get(path)
+    if cached is None or cached[0] != key:
+        cached = (key, GraphFile(path))
+        _graph_cache[path] = cached
+    return cached[1]
 
 # -----------------------------------------------------------
 def get_parameter_value(yaml_path, field):
@@ -19,12 +119,7 @@ def get_parameter_value(yaml_path, field):
     object
         Value of the parameter
     """
-    with open(yaml_path, 'r') as f:
-        yamlData = yaml.safe_load(f)
-
-    for record in yamlData['parameters']:
-        if record['name'] == field:
-            return record['value']
+    return copy.deepcopy(load_graph(yaml_path).parameter(field))
 
 
 # -----------------------------------------------------------
@@ -46,12 +141,7 @@ def get_node_parameter_value(yaml_path, node, field):
     object
         Value of the parameter
     """
-    with open(yaml_path, 'r') as f:
-        yamlData = yaml.safe_load(f)
-
-    for node_list in yamlData['Nodes']:
-        if node_list['Name'].split('.')[0] == node:
-            return node_list['Parameters'][field]
+    return copy.deepcopy(load_graph(yaml_path).node_parameter(node, field))
 
 
 # -----------------------------------------------------------
@@ -72,15 +162,8 @@ def get_node_parameter_dump(yaml_path, node):
         All parameters in "parameter" section
         for given node
     """
-    with open(yaml_path, 'r') as f:
-        yamlData = yaml.safe_load(f) # load the parameters file
-
-        if node is not None:        # if we got a node name, return its parameters
-            for node_list in yamlData['Nodes']:
-                if node_list['Name'].split('.')[0] == node:
-                    return node_list['Parameters']
-        else:                       # otherwise, return the full "nodes" dictionary
-            return yamlData['Nodes']
+    # with no node name, return the full "nodes" dictionary
+    return copy.deepcopy(load_graph(yaml_path).node_parameters(node))
 
 
 # -----------------------------------------------------------
@@ -103,10 +186,7 @@ def initializeRedisFromYAML(yaml_path, processName=None):
     pname = f"[{processName}] " if processName is not None else ""
     print(f"{pname}connecting to Redis using: {yaml_path}")
 
-    with open(yaml_path, 'r') as f:
-        yamlData = yaml.safe_load(f)
-
-    redis_params = yamlData['RedisConnection']
+    redis_params = load_graph(yaml_path).data['RedisConnection']
     # connect to redis, figure out the streams of interest
     if ('redis_realtime_socket' in redis_params
             and redis_params['redis_realtime_socket'] is not None):
@@ -144,11 +224,7 @@ def get_redis_info(yaml_path,field):
     string
         ip or port address
     """
-    with open(yaml_path, 'r') as f:
-        yamlData = yaml.safe_load(f)
-        returnValue = yamlData['RedisConnection'][field]
-
-    return returnValue
+    return load_graph(yaml_path).redis_info(field)
 
 
 # -----------------------------------------------------------
@@ -170,34 +246,7 @@ def get_node_io(yaml_path,node):
         'redis_inputs' and one named 'redis_outputs'. 
     """
 
-    # initialize the io dict
-    io = {'redis_inputs':{}, 'redis_outputs':{}}
-    redis_inputs = None
-    redis_outputs = None
-
-
-    with open(yaml_path, 'r') as f:
-        yamlData = yaml.safe_load(f)
-
-
-        # get the list of inputs and outputs for the matching node
-        for node_data in yamlData['Nodes']:
-            if node_data['Name'].split('.')[0] == node:
-                redis_inputs = node_data['redis_inputs']
-                redis_outputs = node_data['redis_outputs']
-                if type(redis_inputs) is str:
-                    redis_inputs = [redis_inputs]
-                if type(redis_outputs) is str:
-                    redis_outputs = [redis_outputs]
-
-        if redis_inputs is not None:
-            for in_stream in redis_inputs:
-                io['redis_inputs'][in_stream] = yamlData['RedisStreams'][in_stream]
-        if redis_outputs is not None:
-            for out_stream in redis_outputs:
-                io['redis_outputs'][out_stream] = yamlData['RedisStreams'][out_stream]
-                
-    return io
+    return copy.deepcopy(load_graph(yaml_path).node_io(node))
 
 # -----------------------------------------------------------
 # Moving all node settings into Redis
@@ -237,12 +286,10 @@ def unpack_string(yaml_path, stream):
     the sample_type field in the graph settings yaml
     """
 
-    with open(yaml_path, 'r') as f:
-        yamlData = yaml.safe_load(f)
-
-    sample_type = yamlData['RedisStreams'][stream]['sample_type']
-    num_chans = yamlData['RedisStreams'][stream]['chan_per_stream']
-    num_samp = yamlData['RedisStreams'][stream]['samp_per_stream']
+    stream_info = load_graph(yaml_path).data['RedisStreams'][stream]
+    sample_type = stream_info['sample_type']
+    num_chans = stream_info['chan_per_stream']
+    num_samp = stream_info['samp_per_stream']
     
     if sample_type in ['int16', 'short']:
         packString = 'h'
@@ -252,6 +299,14 @@ def unpack_string(yaml_path, stream):
         packString = 'I'
     elif sample_type == 'char':
         packString = 'b'
+    elif sample_type in ['uint16', 'uInt16']:
+        packString = 'H'
+    elif sample_type in ['uint64', 'uInt64']:
+        packString = 'Q'
+    elif sample_type in ['float32', 'float']:
+        packString = 'f'
+    elif sample_type in ['float64', 'double']:
+        packString = 'd'
     else:
         return -1
 
@@ -267,16 +322,7 @@ def node_stage(yaml_path, stage):
     Returns the names of all of the nodes that have been associated
     with that stage of the run process
     """
-    
-    with open(yaml_path, 'r') as f:
-        yamlData = yaml.safe_load(f)
-
-    # return the list of node names that match the desired stage
-    stage_nodes = []
-    for nodes in yamlData['Nodes']:
-        if nodes['Stage'].lower() == stage.lower():
-            stage_nodes.append(nodes['Name'])
-    
+    stage_nodes = load_graph(yaml_path).node_stage(stage)
     return ' '.join(stage_nodes) # create a single string of all of the items with spaces between -- for bash convenience
 
 # -----------------------------------------------------------
@@ -297,13 +343,96 @@ def get_node_module(yaml_path, node_name):
     str
         Module name for node
     """
+    return load_graph(yaml_path).node_module(node_name)
 
-    with open(yaml_path, 'r') as f:
-        yamlData = yaml.safe_load(f)
+# -----------------------------------------------------------
+# many values at once -- so that Make and bash only start Python once
+def query_graph(yaml_path, query):
+    """
+    Get a value from a YAML file using a short query string
 
-    for node in yamlData['Nodes']:
-        if node['Name'].split('.')[0] == node_name:
-            return node['Module']
+    Parameters
+    ----------
+    yaml_path : str
+        Path of the YAML file
+    query : str
+        'ip' or 'port' for the Redis connection, 'stage:<stage>' for the
+        names of the nodes in a stage, 'module:<node>' for the module of a
+        node, '<node>.<parameter>' for a node parameter, or '<name>' for a
+        top-level parameter
+
+    Returns
+    -------
+    object
+        The value, or None if it was not found
+    """
+    graph = load_graph(yaml_path)
+    if query in ('ip', 'port'):
+        return graph.redis_info(f'redis_realtime_{query}')
+    kind, _, arg = query.partition(':')
+    if kind == 'stage' and arg:
+        return ' '.join(graph.node_stage(arg))
+    if kind == 'module' and arg:
+        return graph.node_module(arg)
+    node, _, field = query.partition('.')
+    if field:
+        return (graph.nodes.get(node, {}).get('Parameters') or {}).get(field)
+    return graph.parameter(query)
+
+
+def _include_value(value):
+    # lists become space-separated words, for bash and Make loops
+    if isinstance(value, (list, tuple)):
+        return ' '.join(str(v) for v in value)
+    return '' if value is None else str(value)
+
+
+def graph_include(yaml_path, fmt='make', prefix='GRAPH_'):
+    """
+    Write the scalar values of a YAML file as variable assignments that
+    can be included in a Makefile (fmt='make') or sourced by bash
+    (fmt='sh')
+
+    The variables are <prefix><key> for the Redis connection settings and
+    top-level parameters, <prefix>NODES for the node names,
+    <prefix>STAGE_<stage> for the nodes in each stage, <prefix>MODULE_<node>
+    for the module of each node and <prefix><node>_<parameter> for each
+    node parameter. Characters that cannot be used in a variable name are
+    replaced with '_', and dictionary values are skipped.
+
+    Returns
+    -------
+    str
+        The variable assignments, one per line
+    """
+    graph = load_graph(yaml_path)
+    variables = {}
+    for key, value in (graph.data.get('RedisConnection') or {}).items():
+        variables[key] = value
+    variables.update(graph.parameters)
+    variables['NODES'] = list(graph.nodes)
+    # stages are matched case-insensitively, as in node_stage()
+    for stage in sorted({str(n['Stage']).lower() for n in graph.nodes.values()
+                         if n.get('Stage') is not None}):
+        variables[f'STAGE_{stage}'] = graph.node_stage(stage)
+    for node, node_data in graph.nodes.items():
+        if 'Module' in node_data:
+            variables[f'MODULE_{node}'] = node_data['Module']
+        for key, value in (node_data.get('Parameters') or {}).items():
+            variables[f'{node}_{key}'] = value
+
+    lines = [f'# generated by brand.tools from {graph.path}']
+    for key, value in variables.items():
+        if isinstance(value, dict):
+            continue
+        name = re.sub(r'\W', '_', prefix + str(key))
+        value = _include_value(value)
+        if fmt == 'sh':
+            lines.append(f'{name}={shlex.quote(value)}')
+        else:
+            value = value.replace('$', '$$').replace('#', '\\#')
+            lines.append(f'{name} := {value}')
+    return '\n'.join(lines) + '\n'
 
 # -----------------------------------------------------------
 # running the function as a script -- for C and Bash usage
@@ -321,6 +450,11 @@ def main():
         the --stage flag is used with "start", "main" or "end" to return a list of nodes
         that will run during that process period. Refer to the run script for more info
 
+        The --get flag takes any number of queries (see query_graph) and prints one
+        value per line, and the --include flag prints every value as variables for a
+        Makefile ("make") or a bash script ("sh"), so that a single invocation can
+        replace many.
+
         This should be used only for c or bash."""
 
     parser = argparse.ArgumentParser(description=description)
@@ -330,13 +464,20 @@ def main():
     parser.add_argument('file', default="", type=str, help='The YAML file to be loaded')
     parser.add_argument('--redis', help="Return the port and ip for the redis instance")
     parser.add_argument('--stage', type=str, help="Returns list of Start, Main or End modules")
+    parser.add_argument('--get', nargs='+', metavar='QUERY', help="Return one value per line: ip, port, stage:<stage>, module:<node>, <node>.<parameter> or <parameter>")
+    parser.add_argument('--include', choices=['make', 'sh'], help="Return all values as Make or bash variables")
+    parser.add_argument('--prefix', type=str, default='GRAPH_', help="Prefix of the variables returned by --include")
     redisGroup = parser.add_mutually_exclusive_group()
     redisGroup.add_argument('--ip', help='IP for the redis instance', action="store_true")
     redisGroup.add_argument('--port', help='port for the redis instance',  action="store_true")
 
     args = parser.parse_args()
 
-    if args.ip:
+    if args.get:
+        print('\n'.join(_include_value(query_graph(args.file, q)) for q in args.get))
+    elif args.include:
+        print(graph_include(args.file, args.include, args.prefix), end="")
+    elif args.ip:
         print(get_redis_info(args.file,'redis_realtime_ip'))
     elif args.port:
         print(get_redis_info(args.file,'redis_realtime_port'))
@@ -355,7 +496,3 @@ def main():
 
 if __name__ == '__main__':
     main()
-
-
-
-
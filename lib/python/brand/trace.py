@@ -0,0 +1,525 @@
+"""
+Trace the latency of data through a graph
+
+Nodes label their output entries with the sync labels of the inputs they
+were computed from and stamp them with a monotonic time key (see
+doc/DataSyncGuidelines.md). Following each label value from stream to
+stream gives the latency of every edge of the graph (from a node's input
+stream to its output stream) and the end-to-end latency from each source
+stream to each sink stream, along with the slowest paths through the
+graph. The streams of each node are found in its parameters in the
+supergraph, and time keys written on other machines are converted to the
+supervisor's clock with the models in the clock_offsets stream.
+
+Usage:
+    python -m brand.trace                       # what is in Redis now
+    python -m brand.trace --follow              # online, to latency_trace
+    python -m brand.trace --rdb path/to/session.rdb -o trace.json
+"""
+import argparse
+import heapq
+import itertools
+import json
+import logging
+import re
+import sys
+import time
+
+from redis import Redis
+
+from .clock import get_clock_offsets, to_reference_ns
+from .exceptions import GraphError
+from .timing import LatencyHistogram
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_REDIS_IP = '127.0.0.1'
+DEFAULT_REDIS_PORT = 6379
+DEFAULT_SOURCE_PORT = 6380
+TRACE_STREAM = 'latency_trace'
+
+# parameters whose names contain these words hold input or output streams
+_INPUT_KEY = re.compile(r'(^|_)(in|inputs?)(_|$)')
+_OUTPUT_KEY = re.compile(r'(^|_)(out|outputs?)(_|$)')
+
+
+def _strings(value):
+    """
+    Strings in a parameter value, including those in nested lists and the
+    keys of nested dictionaries
+    """
+    if isinstance(value, str):
+        yield value
+    elif isinstance(value, dict):
+        for key, item in value.items():
+            yield from _strings(key)
+            yield from _strings(item)
+    elif isinstance(value, (list, tuple)):
+        for item in value:
+            yield from _strings(item)
+
+
+def get_supergraph(r):
+    """
+    Get the latest supergraph published to supergraph_stream
+    """
+    entries = r.xrevrange('supergraph_stream', count=1)
+    if not entries:
+        raise GraphError('No supergraph has been published to Redis')
+    return json.loads(entries[0][1][b'data'])
+
+
+def graph_topology(supergraph, streams):
+    """
+    Find the input and output streams of each node of a supergraph
+
+    Stream names are looked up in the values of each node's parameters.
+    Those found in a parameter whose name contains 'out' or 'output' (e.g.
+    output_stream or output_retention) are outputs, and those found in a
+    parameter whose name contains 'in' or 'input' are inputs. Any other
+    stream is an input if another node outputs it and an output otherwise.
+
+    Parameters
+    ----------
+    supergraph : dict
+        Supergraph, as published to supergraph_stream
+    streams : set
+        Names of the streams that exist in Redis
+
+    Returns
+    -------
+    dict
+        For each node nickname, a dict with its 'inputs' and 'outputs' (sets
+        of stream names) and its 'machine' (None if it runs on the
+        supervisor's machine)
+    """
+    topology = {}
+    for nickname, node in supergraph.get('nodes', {}).items():
+        inputs, outputs, other = set(), set(), set()
+        for key, value in (node.get('parameters') or {}).items():
+            names = {name for name in _strings(value) if name in streams}
+            if _OUTPUT_KEY.search(key):
+                outputs |= names
+            elif _INPUT_KEY.search(key):
+                inputs |= names
+            else:
+                other |= names
+        topology[nickname] = {
+            'inputs': inputs,
+            'outputs': outputs,
+            'other': other - inputs - outputs,
+            'machine': node.get('machine')
+        }
+
+    written = set()
+    for node in topology.values():
+        written |= node['outputs']
+    for node in topology.values():
+        other = node.pop('other')
+        node['inputs'] |= other & written
+        node['outputs'] |= other - written
+    return topology
+
+
+def _hist_report(hist):
+    return {**hist.summary(), 'histogram': hist.buckets()}
+
+
+class LatencyTracer():
+    """
+    Measure the latency of each edge of a graph and of each path from a
+    source stream to a sink stream by matching sync label values
+
+    Each label value is matched on the first entry of each stream that
+    carries it. Histograms accumulate over all calls to update().
+
+    Parameters
+    ----------
+    r : redis.Redis
+        Connection to the Redis instance holding the graph's streams
+    supergraph : dict, optional
+        Supergraph of the graph, by default the latest one in
+        supergraph_stream
+    clock_models : dict, optional
+        Clock model of each machine, by default the latest ones in
+        clock_offsets (see brand.clock)
+    sync_field : bytes, optional
+        Field holding the JSON-encoded sync labels, by default b'sync'
+    time_field : bytes, optional
+        Field holding the monotonic time key, by default b'ts'
+    n_slowest : int, optional
+        Number of slowest end-to-end paths to keep, by default 10
+    max_history : int, optional
+        Number of label values kept per stream to match later entries
+        against, by default 10000. None keeps all of them.
+    chunk_size : int, optional
+        Number of entries read from each stream at a time, by default 1000
+    """
+
+    def __init__(self,
+                 r,
+                 supergraph=None,
+                 clock_models=None,
+                 sync_field=b'sync',
+                 time_field=b'ts',
+                 n_slowest=10,
+                 max_history=10000,
+                 chunk_size=1000):
+        self.r = r
+        self.sync_field = sync_field
+        self.time_field = time_field
+        self.n_slowest = n_slowest
+        self.max_history = max_history
+        self.chunk_size = chunk_size
+
+        if supergraph is None:
+            supergraph = get_supergraph(r)
+        if clock_models is None:
+            clock_models = get_clock_offsets(r)
+
+        # only streams that exist can be traced
+        candidates = set()
+        for node in supergraph.get('nodes', {}).values():
+            for value in (node.get('parameters') or {}).values():
+                candidates.update(_strings(value))
+        candidates = sorted(candidates)
+        p = r.pipeline(transaction=False)
+        for name in candidates:
+            p.type(name)
+        streams = {
+            name
+            for name, kind in zip(candidates, p.execute())
+            if kind == b'stream'
+        }
+        self.topology = graph_topology(supergraph, streams)
+
+        self.edges = []  # (input stream, output stream, node nickname)
+        self.clock_model = {}  # clock model of the machine writing a stream
+        for nickname, node in self.topology.items():
+            model = clock_models.get(node['machine'])
+            for out_stream in node['outputs']:
+                if model is not None:
+                    self.clock_model[out_stream] = model
+                for in_stream in node['inputs']:
+                    if in_stream != out_stream:
+                        self.edges.append((in_stream, out_stream, nickname))
+        self.streams = sorted({s for edge in self.edges for s in edge[:2]})
+
+        downstream = {s: set() for s in self.streams}
+        upstream = {s: set() for s in self.streams}
+        for in_stream, out_stream, _ in self.edges:
+            downstream[in_stream].add(out_stream)
+            upstream[out_stream].add(in_stream)
+        self.sources = [s for s in self.streams if not upstream[s]]
+        self.sinks = [s for s in self.streams if not downstream[s]]
+        self.paths = {}
+        for source in self.sources:
+            for sink, path in self._find_paths(source, downstream).items():
+                if sink in self.sinks:
+                    self.paths[(source, sink)] = path
+        self.read_order = self._read_order(upstream, downstream)
+
+        self.last_ids = {s: '-' for s in self.streams}
+        self.times = {s: {} for s in self.streams}
+        self.edge_hists = {}
+        self.path_hists = {}
+        self.slowest = []
+        self.n_traced = 0
+
+    @staticmethod
+    def _find_paths(source, downstream):
+        """
+        Shortest path from a source to each stream downstream of it
+        """
+        paths = {source: [source]}
+        frontier = [source]
+        while frontier:
+            next_frontier = []
+            for stream in frontier:
+                for out in sorted(downstream[stream]):
+                    if out not in paths:
+                        paths[out] = paths[stream] + [out]
+                        next_frontier.append(out)
+            frontier = next_frontier
+        return paths
+
+    def _read_order(self, upstream, downstream):
+        """
+        Order the streams from sinks to sources, so that when a stream is
+        read, the entries its new entries were computed from have already
+        been written to the streams that are read after it
+        """
+        order = []
+        n_down = {s: len(downstream[s]) for s in self.streams}
+        ready = [s for s in self.streams if not n_down[s]]
+        while ready:
+            stream = ready.pop()
+            order.append(stream)
+            for in_stream in upstream[stream]:
+                n_down[in_stream] -= 1
+                if not n_down[in_stream]:
+                    ready.append(in_stream)
+        # streams in feedback loops have no such order
+        order += [s for s in self.streams if s not in order]
+        return order
+
+    def _decode(self, stream, entries):
+        """
+        Get the sync labels and time key of each entry, with the time keys
+        converted to the supervisor's clock
+        """
+        labels, times = [], []
+        for _, entry_data in entries:
+            sync = entry_data.get(self.sync_field)
+            ts = entry_data.get(self.time_field)
+            if sync is None or ts is None:
+                continue
+            labels.append(json.loads(sync))
+            times.append(int.from_bytes(ts[:8], sys.byteorder))
+        if stream in self.clock_model and times:
+            times = to_reference_ns(self.clock_model[stream], times).tolist()
+        return zip(labels, times)
+
+    def read(self, end='+'):
+        """
+        Read the new entries of all streams and record the time of the
+        first entry carrying each label value
+
+        Returns
+        -------
+        dict
+            (label value, time) pairs seen for the first time, for each
+            stream and label name
+        """
+        new = {s: {} for s in self.streams}
+        while True:
+            p = self.r.pipeline(transaction=False)
+            for stream in self.read_order:
+                last_id = self.last_ids[stream]
+                p.xrange(stream,
+                         min=last_id if last_id == '-' else '(' + last_id,
+                         max=end,
+                         count=self.chunk_size)
+            more = False
+            for stream, entries in zip(self.read_order, p.execute()):
+                if not entries:
+                    continue
+                self.last_ids[stream] = entries[-1][0].decode()
+                more |= len(entries) == self.chunk_size
+                for sync, ts in self._decode(stream, entries):
+                    for label, value in sync.items():
+                        if isinstance(value, (list, dict)):
+                            value = json.dumps(value)
+                        seen = self.times[stream].setdefault(label, {})
+                        if value not in seen:
+                            seen[value] = ts
+                            new[stream].setdefault(label, []).append(
+                                (value, ts))
+            if not more:
+                return new
+
+    def _prune(self):
+        if self.max_history is None:
+            return
+        for labels in self.times.values():
+            for seen in labels.values():
+                excess = len(seen) - self.max_history
+                if excess > 0:
+                    for value in list(itertools.islice(seen, excess)):
+                        del seen[value]
+
+    def _hops(self, path, label, value, t0):
+        """
+        Latency at which a label value reached each stream of a path
+        """
+        hops = []
+        for stream in path:
+            t = self.times[stream].get(label, {}).get(value)
+            hops.append({
+                'stream': stream,
+                'latency_ns': None if t is None else t - t0
+            })
+        return hops
+
+    def update(self, end='+'):
+        """
+        Read the new entries of all streams and add the latencies of the
+        label values seen for the first time to the histograms
+
+        Returns
+        -------
+        int
+            Number of end-to-end latencies that were added
+        """
+        new = self.read(end)
+
+        for in_stream, out_stream, nickname in self.edges:
+            for label, values in new[out_stream].items():
+                seen = self.times[in_stream].get(label)
+                if seen is None:
+                    continue
+                key = (in_stream, out_stream, nickname, label)
+                for value, ts in values:
+                    if value in seen:
+                        if key not in self.edge_hists:
+                            self.edge_hists[key] = LatencyHistogram()
+                        self.edge_hists[key].add(ts - seen[value])
+
+        n_traced = 0
+        for (source, sink), path in self.paths.items():
+            for label, values in new[sink].items():
+                seen = self.times[source].get(label)
+                if seen is None:
+                    continue
+                key = (source, sink, label)
+                for value, ts in values:
+                    if value not in seen:
+                        continue
+                    t0 = seen[value]
+                    if key not in self.path_hists:
+                        self.path_hists[key] = LatencyHistogram()
+                    self.path_hists[key].add(ts - t0)
+                    n_traced += 1
+                    latency = ts - t0
+                    if self.n_slowest and (len(self.slowest) < self.n_slowest
+                                           or latency > self.slowest[0][0]):
+                        item = (latency, self.n_traced + n_traced, {
+                            'latency_ns': latency,
+                            'source': source,
+                            'sink': sink,
+                            'label': label,
+                            'value': value,
+                            'path': self._hops(path, label, value, t0)
+                        })
+                        if len(self.slowest) < self.n_slowest:
+                            heapq.heappush(self.slowest, item)
+                        else:
+                            heapq.heapreplace(self.slowest, item)
+        self.n_traced += n_traced
+
+        self._prune()
+        return n_traced
+
+    def report(self):
+        """
+        Summarize the latencies traced so far
+
+        Returns
+        -------
+        dict
+            'edges': summary and histogram of the latency of each edge,
+            'end_to_end': summary and histogram of the latency from each
+            source to each sink, and 'slowest': the slowest label values
+            from a source to a sink, with the latency at which they reached
+            each stream along the way. Latencies are in nanoseconds, and
+            histograms are lists of [upper_edge_ns, count] pairs.
+        """
+        edges = [{
+            'from': in_stream,
+            'to': out_stream,
+            'node': nickname,
+            'label': label,
+            **_hist_report(hist)
+        } for (in_stream, out_stream, nickname, label), hist in
+                 self.edge_hists.items()]
+        end_to_end = [{
+            'source': source,
+            'sink': sink,
+            'label': label,
+            **_hist_report(hist)
+        } for (source, sink, label), hist in self.path_hists.items()]
+        slowest = [item for _, _, item in sorted(self.slowest, reverse=True)]
+        return {'edges': edges, 'end_to_end': end_to_end, 'slowest': slowest}
+
+    def run(self, interval=1, stop_event=None, stream=TRACE_STREAM):
+        """
+        Trace the graph online, starting from its newest entries, and
+        publish the report as JSON (in the 'data' key) to a stream every
+        interval seconds until stop_event is set
+        """
+        p = self.r.pipeline(transaction=False)
+        for s in self.streams:
+            p.xrevrange(s, count=1)
+        for s, entries in zip(self.streams, p.execute()):
+            if entries:
+                self.last_ids[s] = entries[0][0].decode()
+
+        while stop_event is None or not stop_event.is_set():
+            time.sleep(interval)
+            self.update()
+            self.r.xadd(stream, {'data': json.dumps(self.report())},
+                        maxlen=1000,
+                        approximate=True)
+
+
+def _log_report(report):
+    for edge in report['edges']:
+        logger.info(f"{edge['from']} -> {edge['to']} ({edge['node']}, "
+                    f"{edge['label']}): n={edge['count']} "
+                    f"p50={edge['p50_ns'] / 1e6:.3f} ms "
+                    f"p99={edge['p99_ns'] / 1e6:.3f} ms "
+                    f"max={edge['max_ns'] / 1e6:.3f} ms")
+    for path in report['end_to_end']:
+        logger.info(f"{path['source']} => {path['sink']} ({path['label']}): "
+                    f"n={path['count']} p50={path['p50_ns'] / 1e6:.3f} ms "
+                    f"p99={path['p99_ns'] / 1e6:.3f} ms "
+                    f"max={path['max_ns'] / 1e6:.3f} ms")
+
+
+def main():
+    ap = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    ap.add_argument('-i', '--host', default=DEFAULT_REDIS_IP,
+                    help='ip address of the redis server'
+                    f' (default: {DEFAULT_REDIS_IP})')
+    ap.add_argument('-p', '--port', type=int, default=DEFAULT_REDIS_PORT,
+                    help='port of the redis server'
+                    f' (default: {DEFAULT_REDIS_PORT})')
+    ap.add_argument('--rdb', help='RDB file of a recorded session to trace')
+    ap.add_argument('--src-port', type=int, default=DEFAULT_SOURCE_PORT,
+                    help='port of the redis server started for the RDB file'
+                    f' (default: {DEFAULT_SOURCE_PORT})')
+    ap.add_argument('--follow', action='store_true',
+                    help=f'trace new entries and publish to {TRACE_STREAM}')
+    ap.add_argument('--interval', type=float, default=1,
+                    help='seconds between reports with --follow'
+                    ' (default: 1)')
+    ap.add_argument('--slowest', type=int, default=10,
+                    help='number of slowest paths to report (default: 10)')
+    ap.add_argument('-o', '--output', help='file to write the report to')
+    args = ap.parse_args()
+
+    logging.basicConfig(format='[trace] %(levelname)s: %(message)s',
+                        level=logging.INFO)
+    src_proc = None
+    if args.rdb:
+        from .replay import start_source_server
+        src_proc, r = start_source_server(args.rdb, args.src_port)
+    else:
+        r = Redis(args.host, args.port)
+
+    try:
+        if args.follow:
+            tracer = LatencyTracer(r, n_slowest=args.slowest)
+            logger.info(f'Tracing {tracer.streams}, publishing to '
+                        f'{TRACE_STREAM}')
+            tracer.run(args.interval)
+        else:
+            tracer = LatencyTracer(r, n_slowest=args.slowest, max_history=None)
+            tracer.update()
+            report = tracer.report()
+            _log_report(report)
+            if args.output:
+                with open(args.output, 'w') as f:
+                    json.dump(report, f, indent=2)
+            else:
+                json.dump(report, sys.stdout)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        if src_proc is not None:
+            src_proc.terminate()
+            src_proc.wait()
+
+
+if __name__ == '__main__':
+    main()
@@ -10,6 +10,6 @@ setup(
         'numpy',
         'psutil',
         'pyyaml',
-        'redis'
+        'redis>=4.2'
     ]
 )
@@ -0,0 +1,9 @@
+from brand import NodeHost
+
+if __name__ == '__main__':
+    # parse command line arguments
+    args = NodeHost.parse_host_args()
+    kwargs = vars(args)
+    # Run the hosted nodes
+    host = NodeHost(**kwargs)
+    host.run()